@@ -1,5 +1,29 @@
-from barbell2.bodycomp.totalseg import TotalSegmentator
-from barbell2.bodycomp.selectroi import RoiSelector
-from barbell2.bodycomp.selectslice import SliceSelector
-from barbell2.bodycomp.seg import MuscleFatSegmentator
-from barbell2.bodycomp.calculator import BodyCompositionCalculator
+import importlib
+
+# Classes are imported on first access so that importing a single tool from this package
+# (e.g., barbell2.bodycomp.adddcmext) does not pull in nibabel, TensorFlow, etc.
+_classes = {
+    'TotalSegmentator': 'barbell2.bodycomp.totalseg',
+    'TotalSegmentatorRunner': 'barbell2.bodycomp.totalseg',
+    'RoiSelector': 'barbell2.bodycomp.selectroi',
+    'SliceSelector': 'barbell2.bodycomp.selectslice',
+    'MuscleFatSegmentator': 'barbell2.bodycomp.seg',
+    'BodyCompositionCalculator': 'barbell2.bodycomp.calculator',
+    'DicomIndex': 'barbell2.bodycomp.dicomindex',
+    'TrainingDataset': 'barbell2.bodycomp.trainingdata',
+    'Pipeline': 'barbell2.bodycomp.pipeline',
+    'PipelineStage': 'barbell2.bodycomp.pipeline',
+    'BodyCompositionPipeline': 'barbell2.bodycomp.pipeline',
+}
+
+__all__ = list(_classes.keys())
+
+
+def __getattr__(name):
+    if name in _classes:
+        return getattr(importlib.import_module(_classes[name]), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
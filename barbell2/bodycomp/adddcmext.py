@@ -1,26 +1,25 @@
 import os
 import shutil
-import pydicom
-import pydicom.errors
 import argparse
 
 
 def main():
+    from barbell2.bodycomp.dicomindex import DicomIndex
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_dir', help='Input directory', default='.')
     parser.add_argument('--output_dir', help='Output directory', default='output')
     args = parser.parse_args()
     os.makedirs(args.output_dir)
+    dicom_files = set([str(f) for f in DicomIndex(args.input_dir).file_paths])
     for f in os.listdir(args.input_dir):
         f_path = os.path.join(args.input_dir, f)
         f_path_new = os.path.join(args.output_dir, f)
-        try:
-            pydicom.dcmread(f_path, stop_before_pixels=True)
+        if f_path in dicom_files:
             if not f.endswith('.dcm'):
                 f_path_new = f_path_new + '.dcm'
             shutil.copy(f_path, f_path_new)
             print(f_path_new)
-        except pydicom.errors.InvalidDicomError:
+        else:
             # Non-DICOM files are copied to output directory by default
             shutil.copy(f_path, f_path_new)
 
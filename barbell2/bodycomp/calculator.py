@@ -1,9 +1,11 @@
 import os
+import csv
 import logging
 import pydicom
 import numpy as np
 
-from barbell2.utils import calculate_area, calculate_mean_radiation_attenuation, get_pixels
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from barbell2.utils import calculate_label_statistics, get_pixels
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +15,7 @@ class BodyCompositionCalculator:
     MUSCLE = 1
     VAT = 5
     SAT = 7
+    METRICS = ['muscle_area', 'vat_area', 'sat_area', 'muscle_ra', 'vat_ra', 'sat_ra']
 
     def __init__(self):
         self.input_files = None                 # L3 images
@@ -31,55 +34,141 @@ class BodyCompositionCalculator:
     def load_segmentation(f_path):
         return np.load(f_path)
 
-    def execute(self):
-        # TODO: If heights are provided, output index values!!!
-        logger.info('Running BodyCompositionCalculator...')
+    @staticmethod
+    def calculate_metrics(input_file, input_segmentation_file):
+        image, pixel_spacing = BodyCompositionCalculator.load_dicom(input_file)
+        segmentations = BodyCompositionCalculator.load_segmentation(input_segmentation_file)
+        statistics = calculate_label_statistics(image, segmentations, pixel_spacing, [
+            BodyCompositionCalculator.MUSCLE, BodyCompositionCalculator.VAT, BodyCompositionCalculator.SAT])
+        return {
+            'muscle_area': statistics[BodyCompositionCalculator.MUSCLE]['area'],
+            'vat_area': statistics[BodyCompositionCalculator.VAT]['area'],
+            'sat_area': statistics[BodyCompositionCalculator.SAT]['area'],
+            'muscle_ra': statistics[BodyCompositionCalculator.MUSCLE]['mean_ra'],
+            'vat_ra': statistics[BodyCompositionCalculator.VAT]['mean_ra'],
+            'sat_ra': statistics[BodyCompositionCalculator.SAT]['mean_ra'],
+        }
+
+    def check_inputs(self):
         if self.input_files is None:
             logger.error('Input files not specified')
-            return None
+            return False
         if self.input_segmentation_files is None:
             logger.error('Input segmentation files not specified')
-            return None
+            return False
         # Check that we're not dealing with probability maps
         if self.input_segmentation_files[0].endswith('.seg.prob.npy'):
             logger.error('Cannot handle *.seg.prob.npy files')
-            return None
+            return False
+        return True
+
+    def get_file_pairs(self):
         # Check that for each input file we have a matching segmentation file
+        segmentation_files = {}
+        for input_segmentation_file in self.input_segmentation_files:
+            segmentation_files[os.path.split(input_segmentation_file)[1]] = input_segmentation_file
         file_pairs = []
         for input_file in self.input_files:
             input_file_name = os.path.split(input_file)[1]
-            found = False
-            for input_segmentation_file in self.input_segmentation_files:
-                input_segmentation_file_name = os.path.split(input_segmentation_file)[1]
-                if input_file_name + '.seg.npy' == input_segmentation_file_name:
-                    file_pairs.append((input_file, input_segmentation_file))
-                    found = True
-                    break
-            if not found:
-                logger.warn(f'Input file {input_file_name} missing corresponding segmentation file')
+            input_segmentation_file = segmentation_files.get(input_file_name + '.seg.npy')
+            if input_segmentation_file is None:
+                logger.warning(f'Input file {input_file_name} missing corresponding segmentation file')
+                continue
+            file_pairs.append((input_file, input_segmentation_file))
+        return file_pairs
+
+    def execute(self):
+        # TODO: If heights are provided, output index values!!!
+        logger.info('Running BodyCompositionCalculator...')
+        if not self.check_inputs():
+            return None
+        file_pairs = self.get_file_pairs()
         # Work with found file pairs
         self.output_metrics = {}
         for file_pair in file_pairs:
-            image, pixel_spacing = self.load_dicom(file_pair[0])
-            segmentations = self.load_segmentation(file_pair[1])
-            self.output_metrics[file_pair[0]] = {}
-            self.output_metrics[file_pair[0]] = {
-                'muscle_area': calculate_area(segmentations, BodyCompositionCalculator.MUSCLE, pixel_spacing),
-                'vat_area': calculate_area(segmentations, BodyCompositionCalculator.VAT, pixel_spacing),
-                'sat_area': calculate_area(segmentations, BodyCompositionCalculator.SAT, pixel_spacing),
-                'muscle_ra': calculate_mean_radiation_attenuation(image, segmentations, BodyCompositionCalculator.MUSCLE),
-                'vat_ra': calculate_mean_radiation_attenuation(image, segmentations, BodyCompositionCalculator.VAT),
-                'sat_ra': calculate_mean_radiation_attenuation(image, segmentations, BodyCompositionCalculator.SAT),
-            }
+            self.output_metrics[file_pair[0]] = self.calculate_metrics(file_pair[0], file_pair[1])
             logger.info(f'{file_pair[0]}:')
-            logger.info(' - muscle_area: {}'.format(self.output_metrics[file_pair[0]]['muscle_area']))
-            logger.info(' - vat_area: {}'.format(self.output_metrics[file_pair[0]]['muscle_area']))
-            logger.info(' - sat_area: {}'.format(self.output_metrics[file_pair[0]]['muscle_area']))
-            logger.info(' - muscle_ra: {}'.format(self.output_metrics[file_pair[0]]['muscle_area']))
-            logger.info(' - vat_ra: {}'.format(self.output_metrics[file_pair[0]]['muscle_area']))
-            logger.info(' - sat_ra: {}'.format(self.output_metrics[file_pair[0]]['muscle_area']))
+            for k, v in self.output_metrics[file_pair[0]].items():
+                logger.info(f' - {k}: {v}')
         return self.output_metrics
 
+    @staticmethod
+    def load_checkpoint(checkpoint_file):
+        """ Returns set of input files already present in the checkpoint CSV file. An incomplete
+        last line (e.g., after a crash) is truncated so new rows can be appended safely
+        """
+        done = set()
+        if not os.path.isfile(checkpoint_file):
+            return done
+        with open(checkpoint_file, 'rb+') as f:
+            content = f.read()
+            if len(content) > 0 and not content.endswith(b'\n'):
+                f.truncate(content.rfind(b'\n') + 1)
+        with open(checkpoint_file, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                if row.get('file') and None not in row.values():
+                    done.add(row['file'])
+        return done
+
+    @staticmethod
+    def has_parquet_engine():
+        import importlib.util
+        if importlib.util.find_spec('pandas') is None:
+            return False
+        return any([importlib.util.find_spec(engine) is not None for engine in ['pyarrow', 'fastparquet']])
+
+    def execute_cohort(self, output_file, workers=None):
+        """ Calculates metrics for all file pairs across a process pool and appends each result
+        to a CSV file as soon as it is available. The CSV file doubles as a checkpoint: input files
+        already listed in it are skipped, so an interrupted run can simply be restarted. If the
+        output file has extension .parquet, the CSV checkpoint is written next to it and converted
+        to Parquet once all file pairs are done
+        :param output_file Output CSV or Parquet file
+        :param workers Number of worker processes (default: number of CPUs)
+        """
+        logger.info('Running BodyCompositionCalculator (cohort)...')
+        if not self.check_inputs():
+            return None
+        checkpoint_file = output_file
+        if output_file.endswith('.parquet'):
+            # Check for a Parquet engine now rather than after all file pairs are done
+            if not self.has_parquet_engine():
+                logger.error('Writing .parquet requires pandas with pyarrow or fastparquet (pip install pyarrow)')
+                return None
+            checkpoint_file = output_file + '.csv'
+        output_dir = os.path.split(checkpoint_file)[0]
+        if output_dir != '':
+            os.makedirs(output_dir, exist_ok=True)
+        done = self.load_checkpoint(checkpoint_file)
+        file_pairs = [file_pair for file_pair in self.get_file_pairs() if file_pair[0] not in done]
+        logger.info(f'{len(done)} files already done, {len(file_pairs)} files remaining')
+        nr_errors = 0
+        write_header = not os.path.isfile(checkpoint_file) or os.path.getsize(checkpoint_file) == 0
+        with open(checkpoint_file, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['file'] + BodyCompositionCalculator.METRICS)
+            if write_header:
+                writer.writeheader()
+                f.flush()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {}
+                for file_pair in file_pairs:
+                    futures[executor.submit(self.calculate_metrics, file_pair[0], file_pair[1])] = file_pair[0]
+                for future in as_completed(futures):
+                    try:
+                        metrics = future.result()
+                    except Exception as e:
+                        logger.error(f'Could not calculate metrics for {futures[future]}: {e}')
+                        nr_errors += 1
+                        continue
+                    writer.writerow({'file': futures[future], **metrics})
+                    f.flush()
+        if nr_errors > 0:
+            logger.warning(f'{nr_errors} files failed, run again to retry them')
+        elif checkpoint_file != output_file:
+            import pandas as pd
+            pd.read_csv(checkpoint_file).to_parquet(output_file, index=False)
+        return output_file
+
 
 if __name__ == '__main__':
     def main():
@@ -1,12 +1,16 @@
 import os
-import h5py
 import argparse
 import numpy as np
-import matplotlib.pyplot as plt
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from barbell2.converters.dcm2npy import Dicom2Numpy
 from barbell2.converters.tag2npy import Tag2Numpy
-from barbell2.utils import update_labels, is_dicom_file
+from barbell2.bodycomp.dicomindex import DicomIndex
+from barbell2.utils import ALBERTA_LABEL_MAP
+
+# Nr. of images written between flushes of the file and its committed row count
+FLUSH_EVERY = 64
 
 
 def get_dcm_pixels(f):
@@ -34,38 +38,141 @@ def has_correct_labels(pixels):
     return False
 
 
+def validate_labels(pixels):
+    """ Checks labels against the Alberta protocol and removes labels 2, 12 and 14 with a single
+    np.bincount() and np.take() (see barbell2.utils.ALBERTA_LABEL_MAP). Returns tuple
+    (labels as uint8 or None, error message)
+    """
+    unexpected, missing = ALBERTA_LABEL_MAP.validate(pixels)
+    if len(unexpected) > 0:
+        return None, f'unknown labels {unexpected}'
+    if len(missing) > 0:
+        return None, f'missing labels {missing}'
+    return ALBERTA_LABEL_MAP.apply(pixels), None
+
+
+def load_pair(f_path, shape):
+    """ Loads DICOM image and its TAG labels. Runs in worker processes. Returns tuple
+    (DICOM file, TAG file, image, labels, error message)
+    """
+    f_tag = os.path.splitext(f_path)[0] + '.tag' if f_path.endswith('.dcm') else f_path + '.tag'
+    try:
+        tag_pixels = get_tag_pixels_for_dcm(f_path, shape)
+        if tag_pixels is None:
+            return f_path, None, None, None, 'could not find TAG file'
+        labels, error = validate_labels(tag_pixels)
+        if labels is None:
+            return f_path, f_tag, None, None, error
+        image = get_dcm_pixels(f_path).astype(np.float32)
+        if image.shape != tuple(shape):
+            return f_path, f_tag, None, None, f'image shape {image.shape} != {tuple(shape)}'
+        return f_path, f_tag, image, labels, None
+    except Exception as e:
+        return f_path, f_tag, None, None, str(e)
+
+
+def load_pairs(f_paths, shape, workers):
+    """ Loads DICOM/TAG pairs across a process pool and yields them in order. At most a few
+    pairs per worker are in flight so memory stays bounded
+    """
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        max_in_flight = 4 * workers
+        futures = deque()
+        for f_path in f_paths:
+            futures.append(executor.submit(load_pair, f_path, shape))
+            if len(futures) >= max_in_flight:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+
+
+def create_datasets(h5f, shape, compression):
+    import h5py
+    rows, cols = shape
+    options = {'chunks': (1, rows, cols), 'compression': 'gzip', 'compression_opts': compression, 'shuffle': True}
+    h5f.create_dataset('images', shape=(0, rows, cols), maxshape=(None, rows, cols), dtype='float32', **options)
+    h5f.create_dataset('labels', shape=(0, rows, cols), maxshape=(None, rows, cols), dtype='uint8', **options)
+    string_dtype = h5py.string_dtype()
+    h5f.create_dataset('metadata/dicom_file', shape=(0,), maxshape=(None,), dtype=string_dtype, chunks=True)
+    h5f.create_dataset('metadata/tag_file', shape=(0,), maxshape=(None,), dtype=string_dtype, chunks=True)
+    h5f.attrs['nr_written'] = 0
+
+
+def get_nr_written(h5f):
+    """ Returns nr. of committed rows. Datasets can be longer if a previous run was killed before
+    shrinking them, so rows beyond this count must be ignored. Files without the attribute were
+    written completely
+    """
+    return int(h5f.attrs.get('nr_written', h5f['images'].shape[0]))
+
+
+def commit_rows(h5f, count):
+    h5f.attrs['nr_written'] = count
+    h5f.flush()
+
+
+def resize_datasets(h5f, n):
+    for name in ['images', 'labels', 'metadata/dicom_file', 'metadata/tag_file']:
+        h5f[name].resize(n, axis=0)
+
+
 def main():
+    """ Builds HDF5 training set with datasets images[N, rows, cols] (float32, HU), labels[N, rows, cols]
+    (uint8) and metadata/dicom_file[N], metadata/tag_file[N]. Datasets are chunked per slice and
+    compressed. Decoding and label validation run in a process pool feeding a single writer.
+    Attribute nr_written holds the nr. of rows flushed to disk, so --append resumes correctly
+    after the process was killed.
+    """
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_dir', help='Input directory')
     parser.add_argument('--output_file', help='Output file', default='output.h5')
     parser.add_argument('--rows', help='Nr. of rows in images', type=int, default=512)
     parser.add_argument('--cols', help='Nr. of columns in images', type=int, default=512)
+    parser.add_argument('--workers', help='Nr. of worker processes', type=int, default=None)
+    parser.add_argument('--compression', help='Gzip compression level (0-9)', type=int, default=4)
+    parser.add_argument('--append', help='Append to existing output file', action='store_true')
     args = parser.parse_args()
-    with h5py.File(args.output_file, 'w') as h5f:
-        count = 1
-        for f in os.listdir(args.input_dir):
-            f_path = os.path.join(args.input_dir, f)
-            if is_dicom_file(f_path):
-                dcm_pixels = get_dcm_pixels(f_path)
-                tag_pixels = get_tag_pixels_for_dcm(f_path, (args.rows, args.cols))
-                if tag_pixels is None:
-                    print('Could not find TAG file for DICOM, skipping...')
+    import h5py
+    shape = (args.rows, args.cols)
+    f_paths = [str(f_path) for f_path in DicomIndex(args.input_dir).file_paths]
+    mode = 'a' if args.append and os.path.isfile(args.output_file) else 'w'
+    with h5py.File(args.output_file, mode) as h5f:
+        if 'images' not in h5f:
+            create_datasets(h5f, shape, args.compression)
+        if h5f['images'].shape[1:] != shape:
+            raise RuntimeError(f'Cannot append {shape} images to {args.output_file} with shape {h5f["images"].shape[1:]}')
+        start = get_nr_written(h5f)
+        count = start
+        # Skip files added by a previous run so re-running with --append does not duplicate slices
+        existing = set(os.path.abspath(f) for f in h5f['metadata/dicom_file'].asstr()[:start])
+        nr_files = len(f_paths)
+        f_paths = [f_path for f_path in f_paths if os.path.abspath(f_path) not in existing]
+        if len(f_paths) < nr_files:
+            print(f'Skipping {nr_files - len(f_paths)} files already in {args.output_file}')
+        # Preallocate for all input files and shrink to the actual number at the end
+        resize_datasets(h5f, start + len(f_paths))
+        try:
+            for f_path, f_tag, image, labels, error in load_pairs(f_paths, shape, args.workers):
+                if error is not None:
+                    print(f'Skipping {f_path}: {error}')
                     continue
-                if has_correct_labels(tag_pixels):
-                    tag_pixels = update_labels(tag_pixels)
-                    idd = ':04d'.format(count)
-                    group = h5f.create_group(idd)
-                    group.create_dataset('image', data=dcm_pixels)
-                    group.create_dataset('labels', data=tag_pixels)
-                    print(f'{idd}: added {f_path}')
-                    count += 1
-                else:
-                    # print(f'[ERROR] missing labels for {f_path}')
-                    pass
-    print(f'Created HDF5 based on {count} patients')
+                h5f['images'][count] = image
+                h5f['labels'][count] = labels
+                h5f['metadata/dicom_file'][count] = f_path
+                h5f['metadata/tag_file'][count] = f_tag
+                print(f'{count:04d}: added {f_path}')
+                count += 1
+                if (count - start) % FLUSH_EVERY == 0:
+                    commit_rows(h5f, count)
+        finally:
+            resize_datasets(h5f, count)
+            commit_rows(h5f, count)
+    print(f'Added {count - start} images to {args.output_file} ({count} in total)')
 
 
 def check_labels():
+    import matplotlib.pyplot as plt
     data_dir = '/Users/Ralph/data/scalpel/raw/gkroft-colorectal-t4-1'
     # data_dir = '/Users/Ralph/data/scalpel/raw/l3-cohorts-1/SURG-PANC'
     for f in os.listdir(data_dir):
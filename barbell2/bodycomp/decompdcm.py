@@ -1,11 +1,11 @@
 import os
 import shutil
-import pydicom
-import pydicom.errors
 import argparse
 
 
 def main():
+    import pydicom
+    import pydicom.errors
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_dir', help='Input directory', default='.')
     parser.add_argument('--output_dir', help='Output directory', default='output')
@@ -0,0 +1,225 @@
+import os
+import logging
+import pydicom
+import pydicom.errors
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class DicomIndex:
+    """ Header-only index of the DICOM files in a directory. Each header is parsed once (without
+    pixel data and restricted to the tags below) and the values are stored in NumPy arrays sorted
+    by z-position, so nearest-z and range queries are binary searches. The index can optionally
+    be persisted as a sidecar file that is invalidated when any file in the directory is added,
+    removed or changed (size or modification time).
+    """
+
+    TAGS = [
+        'ImagePositionPatient',
+        'InstanceNumber',
+        'SeriesInstanceUID',
+        'Rows',
+        'Columns',
+        'PixelSpacing',
+        'SliceThickness',
+    ]
+    SIDECAR_FILE_NAME = '.dicomindex.npz'
+    ARRAYS = [
+        'file_paths',
+        'z',
+        'instance_numbers',
+        'series_instance_uids',
+        'rows',
+        'columns',
+        'pixel_spacing',
+        'slice_thickness',
+        'transfer_syntax_uids',
+    ]
+
+    def __init__(self, directory, extra_tags=None, keep_headers=False, sidecar_file=None):
+        """ Builds index for given directory
+        :param directory DICOM directory
+        :param extra_tags Additional tags to read (only available through headers)
+        :param keep_headers Keep parsed (pixel-less) headers in self.headers
+        :param sidecar_file Path of sidecar file or True for <directory>/.dicomindex.npz
+        """
+        self.directory = directory
+        self.extra_tags = extra_tags
+        self.keep_headers = keep_headers
+        self.sidecar_file = sidecar_file
+        if self.sidecar_file is True:
+            self.sidecar_file = os.path.join(self.directory, DicomIndex.SIDECAR_FILE_NAME)
+        self.file_paths = None
+        self.z = None
+        self.instance_numbers = None
+        self.series_instance_uids = None
+        self.rows = None
+        self.columns = None
+        self.pixel_spacing = None
+        self.slice_thickness = None
+        self.transfer_syntax_uids = None
+        self.headers = None
+        self.nr_valid_z = 0
+        self.signature = self.get_directory_signature()
+        if not self.use_sidecar() or not self.load():
+            self.build()
+            if self.use_sidecar():
+                self.save()
+
+    def __len__(self):
+        return len(self.file_paths)
+
+    def use_sidecar(self):
+        # Sidecar only holds the standard arrays, not extra tags or full headers
+        return self.sidecar_file is not None and not self.extra_tags and not self.keep_headers
+
+    def get_directory_signature(self):
+        names, sizes, mtimes = [], [], []
+        for f in sorted(os.listdir(self.directory)):
+            if f == DicomIndex.SIDECAR_FILE_NAME:
+                continue
+            f_path = os.path.join(self.directory, f)
+            if not os.path.isfile(f_path):
+                continue
+            stat = os.stat(f_path)
+            names.append(f)
+            sizes.append(stat.st_size)
+            mtimes.append(stat.st_mtime_ns)
+        return np.array(names, dtype=str), np.array(sizes, dtype=np.int64), np.array(mtimes, dtype=np.int64)
+
+    @staticmethod
+    def get_value(p, keyword, default):
+        value = p.get(keyword, None)
+        if value is None or value == '':
+            return default
+        return value
+
+    def build(self):
+        tags = list(DicomIndex.TAGS)
+        if self.extra_tags:
+            tags.extend([tag for tag in self.extra_tags if tag not in tags])
+        items = []
+        for f in self.signature[0]:
+            f_path = os.path.join(self.directory, f)
+            try:
+                p = pydicom.dcmread(f_path, stop_before_pixels=True, specific_tags=tags)
+            except pydicom.errors.InvalidDicomError:
+                continue
+            position = self.get_value(p, 'ImagePositionPatient', None)
+            pixel_spacing = self.get_value(p, 'PixelSpacing', None)
+            items.append((
+                f_path,
+                float(position[2]) if position is not None else np.nan,
+                int(self.get_value(p, 'InstanceNumber', -1)),
+                str(self.get_value(p, 'SeriesInstanceUID', '')),
+                int(self.get_value(p, 'Rows', 0)),
+                int(self.get_value(p, 'Columns', 0)),
+                [float(x) for x in pixel_spacing] if pixel_spacing is not None else [np.nan, np.nan],
+                float(self.get_value(p, 'SliceThickness', np.nan)),
+                str(p.file_meta.get('TransferSyntaxUID', '')),
+                p if self.keep_headers else None,
+            ))
+        # NaN z-positions (no ImagePositionPatient) are sorted to the end
+        z = np.array([item[1] for item in items], dtype=np.float64)
+        order = np.argsort(z, kind='stable')
+        items = [items[i] for i in order]
+        self.file_paths = np.array([item[0] for item in items], dtype=str)
+        self.z = z[order]
+        self.instance_numbers = np.array([item[2] for item in items], dtype=np.int64)
+        self.series_instance_uids = np.array([item[3] for item in items], dtype=str)
+        self.rows = np.array([item[4] for item in items], dtype=np.int64)
+        self.columns = np.array([item[5] for item in items], dtype=np.int64)
+        self.pixel_spacing = np.array([item[6] for item in items], dtype=np.float64).reshape(-1, 2)
+        self.slice_thickness = np.array([item[7] for item in items], dtype=np.float64)
+        self.transfer_syntax_uids = np.array([item[8] for item in items], dtype=str)
+        if self.keep_headers:
+            self.headers = [item[9] for item in items]
+        self.nr_valid_z = int(np.count_nonzero(np.isfinite(self.z)))
+
+    def load(self):
+        if not os.path.isfile(self.sidecar_file):
+            return False
+        try:
+            with np.load(self.sidecar_file, allow_pickle=False) as data:
+                for i, name in enumerate(['signature_names', 'signature_sizes', 'signature_mtimes']):
+                    if not np.array_equal(data[name], self.signature[i]):
+                        logger.info(f'DICOM index {self.sidecar_file} out of date, rebuilding')
+                        return False
+                for name in DicomIndex.ARRAYS:
+                    setattr(self, name, data[name])
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(f'Could not load DICOM index {self.sidecar_file} ({e}), rebuilding')
+            return False
+        # Stored paths are relative to the directory so the directory can be moved
+        self.file_paths = np.array([os.path.join(self.directory, f) for f in self.file_paths], dtype=str)
+        self.nr_valid_z = int(np.count_nonzero(np.isfinite(self.z)))
+        return True
+
+    def save(self):
+        arrays = {name: getattr(self, name) for name in DicomIndex.ARRAYS}
+        arrays['file_paths'] = np.array([os.path.split(f)[1] for f in self.file_paths], dtype=str)
+        try:
+            # Write to temporary file first so readers never see a partial index
+            tmp_file = self.sidecar_file + '.tmp.npz'
+            np.savez(
+                tmp_file,
+                signature_names=self.signature[0],
+                signature_sizes=self.signature[1],
+                signature_mtimes=self.signature[2],
+                **arrays,
+            )
+            os.replace(tmp_file, self.sidecar_file)
+        except OSError as e:
+            logger.warning(f'Could not save DICOM index {self.sidecar_file} ({e})')
+
+    @staticmethod
+    def get_nearest_idx_in(z_sorted, z):
+        i = int(np.searchsorted(z_sorted, z))
+        if i == 0:
+            return 0
+        if i == len(z_sorted):
+            return i - 1
+        return i - 1 if abs(z_sorted[i - 1] - z) <= abs(z_sorted[i] - z) else i
+
+    def get_nearest_idx(self, z):
+        """ Returns index of file nearest to given z-position (or -1 if there are no positions)
+        :param z Z-position in patient coordinates
+        """
+        if self.nr_valid_z == 0:
+            return -1
+        return self.get_nearest_idx_in(self.z[:self.nr_valid_z], z)
+
+    def get_nearest(self, z):
+        i = self.get_nearest_idx(z)
+        if i < 0:
+            return None
+        return str(self.file_paths[i])
+
+    def get_between(self, z_min, z_max, series_instance_uid=None):
+        """ Returns one file per z-position between the files nearest to z_min and z_max (inclusive),
+        sorted by z. If several files share a z-position (e.g., multiple series in the directory),
+        the last one in file name order is returned, like the original SliceSelector did
+        :param z_min Minimum z-position
+        :param z_max Maximum z-position
+        :param series_instance_uid Only consider files of this series
+        """
+        idx = np.arange(self.nr_valid_z)
+        if series_instance_uid is not None:
+            idx = idx[self.series_instance_uids[:self.nr_valid_z] == series_instance_uid]
+        if len(idx) == 0:
+            return []
+        z_valid = self.z[idx]
+        i_min, i_max = self.get_nearest_idx_in(z_valid, z_min), self.get_nearest_idx_in(z_valid, z_max)
+        i_start = np.searchsorted(z_valid, z_valid[i_min], side='left')
+        i_end = np.searchsorted(z_valid, z_valid[i_max], side='right')
+        idx, z_valid = idx[i_start:i_end], z_valid[i_start:i_end]
+        # Files are sorted by z (stable, so by file name within equal z); keep last of each run
+        is_last = np.append(z_valid[1:] != z_valid[:-1], True)
+        return [str(f) for f in self.file_paths[idx[is_last]]]
+
+    def get_at_instance_number(self, instance_number):
+        idx = np.nonzero(self.instance_numbers == int(instance_number))[0]
+        if len(idx) == 0:
+            return None
+        return str(self.file_paths[idx[0]])
@@ -1,10 +1,9 @@
 import os
 import shutil
-import pydicom
-import pydicom.errors
 import argparse
 
 from barbell2.utils import get_tag_file_for_dicom
+from barbell2.bodycomp.dicomindex import DicomIndex
 
 
 def get_variable_operator_value(vc):
@@ -69,26 +68,26 @@ def main():
     args = parser.parse_args()
     os.makedirs(args.output_dir)
     errors = []
-    for f in os.listdir(args.input_dir):
-        f_path = os.path.join(args.input_dir, f)
-        f_path_new = os.path.join(args.output_dir, f)
-        try:
-            p = pydicom.dcmread(f_path, stop_before_pixels=True)
-            result, msg = dicom_ok(p, args)
-            if result:
-                # Copy DICOM and TAG file to output directory
-                shutil.copy(f_path, f_path_new)
-                tag_file = get_tag_file_for_dicom(f_path)
-                if os.path.isfile(tag_file):
-                    tag_name = os.path.split(tag_file)[1]
-                    shutil.copy(tag_file, os.path.join(args.output_dir, tag_name))
-                    print(f'{f_path}|*.tag')
-                else:
-                    print(f'{f_path}')
+    # Only read the tags we need to check
+    tags = [x.strip() for x in args.attributes.split(',')]
+    tags.extend([get_variable_operator_value(x.strip())[0] for x in args.values.split(',')])
+    index = DicomIndex(args.input_dir, extra_tags=tags, keep_headers=True)
+    for f_path, p in zip(index.file_paths, index.headers):
+        f_path = str(f_path)
+        f_path_new = os.path.join(args.output_dir, os.path.split(f_path)[1])
+        result, msg = dicom_ok(p, args)
+        if result:
+            # Copy DICOM and TAG file to output directory
+            shutil.copy(f_path, f_path_new)
+            tag_file = get_tag_file_for_dicom(f_path)
+            if tag_file is not None and os.path.isfile(tag_file):
+                tag_name = os.path.split(tag_file)[1]
+                shutil.copy(tag_file, os.path.join(args.output_dir, tag_name))
+                print(f'{f_path}|*.tag')
             else:
-                errors.append(f'{f_path}: {msg}')
-        except pydicom.errors.InvalidDicomError:
-            pass
+                print(f'{f_path}')
+        else:
+            errors.append(f'{f_path}: {msg}')
     if len(errors) > 0:
         with open(os.path.join(args.output_dir, 'errors.txt'), 'w') as f:
             for error in errors:
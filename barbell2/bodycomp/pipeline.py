@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineStage:
+    """ Node in the pipeline DAG. The stage function receives the patient's context dictionary
+    and an overwrite flag, and returns a dictionary with (at least) the declared outputs. The
+    overwrite flag is True if the pipeline runs with overwrite = True or if the stage ran before
+    with different inputs, so that stale outputs get replaced. Inputs are context keys that
+    are produced by other stages or are available from the start (patient, dicom_directory and
+    output_directory). At most max_workers patients run this stage at the same time
+    """
+    def __init__(self, name, inputs, outputs, func, max_workers=1, params=None):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.func = func
+        self.max_workers = max_workers
+        self.params = params            # Stage settings that are part of the stage hash
+        self.semaphore = None
+
+
+class Pipeline:
+
+    CONTEXT_KEYS = ['patient', 'dicom_directory', 'output_directory']
+    STATE_FILE_NAME = 'pipeline.json'
+
+    def __init__(self):
+        self.input_directories = None       # Patient DICOM directories
+        self.output_directory = None        # Each patient gets subdirectory <output_directory>/<patient>
+        self.max_workers = 4                # Max. nr. of patients processed in parallel
+        self.overwrite = False              # Re-run stages even if their inputs did not change
+        self.stages = []
+        self.timings = None                 # List of (patient, stage, seconds, skipped) tuples
+        self.output = None                  # Dictionary with final context for each patient
+        self.lock = threading.Lock()
+
+    def add_stage(self, stage):
+        self.stages.append(stage)
+
+    def get_sorted_stages(self):
+        """ Returns stages in topological order based on their inputs and outputs
+        """
+        available = set(Pipeline.CONTEXT_KEYS)
+        remaining = list(self.stages)
+        stages = []
+        while len(remaining) > 0:
+            ready = [stage for stage in remaining if all([x in available for x in stage.inputs])]
+            if len(ready) == 0:
+                names = [stage.name for stage in remaining]
+                raise RuntimeError(f'Stages {names} have inputs that no stage produces (or a cycle)')
+            for stage in ready:
+                stages.append(stage)
+                available.update(stage.outputs)
+                remaining.remove(stage)
+        return stages
+
+    @staticmethod
+    def update_hash(h, value):
+        if isinstance(value, (list, tuple)):
+            for x in value:
+                Pipeline.update_hash(h, x)
+        elif isinstance(value, dict):
+            for k in sorted(value.keys()):
+                h.update(str(k).encode())
+                Pipeline.update_hash(h, value[k])
+        elif isinstance(value, str) and os.path.isfile(value):
+            stat = os.stat(value)
+            h.update(f'{value}|{stat.st_size}|{stat.st_mtime_ns}'.encode())
+        elif isinstance(value, str) and os.path.isdir(value):
+            for root, dirs, files in os.walk(value):
+                dirs.sort()
+                for f in sorted(files):
+                    Pipeline.update_hash(h, os.path.join(root, f))
+        else:
+            h.update(repr(value).encode())
+
+    def get_stage_hash(self, stage, context):
+        """ Hash of the stage's inputs (file paths, sizes and modification times) and parameters
+        """
+        h = hashlib.sha256()
+        h.update(stage.name.encode())
+        Pipeline.update_hash(h, stage.params)
+        for x in stage.inputs:
+            Pipeline.update_hash(h, context[x])
+        return h.hexdigest()
+
+    @staticmethod
+    def outputs_exist(outputs):
+        for value in outputs.values():
+            values = value if isinstance(value, list) else [value]
+            for x in values:
+                if isinstance(x, str) and os.path.isabs(x) and not os.path.exists(x):
+                    return False
+        return True
+
+    def load_state(self, patient_output_directory):
+        state_file = os.path.join(patient_output_directory, Pipeline.STATE_FILE_NAME)
+        if not os.path.isfile(state_file):
+            return {}
+        try:
+            with open(state_file, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning(f'Could not read {state_file}, running all stages')
+            return {}
+
+    def save_state(self, patient_output_directory, state):
+        state_file = os.path.join(patient_output_directory, Pipeline.STATE_FILE_NAME)
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(state, f, indent=4)
+        os.replace(state_file + '.tmp', state_file)
+
+    def add_timing(self, patient, stage, seconds, skipped):
+        with self.lock:
+            self.timings.append((patient, stage, seconds, skipped))
+
+    def run_patient(self, dicom_directory, stages):
+        patient = os.path.split(os.path.normpath(dicom_directory))[1]
+        patient_output_directory = os.path.abspath(os.path.join(self.output_directory, patient))
+        os.makedirs(patient_output_directory, exist_ok=True)
+        context = {
+            'patient': patient,
+            'dicom_directory': os.path.abspath(dicom_directory),
+            'output_directory': patient_output_directory,
+        }
+        state = self.load_state(patient_output_directory)
+        for stage in stages:
+            stage_hash = self.get_stage_hash(stage, context)
+            stage_state = state.get(stage.name, {})
+            if not self.overwrite and stage_state.get('hash') == stage_hash and self.outputs_exist(stage_state['outputs']):
+                logger.info(f'{patient}: skipping {stage.name}, inputs did not change')
+                context.update(stage_state['outputs'])
+                self.add_timing(patient, stage.name, 0.0, True)
+                continue
+            with stage.semaphore:
+                logger.info(f'{patient}: running {stage.name}...')
+                start = time.time()
+                try:
+                    outputs = stage.func(context, self.overwrite or stage.name in state)
+                except Exception as e:
+                    logger.error(f'{patient}: stage {stage.name} failed ({e})')
+                    outputs = None
+                seconds = time.time() - start
+            self.add_timing(patient, stage.name, seconds, False)
+            if outputs is None or not all([x in outputs.keys() and outputs[x] is not None for x in stage.outputs]):
+                logger.error(f'{patient}: stage {stage.name} did not produce outputs {stage.outputs}, stopping')
+                return patient, None
+            outputs = {x: outputs[x] for x in stage.outputs}
+            context.update(outputs)
+            state[stage.name] = {'hash': stage_hash, 'outputs': outputs, 'seconds': seconds}
+            self.save_state(patient_output_directory, state)
+            logger.info(f'{patient}: {stage.name} took {seconds:.1f} seconds')
+        return patient, context
+
+    def log_timings(self):
+        for stage in self.get_sorted_stages():
+            seconds = [x[2] for x in self.timings if x[1] == stage.name and not x[3]]
+            nr_skipped = len([x for x in self.timings if x[1] == stage.name and x[3]])
+            if len(seconds) > 0:
+                logger.info(
+                    f'{stage.name}: {len(seconds)} runs, {nr_skipped} skipped, total {sum(seconds):.1f} s, '
+                    f'mean {sum(seconds) / len(seconds):.1f} s, max {max(seconds):.1f} s')
+            else:
+                logger.info(f'{stage.name}: 0 runs, {nr_skipped} skipped')
+
+    def execute(self):
+        logger.info('Running Pipeline...')
+        if self.input_directories is None:
+            logger.error('Input directories not specified')
+            return None
+        if self.output_directory is None:
+            logger.error('Output directory not specified')
+            return None
+        stages = self.get_sorted_stages()
+        for stage in stages:
+            stage.semaphore = threading.BoundedSemaphore(stage.max_workers)
+        self.timings = []
+        self.output = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.run_patient, d, stages) for d in self.input_directories]
+            for future in futures:
+                patient, context = future.result()
+                self.output[patient] = context
+        self.log_timings()
+        return self.output
+
+
+class BodyCompositionPipeline(Pipeline):
+    """ Runs DicomToNifti -> TotalSegmentator -> RoiSelector -> SliceSelector ->
+    MuscleFatSegmentator -> BodyCompositionCalculator for each patient DICOM directory
+    """
+    def __init__(self):
+        super(BodyCompositionPipeline, self).__init__()
+        from barbell2.bodycomp.selectroi import RoiSelector
+        from barbell2.bodycomp.selectslice import SliceSelector
+        self.roi = RoiSelector.VERTEBRAE_L3
+        self.slice_mode = SliceSelector.MEDIAN
+        self.fast = False                   # TotalSegmentator --fast
+        self.model_files = None             # Model files for MuscleFatSegmentator
+        self.image_dimensions = (512, 512)
+        self.max_workers_io = 4             # Max. nr. of patients in I/O-bound stages (conversion, selection, etc.)
+        self.max_workers_totalsegmentator = 1
+        self.max_workers_segmentator = 1
+
+    def run_dicom2nifti(self, context, overwrite):
+        from barbell2.converters.dcm2nifti import DicomToNifti
+        converter = DicomToNifti()
+        converter.input_directory = context['dicom_directory']
+        converter.output_file = os.path.join(context['output_directory'], 'volume.nii.gz')
+        converter.overwrite = overwrite
+        return {'nifti_file': converter.execute()}
+
+    def run_totalsegmentator(self, context, overwrite):
+        from barbell2.bodycomp.totalseg import TotalSegmentator
+        segmentator = TotalSegmentator()
+        segmentator.input_file = context['nifti_file']
+        segmentator.output_directory = os.path.join(context['output_directory'], 'totalsegmentator')
+        segmentator.fast = self.fast
+        segmentator.overwrite = overwrite
+        os.makedirs(segmentator.output_directory, exist_ok=True)
+        return {'totalsegmentator_directory': segmentator.execute()}
+
+    def run_roiselector(self, context, overwrite):
+        from barbell2.bodycomp.selectroi import RoiSelector
+        selector = RoiSelector()
+        selector.input_directory = context['totalsegmentator_directory']
+        selector.roi = self.roi
+        selector.output_directory = os.path.join(context['output_directory'], 'roi')
+        selector.overwrite = overwrite
+        return {'roi_file': selector.execute()}
+
+    def run_sliceselector(self, context, overwrite):
+        from barbell2.bodycomp.selectslice import SliceSelector
+        selector = SliceSelector()
+        selector.input_roi = context['roi_file']
+        selector.input_volume = context['nifti_file']
+        selector.input_dicom_directory = context['dicom_directory']
+        selector.mode = self.slice_mode
+        return {'slice_files': selector.execute()}
+
+    def run_segmentator(self, context, overwrite):
+        from barbell2.bodycomp.seg import MuscleFatSegmentator
+        segmentator = MuscleFatSegmentator()
+        segmentator.input_files = context['slice_files']
+        segmentator.image_dimensions = self.image_dimensions
+        segmentator.model_files = self.model_files
+        segmentator.output_directory = os.path.join(context['output_directory'], 'segmentations')
+        return {'segmentation_files': segmentator.execute()}
+
+    def run_calculator(self, context, overwrite):
+        from barbell2.bodycomp.calculator import BodyCompositionCalculator
+        calculator = BodyCompositionCalculator()
+        calculator.input_files = context['slice_files']
+        calculator.input_segmentation_files = context['segmentation_files']
+        return {'metrics': calculator.execute()}
+
+    def execute(self):
+        self.stages = [
+            PipelineStage(
+                'dicom2nifti', ['dicom_directory'], ['nifti_file'],
+                self.run_dicom2nifti, self.max_workers_io),
+            PipelineStage(
+                'totalsegmentator', ['nifti_file'], ['totalsegmentator_directory'],
+                self.run_totalsegmentator, self.max_workers_totalsegmentator, {'fast': self.fast}),
+            PipelineStage(
+                'roiselector', ['totalsegmentator_directory'], ['roi_file'],
+                self.run_roiselector, self.max_workers_io, {'roi': self.roi}),
+            PipelineStage(
+                'sliceselector', ['roi_file', 'nifti_file', 'dicom_directory'], ['slice_files'],
+                self.run_sliceselector, self.max_workers_io, {'mode': self.slice_mode}),
+            PipelineStage(
+                'segmentator', ['slice_files'], ['segmentation_files'],
+                self.run_segmentator, self.max_workers_segmentator, {'model_files': self.model_files}),
+            PipelineStage(
+                'calculator', ['slice_files', 'segmentation_files'], ['metrics'],
+                self.run_calculator, self.max_workers_io),
+        ]
+        if self.model_files is None:
+            logger.error('Model files not specified')
+            return None
+        return super(BodyCompositionPipeline, self).execute()
@@ -1,19 +1,89 @@
 import os
 import json
+import shutil
+import hashlib
 import zipfile
 import logging
+import tempfile
+import threading
 import pydicom
 import numpy as np
 
-from barbell2.utils import is_dicom_file, get_pixels
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from barbell2.utils import is_dicom_file, get_pixels, iter_prefetched, LabelMap
 
 logger = logging.getLogger(__name__)
 
 
+class ModelCache:
+    """ Extracts each model archive once into a directory named after the SHA-256 of the archive
+    and keeps the most recently used models loaded in memory, so repeated calls to execute() in
+    the same process do not reload them
+    """
+    def __init__(self, cache_directory='/tmp/barbell2/bodycomp/models', max_size=4):
+        self.cache_directory = cache_directory
+        self.max_size = max_size
+        self.models = OrderedDict()
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    def get_hash(self, file_path):
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            h = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(block)
+            self.hashes[key] = h.hexdigest()
+        return self.hashes[key]
+
+    def extract(self, file_path):
+        model_directory = os.path.join(self.cache_directory, self.get_hash(file_path))
+        if os.path.isdir(model_directory):
+            return model_directory
+        os.makedirs(self.cache_directory, exist_ok=True)
+        # Extract to temporary directory first so other processes never see a partial model
+        tmp_directory = tempfile.mkdtemp(dir=self.cache_directory)
+        with zipfile.ZipFile(file_path) as zip_obj:
+            zip_obj.extractall(path=tmp_directory)
+        try:
+            os.rename(tmp_directory, model_directory)
+        except OSError:
+            # Another process extracted the same archive in the meantime
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+        return model_directory
+
+    def load(self, file_path):
+        import tensorflow as tf
+        with self.lock:
+            key = self.get_hash(file_path)
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            model_directory = self.extract(file_path)
+            logger.info(f'Loading model {file_path} from {model_directory}')
+            model = tf.keras.models.load_model(model_directory, compile=False)
+            self.models[key] = model
+            while len(self.models) > self.max_size:
+                self.models.popitem(last=False)
+            return model
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+
+model_cache = ModelCache()
+
+
 class MuscleFatSegmentator:
 
     ARGMAX = 0
     PROBABILITIES = 1
+    # Model predicts 0 (background), 1 (muscle), 2 (VAT) and 3 (SAT), which map to Alberta labels 0, 1, 5 and 7
+    LABEL_MAP_157 = LabelMap({1: 1, 2: 5, 3: 7}, valid_labels=[0, 1, 2, 3])
 
     def __init__(self):
         self.input_files = None
@@ -22,15 +92,13 @@ class MuscleFatSegmentator:
         self.mode = MuscleFatSegmentator.ARGMAX
         self.output_directory = None
         self.output_segmentation_files = None
+        self.batch_size = 8                 # Nr. of images per predict() call
+        self.nr_loader_threads = 4          # Nr. of threads decoding and normalizing DICOM images
+        self.queue_size = 32                # Max. nr. of images decoded ahead of inference
 
     @staticmethod
     def load_model(file_path):
-        import tensorflow as tf
-        model_directory = '/tmp/barbell2/bodycomp/seg.py'
-        os.makedirs(model_directory, exist_ok=True)
-        with zipfile.ZipFile(file_path) as zip_obj:
-            zip_obj.extractall(path=model_directory)
-        return tf.keras.models.load_model(model_directory, compile=False)
+        return model_cache.load(file_path)
 
     @staticmethod
     def load_params(file_path):
@@ -61,24 +129,55 @@ class MuscleFatSegmentator:
         img = np.divide(c, d, np.zeros_like(c), where=d != 0)
         return img
 
-    def predict_contour(self, contour_model, src_img, params):
-        ct = np.copy(src_img)
-        ct = self.normalize(ct, params['min_bound_contour'], params['max_bound_contour'])
-        img2 = np.expand_dims(ct, 0)
-        img2 = np.expand_dims(img2, -1)
-        pred = contour_model.predict([img2])
-        pred_squeeze = np.squeeze(pred)
-        pred_max = pred_squeeze.argmax(axis=-1)
-        mask = np.uint8(pred_max)
-        return mask
-
     @staticmethod
     def convert_labels_to_157(prediction):
-        new_prediction = np.copy(prediction)
-        new_prediction[new_prediction == 1] = 1
-        new_prediction[new_prediction == 2] = 5
-        new_prediction[new_prediction == 3] = 7
-        return new_prediction
+        return MuscleFatSegmentator.LABEL_MAP_157.apply(prediction)
+
+    def load_image(self, f, params, use_contour_model):
+        """ Loads and normalizes DICOM image. Returns tuple (f, img, img_contour) where img_contour
+        is the image normalized for the contour model (or None if there is no contour model)
+        """
+        if not is_dicom_file(f):
+            logger.warning(f'File {f} is not a valid DICOM file')
+            return f, None, None
+        p = pydicom.dcmread(f)
+        img1 = get_pixels(p, normalize=True)
+        img_contour = None
+        if use_contour_model:
+            img_contour = self.normalize(np.copy(img1), params['min_bound_contour'], params['max_bound_contour'])
+        img1 = self.normalize(img1, params['min_bound'], params['max_bound'])
+        return f, img1, img_contour
+
+    def load_images(self, params, use_contour_model):
+        """ Generator that loads and normalizes input images on a background thread pool. At most
+        queue_size images are decoded ahead of the consumer. Images are returned in input order
+        """
+        with ThreadPoolExecutor(max_workers=self.nr_loader_threads) as executor:
+            futures = (executor.submit(self.load_image, f, params, use_contour_model) for f in self.input_files)
+            for future in iter_prefetched(futures, self.queue_size):
+                yield future.result()
+
+    def load_batches(self, params, use_contour_model):
+        batch = []
+        for f, img, img_contour in self.load_images(params, use_contour_model):
+            if img is None:
+                continue
+            batch.append((f, img, img_contour))
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def predict_batch(self, model, contour_model, batch):
+        imgs = np.stack([item[1] for item in batch])
+        if contour_model is not None:
+            imgs_contour = np.stack([item[2] for item in batch])
+            pred = contour_model.predict(imgs_contour[..., np.newaxis], batch_size=len(batch))
+            masks = np.uint8(pred.argmax(axis=-1))
+            imgs = imgs * masks
+        imgs = imgs.astype(np.float32)
+        return model.predict(imgs[..., np.newaxis], batch_size=len(batch))
 
     def execute(self):
         logger.info('Running MuscleFatSegmentator...')
@@ -97,23 +196,11 @@ class MuscleFatSegmentator:
         os.makedirs(self.output_directory, exist_ok=True)
         model, contour_model, params = self.load_model_files()
         self.output_segmentation_files = []
-        for f in self.input_files:
-            f_name = os.path.split(f)[1]
-            if is_dicom_file(f):
-                p = pydicom.dcmread(f)
-                img1 = get_pixels(p, normalize=True)
-                if contour_model is not None:
-                    mask = self.predict_contour(contour_model, img1, params)
-                    img1 = self.normalize(img1, params['min_bound'], params['max_bound'])
-                    img1 = img1 * mask
-                else:
-                    img1 = self.normalize(img1, params['min_bound'], params['max_bound'])
-                img1 = img1.astype(np.float32)
-                img2 = np.expand_dims(img1, 0)
-                img2 = np.expand_dims(img2, -1)
-                pred = model.predict([img2])
-                pred_squeeze = np.squeeze(pred)
-                print(pred_squeeze[256][256])
+        for batch in self.load_batches(params, contour_model is not None):
+            pred = self.predict_batch(model, contour_model, batch)
+            for i in range(len(batch)):
+                f_name = os.path.split(batch[i][0])[1]
+                pred_squeeze = np.squeeze(pred[i])
                 if self.mode == MuscleFatSegmentator.ARGMAX:
                     pred_max = pred_squeeze.argmax(axis=-1)
                     pred_max = self.convert_labels_to_157(pred_max)
@@ -125,9 +212,7 @@ class MuscleFatSegmentator:
                     self.output_segmentation_files.append(segmentation_file)
                     np.save(segmentation_file, pred_squeeze)
                 else:
-                    logger.warn(f'Unknown mode {self.mode}')
-            else:
-                logger.warning(f'File {f} is not a valid DICOM file')
+                    logger.warning(f'Unknown mode {self.mode}')
         return self.output_segmentation_files
 
 
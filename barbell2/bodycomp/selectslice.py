@@ -1,9 +1,10 @@
 import os
 import logging
 import pydicom
-import nibabel
 import numpy as np
 
+from barbell2.bodycomp.dicomindex import DicomIndex
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,7 +21,10 @@ class SliceSelector:
         self.input_volume = None
         self.input_dicom_directory = None
         self.mode = None
+        self.series_instance_uid = None     # Optional series to select from if directory has several
         self.output_files = None
+        self.dicom_index = None
+        self.roi_coverage = None            # Nr. of ROI voxels in each axial slice of the ROI
 
     @staticmethod
     def has_duplicate_objects(roi):
@@ -28,22 +32,30 @@ class SliceSelector:
         return False
 
     @staticmethod
-    def get_min_max_slice_idx(roi):
-        roi_data = roi.get_fdata()
-        nr_slices = roi_data.shape[2]
-        i_min = -1
-        for i in range(nr_slices):
-            slice = roi_data[:,:,i]
-            if 1 in np.unique(slice):
-                i_min = i
-                break
-        i_max = -1
-        for i in range(nr_slices):
-            slice = roi_data[:,:,nr_slices-i-1]
-            if 1 in np.unique(slice):
-                i_max = nr_slices - i
-                break
-        return i_min, i_max
+    def get_slice_coverage(roi, label=1, nr_slices_per_chunk=64):
+        """ Returns the number of ROI voxels (value == label) in each axial slice. The ROI is read
+        through nibabel's array proxy in its native data type, one chunk of slices at a time, so
+        the full volume is never expanded to float64. For .nii.gz files, load the ROI with
+        keep_file_open=True, otherwise every chunk decompresses the file from the start
+        :param roi NIFTI image
+        :param label Label value of the ROI
+        :param nr_slices_per_chunk Number of axial slices to read at once
+        """
+        nr_slices = roi.shape[2]
+        coverage = np.zeros(nr_slices, dtype=np.int64)
+        for i in range(0, nr_slices, nr_slices_per_chunk):
+            chunk = np.asanyarray(roi.dataobj[:, :, i:i + nr_slices_per_chunk])
+            coverage[i:i + chunk.shape[2]] = np.count_nonzero(chunk == label, axis=(0, 1))
+        return coverage
+
+    @staticmethod
+    def get_min_max_slice_idx(roi, coverage=None):
+        if coverage is None:
+            coverage = SliceSelector.get_slice_coverage(roi)
+        idx = np.flatnonzero(coverage)
+        if len(idx) == 0:
+            return -1, -1
+        return int(idx[0]), int(idx[-1]) + 1
 
     @staticmethod
     def get_z_coord_patient_position(i, volume):
@@ -61,19 +73,14 @@ class SliceSelector:
         p = pydicom.dcmread(file_path, stop_before_pixels=True)
         return p.ImagePositionPatient[2]
 
+    def get_dicom_index(self, dicom_directory):
+        # Headers are only read once per directory, however many positions are requested
+        if self.dicom_index is None or self.dicom_index.directory != dicom_directory:
+            self.dicom_index = DicomIndex(dicom_directory)
+        return self.dicom_index
+
     def get_dicom_images_between(self, z_min, z_max, dicom_directory):
-        z_coords = {}
-        for f in os.listdir(dicom_directory):
-            f_path = os.path.join(dicom_directory, f)
-            z = self.get_dicom_z(f_path)
-            z_coords[z] = f_path
-        z_min_nearest = min(list(z_coords.keys()), key=lambda x:abs(x - z_min))
-        z_max_nearest = min(list(z_coords.keys()), key=lambda x:abs(x - z_max))
-        file_paths = []
-        for z in z_coords.keys():
-            if z_min_nearest <= z <= z_max_nearest:
-                file_paths.append(z_coords[z])
-        return file_paths
+        return self.get_dicom_index(dicom_directory).get_between(z_min, z_max, self.series_instance_uid)
 
     def execute(self):
         logger.info('Running SliceSelector...')
@@ -89,12 +96,17 @@ class SliceSelector:
         if self.mode is None:
             logger.error('Mode not specified')
             return None
-        roi = nibabel.load(self.input_roi)
+        import nibabel
+        # ROI and volume can also be nibabel images, e.g., from in-process DicomToNifti
+        # Keep the (gzipped) ROI file open so chunks are read in one pass instead of each chunk
+        # decompressing the file from the start again
+        roi = nibabel.load(self.input_roi, keep_file_open=True) if isinstance(self.input_roi, str) else self.input_roi
         if self.has_duplicate_objects(roi):
             logger.error('ROI has duplicate objects')
             return None
-        i_min, i_max = self.get_min_max_slice_idx(roi)
-        volume = nibabel.load(self.input_volume)
+        self.roi_coverage = self.get_slice_coverage(roi)
+        i_min, i_max = self.get_min_max_slice_idx(roi, self.roi_coverage)
+        volume = nibabel.load(self.input_volume) if isinstance(self.input_volume, str) else self.input_volume
         z_min, z_max = self.get_min_max_z_coord_patient_position(i_min, i_max, volume)
         self.output_files = []
         if self.mode == SliceSelector.ALL or self.mode == SliceSelector.TOP or self.mode == SliceSelector.BOTTOM:
@@ -124,12 +136,7 @@ class SliceSelector:
         return self.output_files
 
     def get_dicom_image_at_instance_number(self, instance_number):
-        for f in os.listdir(self.input_dicom_directory):
-            f_path = os.path.join(self.input_dicom_directory, f)
-            p = pydicom.dcmread(f_path, stop_before_pixels=True)
-            if p.InstanceNumber == instance_number:
-                return f_path
-        return None
+        return self.get_dicom_index(self.input_dicom_directory).get_at_instance_number(instance_number)
 
 
 if __name__ == '__main__':
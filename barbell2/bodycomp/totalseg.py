@@ -1,9 +1,24 @@
 import os
-import subprocess
+import sys
+import time
+import shlex
+import signal
 import logging
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+# Runs in the child: sets the memory limit and then replaces itself with the actual command, so
+# the limit is in place before TotalSegmentator starts (preexec_fn is not safe with threads)
+LIMIT_MEMORY_SCRIPT = (
+    'import os, sys, resource; '
+    'n = int(sys.argv[1]); '
+    'resource.setrlimit(resource.RLIMIT_AS, (n, n)); '
+    'os.execvp(sys.argv[2], sys.argv[2:])'
+)
+
 
 class TotalSegmentator:
 
@@ -14,11 +29,24 @@ class TotalSegmentator:
         self.statistics = False
         self.radiomics = False
         self.overwrite = True
+        self.executable = 'TotalSegmentator'
+        self.timeout = None                 # Timeout in seconds (None = no timeout)
         self.cmd = None
 
     @staticmethod
     def is_empty(directory):
-        return len(os.listdir(directory)) == 0
+        return not os.path.isdir(directory) or len(os.listdir(directory)) == 0
+
+    def get_command(self):
+        cmd = [self.executable]
+        if self.statistics:
+            cmd.append('--statistics')
+        if self.radiomics:
+            cmd.append('--radiomics')
+        if self.fast:
+            cmd.append('--fast')
+        cmd.extend(['-i', self.input_file, '-o', self.output_directory])
+        return cmd
 
     def execute(self):
         logger.info('Running TotalSegmentator...')
@@ -31,27 +59,162 @@ class TotalSegmentator:
         if not self.overwrite and not self.is_empty(self.output_directory):
             logger.info('Overwrite = False and output directory not empty, so skipping')
             return self.output_directory
-        fast = ''
-        if self.fast:
-            fast = '--fast'
-        statistics = ''
-        if self.statistics:
-            statistics = '--statistics'
-        radiomics = ''
-        if self.radiomics:
-            radiomics = '--radiomics'
-        self.cmd = 'TotalSegmentator {} {} {} -i {} -o {}'.format(
-            statistics, 
-            radiomics,
-            fast,
-            self.input_file,
-            self.output_directory,
-        )
+        cmd = self.get_command()
+        self.cmd = ' '.join([shlex.quote(x) for x in cmd])
         logger.info(f'Running command: {self.cmd}')
-        os.system(self.cmd)
+        try:
+            process = subprocess.Popen(cmd, start_new_session=True)
+        except FileNotFoundError:
+            logger.error(
+                f'{self.executable} is not installed!\n'
+                'Please install it using pip install pytorch totalsegmentator'
+            )
+            return None
+        try:
+            process.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            # Process runs in its own session so this also kills its children
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            logger.error(f'TotalSegmentator timed out after {self.timeout} seconds')
+            return None
+        if process.returncode != 0:
+            logger.error(f'TotalSegmentator failed with exit code {process.returncode}')
+            return None
         return self.output_directory
 
 
+class TotalSegmentatorRunner:
+    """ Runs TotalSegmentator on a list of NIFTI volumes with nr_parallel processes at the same
+    time. Each process gets a limited number of threads and (optionally) a memory limit. Output
+    is written to a log file per volume, processes exceeding the timeout are killed, and wall time
+    and peak resident memory of each process are reported in self.results
+    """
+    def __init__(self):
+        self.input_files = None             # NIFTI volumes
+        self.output_directory = None        # Output of volume <name>.nii.gz goes to <output_directory>/<name>
+        self.log_directory = None           # Defaults to output directory
+        self.nr_parallel = 2                # Nr. of TotalSegmentator processes running at the same time
+        self.nr_threads = 4                 # Nr. of threads per process
+        self.max_memory = None              # Max. virtual memory per process in bytes (Linux only)
+        self.timeout = None                 # Timeout per process in seconds
+        self.fast = False
+        self.statistics = False
+        self.radiomics = False
+        self.overwrite = True
+        self.executable = 'TotalSegmentator'
+        self.results = None
+
+    @staticmethod
+    def get_volume_name(input_file):
+        name = os.path.split(input_file)[1]
+        for ext in ['.nii.gz', '.nii']:
+            if name.endswith(ext):
+                return name[:-len(ext)]
+        return name
+
+    def get_environment(self):
+        env = dict(os.environ)
+        for name in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+            env[name] = str(self.nr_threads)
+        return env
+
+    def get_limited_command(self, cmd):
+        """ Returns command that runs cmd with virtual memory limited to max_memory bytes. If the
+        limit cannot be set, the command is not started and the wrapper exits with an error
+        """
+        if self.max_memory is None:
+            return cmd
+        return [sys.executable, '-c', LIMIT_MEMORY_SCRIPT, str(self.max_memory)] + cmd
+
+    @staticmethod
+    def wait(process, timeout):
+        """ Waits for process to finish and returns (exit code, peak RSS in bytes, timed out)
+        """
+        start = time.time()
+        timed_out = False
+        while True:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            if timeout is not None and time.time() - start > timeout:
+                # Process runs in its own session so this also kills its children
+                os.killpg(process.pid, signal.SIGKILL)
+                pid, status, rusage = os.wait4(process.pid, 0)
+                timed_out = True
+                break
+            time.sleep(0.1)
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak_rss = rusage.ru_maxrss if os.uname().sysname == 'Darwin' else rusage.ru_maxrss * 1024
+        return process.returncode, peak_rss, timed_out
+
+    def run(self, input_file):
+        name = self.get_volume_name(input_file)
+        segmentator = TotalSegmentator()
+        segmentator.input_file = input_file
+        segmentator.output_directory = os.path.join(self.output_directory, name)
+        segmentator.fast = self.fast
+        segmentator.statistics = self.statistics
+        segmentator.radiomics = self.radiomics
+        segmentator.executable = self.executable
+        result = {
+            'input_file': input_file,
+            'output_directory': segmentator.output_directory,
+            'log_file': os.path.join(self.log_directory or self.output_directory, f'{name}.log'),
+            'exit_code': None,
+            'wall_time': 0.0,
+            'peak_rss': 0,
+            'timed_out': False,
+            'skipped': False,
+        }
+        if not self.overwrite and not segmentator.is_empty(segmentator.output_directory):
+            logger.info(f'Overwrite = False and {segmentator.output_directory} not empty, so skipping')
+            result['skipped'] = True
+            return result
+        os.makedirs(segmentator.output_directory, exist_ok=True)
+        os.makedirs(os.path.split(result['log_file'])[0], exist_ok=True)
+        cmd = segmentator.get_command()
+        cmd.extend(['--nr_thr_resamp', str(self.nr_threads), '--nr_thr_saving', str(self.nr_threads)])
+        start = time.time()
+        with open(result['log_file'], 'w') as log:
+            log.write(' '.join([shlex.quote(x) for x in cmd]) + '\n')
+            log.flush()
+            try:
+                process = subprocess.Popen(
+                    self.get_limited_command(cmd), stdout=log, stderr=subprocess.STDOUT,
+                    env=self.get_environment(), start_new_session=True)
+            except FileNotFoundError:
+                logger.error(f'{self.executable} is not installed!')
+                return result
+            result['exit_code'], result['peak_rss'], result['timed_out'] = self.wait(process, self.timeout)
+        result['wall_time'] = time.time() - start
+        if result['timed_out']:
+            logger.error(f'{input_file}: killed after {self.timeout} seconds (see {result["log_file"]})')
+        elif result['exit_code'] != 0:
+            logger.error(f'{input_file}: failed with exit code {result["exit_code"]} (see {result["log_file"]})')
+        else:
+            logger.info(
+                f'{input_file}: finished in {result["wall_time"]:.1f} seconds, '
+                f'peak RSS {result["peak_rss"] / (1024 * 1024):.0f} MB')
+        return result
+
+    def execute(self):
+        logger.info('Running TotalSegmentatorRunner...')
+        if self.input_files is None:
+            logger.error('Input NIFTI files not specified')
+            return None
+        if self.output_directory is None:
+            logger.error('Output directory not specified')
+            return None
+        with ThreadPoolExecutor(max_workers=self.nr_parallel) as executor:
+            self.results = list(executor.map(self.run, self.input_files))
+        return self.results
+
+
 # class TotalSegmentator:
 
 #     def __init__(self, nifti_path, output_dir):
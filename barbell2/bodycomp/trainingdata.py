@@ -0,0 +1,139 @@
+import logging
+import h5py
+import numpy as np
+
+from barbell2.utils import apply_window, iter_prefetched
+
+logger = logging.getLogger(__name__)
+
+
+class TrainingDataset:
+    """ Random-access reader for HDF5 training sets created by barbell2.bodycomp.createh5. The
+    file is opened once and image/label pairs are read by index from the images and labels
+    datasets. Uncompressed, contiguous datasets are memory-mapped so reads bypass HDF5 altogether.
+    Batches can be read in order (contiguous slabs) or shuffled, in which case indices are grouped
+    in blocks of consecutive rows (whole chunks) so each chunk is decompressed only once per epoch
+    and reads stay contiguous within a block. Batches can be prefetched on a
+    background thread while the caller trains on the previous one
+    """
+    # Min. nr. of consecutive rows per shuffle block (createh5 writes one slice per chunk)
+    MIN_BLOCK_SIZE = 16
+
+    def __init__(self, file_path, window=None, memory_map=True, cache_size=64 * 1024 * 1024, block_size=None):
+        """ Opens HDF5 training set
+        :param file_path Path of HDF5 file
+        :param window Optional (width, level) tuple passed to apply_window(), e.g. (400, 50)
+        :param memory_map Memory-map datasets that are stored contiguous and uncompressed
+        :param cache_size Size of the HDF5 chunk cache in bytes
+        :param block_size Nr. of consecutive rows shuffled as a group (default: smallest multiple
+        of the chunk size that is at least MIN_BLOCK_SIZE)
+        """
+        self.file_path = file_path
+        self.window = window
+        self.h5f = h5py.File(file_path, 'r', rdcc_nbytes=cache_size)
+        if 'images' not in self.h5f or 'labels' not in self.h5f:
+            self.h5f.close()
+            raise RuntimeError(f'{file_path} has no images and labels datasets (created with old createh5?)')
+        self.images = self.get_array(self.h5f['images'], memory_map)
+        self.labels = self.get_array(self.h5f['labels'], memory_map)
+        if self.images.shape != self.labels.shape:
+            self.h5f.close()
+            raise RuntimeError(f'Images {self.images.shape} and labels {self.labels.shape} have different shapes')
+        # Rows beyond nr_written were preallocated by a createh5 run that was killed
+        self.nr_rows = min(int(self.h5f.attrs.get('nr_written', self.images.shape[0])), self.images.shape[0])
+        chunks = self.h5f['images'].chunks
+        self.chunk_size = chunks[0] if chunks is not None else 1
+        if block_size is None:
+            block_size = self.chunk_size * -(-TrainingDataset.MIN_BLOCK_SIZE // self.chunk_size)
+        self.block_size = max(1, int(block_size))
+
+    def __len__(self):
+        return self.nr_rows
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f'Index {idx} out of range for dataset of length {len(self)}')
+        return self.get_image(self.images[idx]), np.asarray(self.labels[idx])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.images, self.labels = None, None
+        self.h5f.close()
+
+    def get_array(self, dataset, memory_map):
+        if not memory_map:
+            return dataset
+        offset = dataset.id.get_offset()
+        # Compressed datasets are always chunked, so contiguous means raw bytes at a fixed offset
+        if dataset.chunks is not None or offset is None:
+            return dataset
+        logger.info(f'Memory-mapping {dataset.name} in {self.file_path}')
+        return np.memmap(self.file_path, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+
+    def get_image(self, image):
+        if self.window is None:
+            return np.asarray(image)
+        return apply_window(np.asarray(image, dtype=np.float32), self.window)
+
+    def get_metadata(self, idx):
+        """ Returns (DICOM file, TAG file) for given index
+        """
+        metadata = self.h5f['metadata']
+        return metadata['dicom_file'].asstr()[idx], metadata['tag_file'].asstr()[idx]
+
+    def get_batch(self, start, stop):
+        """ Reads images and labels [start, stop) with a single read per dataset
+        """
+        return self.get_image(self.images[start:stop]), np.asarray(self.labels[start:stop])
+
+    def get_batch_at(self, indices):
+        """ Reads images and labels at given indices (in the given order)
+        """
+        indices = np.asarray(indices)
+        # HDF5 point selections must be increasing, so read sorted and restore the order afterwards
+        unique, inverse = np.unique(indices, return_inverse=True)
+        images, labels = self.images[unique], self.labels[unique]
+        return self.get_image(images[inverse]), np.asarray(labels[inverse])
+
+    def get_shuffled_indices(self, seed=None):
+        """ Returns all indices in random order, grouped in blocks of block_size consecutive rows:
+        the order of the blocks is shuffled and so is the order within each block
+        """
+        rng = np.random.default_rng(seed)
+        starts = np.arange(0, len(self), self.block_size)
+        rng.shuffle(starts)
+        indices = []
+        for start in starts:
+            block = np.arange(start, min(start + self.block_size, len(self)))
+            rng.shuffle(block)
+            indices.append(block)
+        return np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype=np.int64)
+
+    def get_batches(self, batch_size, shuffle=False, seed=None, drop_last=False):
+        """ Yields (images, labels) batches for one epoch in the calling thread
+        """
+        if shuffle:
+            indices = self.get_shuffled_indices(seed)
+        for start in range(0, len(self), batch_size):
+            stop = min(start + batch_size, len(self))
+            if drop_last and stop - start < batch_size:
+                break
+            if shuffle:
+                yield self.get_batch_at(indices[start:stop])
+            else:
+                yield self.get_batch(start, stop)
+
+    def iter_batches(self, batch_size, shuffle=False, seed=None, drop_last=False, prefetch=2):
+        """ Same as get_batches() but reads up to prefetch batches ahead on a background thread
+        """
+        if prefetch <= 0:
+            yield from self.get_batches(batch_size, shuffle, seed, drop_last)
+            return
+        yield from iter_prefetched(self.get_batches(batch_size, shuffle, seed, drop_last), prefetch)
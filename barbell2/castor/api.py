@@ -1,10 +1,15 @@
+import io
+import csv
 import json
 import logging
-import pandas as pd
+import threading
 
-from oauthlib.oauth2 import BackendApplicationClient
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from oauthlib.oauth2 import BackendApplicationClient, TokenExpiredError
 from requests_oauthlib import OAuth2Session
 from barbell2.utils import current_time_secs, elapsed_secs, duration
+from barbell2.castor.cache import ResponseCache
 
 logger = logging.getLogger('__name__')
 
@@ -13,13 +18,28 @@ class CastorApiClient:
     base_url = 'https://data.castoredc.com'
     token_url = base_url + '/oauth/token'
     api_url = base_url + '/api'
+    max_page_size = 1000
 
-    def __init__(self, client_id, client_secret, verbose=False):
+    def __init__(self, client_id, client_secret, verbose=False, max_workers=8, cache=True, cache_dir=None, refresh=False):
+        """ Creates client
+        :param client_id Client ID
+        :param client_secret Client secret
+        :param verbose Log requests and responses
+        :param max_workers Max. nr. of concurrent requests (and pooled connections)
+        :param cache Cache OAuth token and metadata responses on disk (see ResponseCache)
+        :param cache_dir Cache directory (default: ~/.cache/barbell2/castor)
+        :param refresh Ignore cached token and metadata responses and download them again
+        """
         self.verbose = verbose
         if self.verbose:
             logger.info(f'__init__()')
         self.client_id = client_id
         self.client_secret = client_secret
+        self.max_workers = max_workers
+        self.cache = ResponseCache(cache_dir) if cache else None
+        self.refresh = refresh
+        self.token_from_cache = False   # Session uses cached OAuth token (renewed once if rejected)
+        self.session_lock = threading.Lock()
         self.session = self.create_session(self.client_id, self.client_secret)
         self.studies = self.get_studies()
 
@@ -32,15 +52,116 @@ class CastorApiClient:
             )
         client = BackendApplicationClient(client_id=client_id)
         client_session = OAuth2Session(client=client)
-        client_session.fetch_token(
+        # Keep enough connections open for concurrent requests (see get_pages())
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        client_session.mount('https://', adapter)
+        client_session.mount('http://', adapter)
+        token = None
+        if self.cache is not None and not self.refresh:
+            token = self.cache.load_token(client_id)
+        self.token_from_cache = token is not None
+        if token is not None:
+            client_session.token = token
+            return client_session
+        token = client_session.fetch_token(
             token_url=self.token_url,
             client_id=client_id,
             client_secret=client_secret,
         )
+        if self.cache is not None:
+            self.cache.save_token(client_id, token)
         return client_session
 
     def recreate_session(self):
-        self.session = self.create_session(self.client_id, self.client_secret)
+        refresh = self.refresh
+        self.refresh = True
+        try:
+            self.session = self.create_session(self.client_id, self.client_secret)
+        finally:
+            self.refresh = refresh
+
+    def renew_cached_token(self, session, expired=False):
+        """ Called when a request with given session got 401 Unauthorized or its OAuth token expired.
+        If the session used a cached OAuth token (e.g., revoked or expired early) or the token expired,
+        the token is removed from the cache and the session is recreated with a new token. Returns True
+        if the request should be retried
+        :param session Session the request was sent with
+        :param expired Token expired during a (long) run of requests
+        """
+        with self.session_lock:
+            if session is not self.session:
+                # Another thread already renewed the token
+                return True
+            if not self.token_from_cache and not expired:
+                return False
+            logger.warning('OAuth token expired, fetching new token' if expired else 'Cached OAuth token rejected, fetching new token')
+            if self.cache is not None:
+                self.cache.remove(self.cache.get_key('token', self.client_id))
+            self.recreate_session()
+            return True
+
+    def get(self, url, **kwargs):
+        """ Sends GET request with current session. If a cached OAuth token is rejected or the
+        token expired, the token is renewed once and the request is sent again
+        """
+        session = self.session
+        try:
+            response = session.get(url, **kwargs)
+        except TokenExpiredError:
+            self.renew_cached_token(session, expired=True)
+            return self.session.get(url, **kwargs)
+        if response.status_code == 401 and self.renew_cached_token(session):
+            response.close()
+            response = self.session.get(url, **kwargs)
+        return response
+
+    def get_cached(self, url, refresh=None):
+        """ Returns response text for given metadata URL, from the on-disk cache if enabled
+        :param url URL
+        :param refresh Download again even if cached (default: self.refresh)
+        """
+        if self.cache is None:
+            response = self.get(url)
+            response.raise_for_status()
+            return response.text
+        return self.cache.get(self, url, self.client_id, self.refresh if refresh is None else refresh)
+
+    def get_study_structure(self, study_id, refresh=None):
+        """ Returns export/structure CSV text (field definitions) for given study
+        """
+        return self.get_cached(self.api_url + '/study/{}/export/structure'.format(study_id), refresh)
+
+    def get_option_groups(self, study_id, refresh=None):
+        """ Returns export/optiongroups CSV text for given study
+        """
+        return self.get_cached(self.api_url + '/study/{}/export/optiongroups'.format(study_id), refresh)
+
+    def get_page(self, url, page, page_size):
+        response = self.get(url, params={'page': page, 'page_size': page_size})
+        response.raise_for_status()
+        return response.json()
+
+    def get_pages(self, url, embedded_key, max_workers=None):
+        """ Returns items of all pages of a paginated endpoint in order. Page 1 is requested
+        with the largest page size to learn the page count, the remaining pages are requested
+        concurrently with at most max_workers requests at the same time
+        :param url Endpoint URL
+        :param embedded_key Key of the items in the response's _embedded object
+        :param max_workers Max. nr. of concurrent requests (default: self.max_workers)
+        """
+        response_data = self.get_page(url, 1, self.max_page_size)
+        page_count = response_data.get('page_count', 1)
+        pages = [response_data]
+        if page_count > 1 and max_workers == 1:
+            pages.extend([self.get_page(url, page, self.max_page_size) for page in range(2, page_count + 1)])
+        elif page_count > 1:
+            with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+                pages.extend(executor.map(
+                    lambda page: self.get_page(url, page, self.max_page_size), range(2, page_count + 1)))
+        items = []
+        for page in pages:
+            items.extend(page['_embedded'][embedded_key])
+        return items
 
     def get_studies(self):
         """ Returns list of study objects
@@ -48,8 +169,7 @@ class CastorApiClient:
         uri = self.api_url + '/study'
         if self.verbose:
             logger.info(f'get_studies() uri={uri}')
-        response = self.session.get(uri)
-        response_data = response.json()
+        response_data = json.loads(self.get_cached(uri))
         if self.verbose:
             logger.info(f'get_studies() response_data={json.dumps(response_data, indent=4)}')
         studies = []
@@ -84,30 +204,59 @@ class CastorApiClient:
         :param verbose
         """
         record_url = self.api_url + '/study/{}/record'.format(study_id)
-        response = self.session.get(record_url)
-        response_data = response.json()
-        page_count = response_data['page_count']
         records = []
-        for i in range(1, page_count + 1):
-            record_page_url = self.api_url + '/study/{}/record?page={}'.format(study_id, i)
-            response = self.session.get(record_page_url)
-            response_data = response.json()
-            for record in response_data['_embedded']['records']:
-                if not record['id'].startswith('ARCHIVED'):
-                    records.append(record)
-                    if self.verbose:
-                        print(record)
+        for record in self.get_pages(record_url, 'records'):
+            if not record['id'].startswith('ARCHIVED'):
+                records.append(record)
+                if self.verbose:
+                    print(record)
         return records
     
-    def get_record_field_data(self, study_id, record_id):
+    def get_record_field_data(self, study_id, record_id, max_workers=None):
         """ Returns list of all field values for this record 
         :param study_id: Study ID
         :param record_id: Record (or participant) ID
+        :param max_workers: Max. nr. of concurrent page requests (default: self.max_workers)
         """
         record_url = self.api_url + '/study/{}/participant/{}/data-points/study'.format(study_id, record_id)
-        response = self.session.get(record_url)
-        record_field_data = response.json()
-        return record_field_data['_embedded']['items']
+        return self.get_pages(record_url, 'items', max_workers)
+
+    @staticmethod
+    def get_item_value(item):
+        # Data point items have the value under 'field_value' (or 'value' in older API versions)
+        value = item.get('field_value', item.get('value'))
+        return '' if value is None else value
+
+    def get_records_field_data(self, study_id, field_names=None, record_ids=None):
+        """ Returns pandas DataFrame with one row per record (index = record ID) and one column per
+        field (field variable name), with '' for missing values. All data points of a record are
+        fetched with a single (paginated) request and records are fetched concurrently with at
+        most max_workers requests at the same time
+        :param study_id Study ID
+        :param field_names Field variable names (default: all fields)
+        :param record_ids Record IDs (default: all non-archived records)
+        """
+        import pandas as pd
+        fields = self.get_fields(study_id)
+        if field_names is not None:
+            fields_by_name = {field['field_variable_name']: field for field in fields}
+            missing = [name for name in field_names if name not in fields_by_name]
+            if len(missing) > 0:
+                raise ValueError(f'Unknown fields {missing}')
+            fields = [fields_by_name[name] for name in field_names]
+        if record_ids is None:
+            record_ids = [self.get_record_id(record) for record in self.get_records(study_id)]
+        field_ids = [self.get_field_id(field) for field in fields]
+
+        def get_row(record_id):
+            # Pages of a single record are fetched sequentially, records themselves run concurrently
+            items = self.get_record_field_data(study_id, record_id, max_workers=1)
+            values = {item['field_id']: self.get_item_value(item) for item in items}
+            return [values.get(field_id, '') for field_id in field_ids]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            rows = list(executor.map(get_row, record_ids))
+        return pd.DataFrame(rows, index=pd.Index(record_ids, name='record_id'), columns=[field['field_variable_name'] for field in fields])
 
     @staticmethod
     def get_record_id(record):
@@ -123,18 +272,10 @@ class CastorApiClient:
         :param verbose
         """
         field_url = self.api_url + '/study/{}/field'.format(study_id)
-        response = self.session.get(field_url)
-        response_data = response.json()
-        page_count = response_data['page_count']
-        fields = []
-        for i in range(1, page_count + 1):
-            field_page_url = self.api_url + '/study/{}/field?page={}'.format(study_id, i)
-            response = self.session.get(field_page_url)
-            response_data = response.json()
-            for field in response_data['_embedded']['fields']:
-                fields.append(field)
-                if self.verbose:
-                    logger.info(field)
+        fields = self.get_pages(field_url, 'fields')
+        if self.verbose:
+            for field in fields:
+                logger.info(field)
         return fields
 
     @staticmethod
@@ -171,51 +312,165 @@ class CastorApiClient:
         :param field_id Field ID for which data is retrieved
         """
         field_data_url = self.api_url + '/study/{}/record/{}/study-data-point/{}'.format(study_id, record_id, field_id)
-        response = self.session.get(field_data_url)
+        response = self.get(field_data_url)
         if response.status_code == 200:
             response_data = response.json()
             return response_data['value']
         return None
 
-    def get_study_data(self, study_id):
-        logger.info('getting study structure...')
-        study_structure_url = self.api_url + '/study/{}/export/structure'.format(study_id)
-        response = self.session.get(study_structure_url)
+    @staticmethod
+    def parse_csv(text):
+        """ Returns rows of semicolon-separated export text (without header)
+        """
+        return list(csv.reader(io.StringIO(text), delimiter=';'))[1:]
+
+    def iter_csv(self, url):
+        """ Downloads semicolon-separated export and yields its rows (without header) while the
+        response is still coming in, so the export is never held in memory as a whole
+        :param url Export URL
+        """
+        with self.get(url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            # urllib3 closes the raw stream as soon as Content-Length bytes are read, which makes
+            # TextIOWrapper fail on its next read and lose the buffered last rows
+            response.raw.auto_close = False
+            text = io.TextIOWrapper(response.raw, encoding=response.encoding or 'utf-8', newline='')
+            reader = csv.reader(text, delimiter=';')
+            next(reader, None)
+            for row in reader:
+                yield row
+
+    def iter_study_data(self, study_id):
+        """ Yields rows of the export/data CSV of given study (see iter_csv())
+        """
+        return self.iter_csv(self.api_url + '/study/{}/export/data'.format(study_id))
+
+    def get_field_defs(self, study_id):
+        """ Returns dictionary {field ID: (field variable name, field type, option group ID)} of
+        all fields except calculations and remarks, in export/structure order
+        :param study_id Study ID
+        """
         field_defs = {}
-        for line in response.text.split('\n')[1:]:
-            items = line.split(';')
+        for items in self.parse_csv(self.get_study_structure(study_id)):
             if len(items) > 11:
                 field_type = items[11]
                 if field_type != 'calculation' and field_type != 'remark':
-                    field_id = items[8]
-                    field_variable_name = items[9]
-                    field_defs[field_id] = [field_variable_name, field_type]
-        logger.info('getting study data...')
-        study_data_url = self.api_url + '/study/{}/export/data'.format(study_id)
-        response = self.session.get(study_data_url)
-        records = {}
-        for line in response.text.split('\n')[1:]:
-            items = line.split(';')
+                    option_group_id = items[15] if len(items) > 15 else ''
+                    field_defs[items[8]] = (items[9], field_type, option_group_id)
+        return field_defs
+
+    def get_option_group_values(self, study_id):
+        """ Returns dictionary {option group ID: list of option values} in export/optiongroups order
+        :param study_id Study ID
+        """
+        option_groups = {}
+        for items in self.parse_csv(self.get_option_groups(study_id)):
+            if len(items) == 6:
+                option_groups.setdefault(items[1], []).append(items[5])
+        return option_groups
+
+    def get_study_data_records(self, study_id):
+        """ Streams export/data and folds each row into a per-record dictionary as it arrives, so
+        only the values themselves are kept in memory (not the rows). Returns tuple (record IDs in
+        export order, dictionary {record ID: {field ID: field value}}). If a record has a field
+        more than once, the last value is used
+        :param study_id Study ID
+        """
+        record_ids, records, field_ids = {}, {}, {}
+        for items in self.iter_study_data(study_id):
             if len(items) == 9:
-                record_id = items[1]
-                form_type = items[2]
-                if form_type == '':
-                    records[record_id] = {}
-                elif form_type == 'Study':
-                    field_id = items[5]
-                    field_value = items[6]
-                    records[record_id][field_id] = field_value
+                if items[2] == '':
+                    record_ids.setdefault(items[1], None)
+                elif items[2] == 'Study':
+                    # Share one string per field ID between records instead of one per row
+                    field_id = field_ids.setdefault(items[5], items[5])
+                    records.setdefault(items[1], {})[field_id] = items[6]
+        return list(record_ids), records
+
+    @staticmethod
+    def pivot_study_data(record_ids, records, field_ids):
+        """ Returns wide DataFrame of strings with one row per record and one column per field
+        ID ('' for missing values). Columns are built one at a time from the record dictionaries
+        :param record_ids Record IDs (rows, in this order)
+        :param records Dictionary {record ID: {field ID: field value}}
+        :param field_ids Field IDs (columns, in this order)
+        """
+        import pandas as pd
+        rows = [records.get(record_id, {}) for record_id in record_ids]
+        index = pd.Index(record_ids, name='record_id')
+        columns = {field_id: pd.Series([row.get(field_id, '') for row in rows], index=index, dtype=object) for field_id in field_ids}
+        return pd.DataFrame(columns, index=index, columns=field_ids)
+
+    @staticmethod
+    def convert_column(values, field_type):
+        """ Converts column of strings to the pandas type for given Castor field type
+        """
+        import pandas as pd
+        if field_type in ['numeric', 'radio', 'dropdown', 'year']:
+            return pd.to_numeric(values, errors='coerce')
+        if field_type == 'date':
+            return pd.to_datetime(values, format='%d-%m-%Y', errors='coerce')
+        return values
+
+    @staticmethod
+    def expand_options(values, field_variable_name, field_type, option_values):
+        """ Returns one-hot DataFrame with uint8 columns <field variable name>$<option value> for
+        each option. Checkbox values can contain multiple options separated by ';'
+        """
+        import pandas as pd
+        if field_type == 'checkbox':
+            values = values.str.split(';').explode()
+        categories = pd.Categorical(values, categories=option_values)
+        one_hot = pd.get_dummies(categories, prefix=field_variable_name, prefix_sep='$', dtype='uint8')
+        one_hot.index = values.index
+        if field_type == 'checkbox':
+            one_hot = one_hot.groupby(level=0, sort=False).max()
+        return one_hot
+
+    def get_study_data_frame(self, study_id, typed=True, expand_options=False):
+        """ Returns study data as wide DataFrame with one row per record (index = record ID) and
+        one column per field (field variable name)
+        :param study_id Study ID
+        :param typed Convert numeric, radio, dropdown and year fields to numbers and dates to datetimes
+        :param expand_options Replace radio and checkbox fields by one-hot columns <name>$<option value>
+        """
+        import pandas as pd
+        field_defs = self.get_field_defs(study_id)
+        option_groups = self.get_option_group_values(study_id) if expand_options else {}
+        record_ids, records = self.get_study_data_records(study_id)
+        wide = self.pivot_study_data(record_ids, records, list(field_defs.keys()))
+        columns = []
+        for field_id, (field_variable_name, field_type, option_group_id) in field_defs.items():
+            values = wide[field_id]
+            if expand_options and field_type in ['radio', 'checkbox'] and option_group_id in option_groups:
+                columns.append(self.expand_options(values, field_variable_name, field_type, option_groups[option_group_id]))
+            elif typed:
+                columns.append(self.convert_column(values, field_type).rename(field_variable_name))
+            else:
+                columns.append(values.rename(field_variable_name))
+        if len(columns) == 0:
+            return pd.DataFrame(index=pd.Index(record_ids, name='record_id'))
+        data = pd.concat(columns, axis=1)
+        data.index.name = 'record_id'
+        return data
+
+    def get_study_data(self, study_id):
+        """ Returns dictionary {field ID: {field_variable_name, field_type, field_values}} with
+        the (string) values of each field for all records in export order
+        :param study_id Study ID
+        """
+        logger.info('getting study structure...')
+        field_defs = self.get_field_defs(study_id)
+        logger.info('getting study data...')
+        record_ids, records = self.get_study_data_records(study_id)
         logger.info('building dataset...')
-        # Object records_data is a dictionary with a key for every field
+        wide = self.pivot_study_data(record_ids, records, list(field_defs.keys()))
         records_data = {}
-        for field_id in field_defs.keys():
-            field_variable_name = field_defs[field_id][0]
-            field_type = field_defs[field_id][1]
-            for record_id in list(records.keys()):  # Make sure we iterate over record IDs in increasing order
-                if field_id not in records_data.keys():
-                    records_data[field_id] = {'field_variable_name': field_variable_name, 'field_type': field_type, 'field_values': []}
-                if field_id in records[record_id].keys():
-                    records_data[field_id]['field_values'].append(records[record_id][field_id])
-                else:
-                    records_data[field_id]['field_values'].append('')
+        for field_id, (field_variable_name, field_type, _) in field_defs.items():
+            records_data[field_id] = {
+                'field_variable_name': field_variable_name,
+                'field_type': field_type,
+                'field_values': wide[field_id].tolist(),
+            }
         return records_data
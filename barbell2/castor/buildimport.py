@@ -1,9 +1,10 @@
 import argparse
-from barbell2.castor import loaders
-from barbell2.castor import builders
 
 
 def main():
+    # Loaders and builders import pandas, so only load them once arguments are parsed
+    from barbell2.castor import loaders
+    from barbell2.castor import builders
     parser = argparse.ArgumentParser()
     parser.add_argument('castor_export', help='Castor export Excel file')
     parser.add_argument('dica_export', help='DHBA or DPCA export Excel data file')
@@ -20,6 +21,8 @@ def main():
 
 
 def bla():
+    from barbell2.castor import loaders
+    from barbell2.castor import builders
     cast_loader = loaders.CastorExportFileLoader('/Users/Ralph/data/surfdrive/documents/hpb/castor/data/exports/castoredc/ESPRESSO_v2.0_DHBA_excel_export_20220926102336.xlsx')
     cast_data = cast_loader.load()
     dica_loader = loaders.DicaExportFileLoader(
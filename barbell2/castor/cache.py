@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """ On-disk cache for responses of (rarely changing) Castor metadata endpoints, such as the
+    study list, export/structure and export/optiongroups, and for OAuth tokens. Responses are
+    keyed on client ID and URL (which contains the study ID and endpoint). A cached response is
+    used without any request while it is younger than ttl seconds. After that it is revalidated
+    with If-None-Match/If-Modified-Since if the server sent an ETag or Last-Modified header, and
+    downloaded again otherwise. Files are only readable by the current user
+    """
+    def __init__(self, cache_dir=None, ttl=3600):
+        """ Creates cache
+        :param cache_dir Cache directory (default: ~/.cache/barbell2/castor)
+        :param ttl Nr. of seconds a response is used without revalidation
+        """
+        self.cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.cache', 'barbell2', 'castor')
+        self.ttl = ttl
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def get_key(*items):
+        return hashlib.sha256('|'.join(items).encode()).hexdigest()
+
+    def get_file_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def load(self, key):
+        try:
+            with open(self.get_file_path(key), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key, entry):
+        # Write to temporary file first so concurrent readers never see a partial entry
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_file, self.get_file_path(key))
+        except OSError as e:
+            logger.warning(f'Could not write cache entry {key} ({e})')
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+    def remove(self, key):
+        if os.path.isfile(self.get_file_path(key)):
+            os.remove(self.get_file_path(key))
+
+    def get(self, session, url, client_id='', refresh=False):
+        """ Returns response text for given URL from cache or server
+        :param session Requests session (or object with compatible get()) used on cache miss or revalidation
+        :param url URL
+        :param client_id Client ID the response belongs to
+        :param refresh Ignore cached response and download it again
+        """
+        key = self.get_key('response', client_id, url)
+        entry = None if refresh else self.load(key)
+        if entry is not None and time.time() - entry['time'] < self.ttl:
+            logger.info(f'Using cached response for {url}')
+            return entry['text']
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        response = session.get(url, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            logger.info(f'Cached response for {url} still valid')
+            entry['time'] = time.time()
+            self.save(key, entry)
+            return entry['text']
+        response.raise_for_status()
+        self.save(key, {
+            'url': url,
+            'time': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'text': response.text,
+        })
+        return response.text
+
+    def load_token(self, client_id, margin=600):
+        """ Returns cached OAuth token for client ID, or None if there is none or it expires within
+        margin seconds (so it does not expire during a long run of requests)
+        :param client_id Client ID
+        :param margin Min. nr. of seconds the token must still be valid
+        """
+        token = self.load(self.get_key('token', client_id))
+        if token is None or token.get('expires_at', 0) - margin < time.time():
+            return None
+        return token
+
+    def save_token(self, client_id, token):
+        self.save(self.get_key('token', client_id), dict(token))
@@ -2,7 +2,6 @@ import os
 import time
 import sqlite3
 import logging
-import pandas as pd
 
 from datetime import datetime
 from barbell2.castor.api import CastorApiClient
@@ -182,6 +181,7 @@ class CastorExcelToSqlite:
 
     @staticmethod
     def get_field_types(field_definitions):
+        import pandas as pd
         field_types = {}
         for _, row in field_definitions.iterrows():
             variable_name = row['Variable name']
@@ -192,6 +192,7 @@ class CastorExcelToSqlite:
         return field_types
     
     def get_records_data(self, field_data, field_types):
+        import pandas as pd
         records_data = {}
         count = 0
         for _, row in field_data.iterrows():
@@ -278,6 +279,7 @@ class CastorExcelToSqlite:
                 conn.close()
 
     def execute(self):
+        import pandas as pd
         logger.info('Loading field definitions...')
         field_definitions = pd.read_excel(self.export_excel_file, sheet_name='Study variable list', engine='openpyxl', dtype=str)
         field_types = self.get_field_types(field_definitions)
@@ -321,6 +323,7 @@ class CastorQuery:
         self.output.to_csv(output_file, sep=';', index=False)
 
     def execute(self, query):
+        import pandas as pd
         self.output = None
         cursor = self.db.cursor()
         data = cursor.execute(query)
@@ -1 +1,21 @@
-from barbell2.converters.dcm2nifti import DicomToNifti
+import importlib
+
+# Classes are imported on first access so that importing a single converter does not pull in
+# the dependencies of all the others (matplotlib, nrrd, etc.)
+_classes = {
+    'DicomToNifti': 'barbell2.converters.dcm2nifti',
+    'DicomToNiftiFarm': 'barbell2.converters.dcm2nifti',
+    'MosaicRenderer': 'barbell2.converters.mosaic',
+}
+
+__all__ = list(_classes.keys())
+
+
+def __getattr__(name):
+    if name in _classes:
+        return getattr(importlib.import_module(_classes[name]), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -1,6 +1,13 @@
 import os
+import json
+import shutil
+import hashlib
 import logging
+import tempfile
 import subprocess
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -8,57 +15,224 @@ logger = logging.getLogger(__name__)
 # from dcmstack import dcmmeta
 
 
+@functools.lru_cache(maxsize=None)
+def find_dcm2niix():
+    """ Returns path of dcm2niix executable (or None). Only looks it up once per process
+    """
+    executable = shutil.which('dcm2niix')
+    if executable is None:
+        print(
+            'dcm2niix is not installed! Please install it using the following command:\n'
+            'curl -fLO https://github.com/rordenlab/dcm2niix/releases/latest/download/dcm2niix_mac.zip'
+        )
+    return executable
+
+
+def get_fingerprint(directory):
+    """ Returns hash of the file names, sizes and modification times in given directory
+    """
+    h = hashlib.sha256()
+    for f in sorted(os.listdir(directory)):
+        f_path = os.path.join(directory, f)
+        if os.path.isfile(f_path):
+            stat = os.stat(f_path)
+            h.update(f'{f}|{stat.st_size}|{stat.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+
+def load_dicom_series(directory):
+    """ Loads DICOM series in given directory as a nibabel.Nifti1Image without calling dcm2niix or
+    touching disk. Slices are sorted along the slice normal and stacked into a preallocated int16
+    volume (in HU). The affine is computed from ImagePositionPatient, ImageOrientationPatient and
+    PixelSpacing and converted from DICOM (LPS) to NIFTI (RAS) coordinates. If the directory
+    contains multiple series, the one with the most slices is used
+    """
+    import nibabel
+    import pydicom
+    import pydicom.errors
+    import numpy as np
+    tags = ['SeriesInstanceUID', 'ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'SliceThickness']
+    series = {}
+    for f in sorted(os.listdir(directory)):
+        f_path = os.path.join(directory, f)
+        if not os.path.isfile(f_path):
+            continue
+        try:
+            p = pydicom.dcmread(f_path, stop_before_pixels=True, specific_tags=tags)
+        except pydicom.errors.InvalidDicomError:
+            continue
+        if 'ImagePositionPatient' not in p or 'ImageOrientationPatient' not in p:
+            continue
+        series.setdefault(p.get('SeriesInstanceUID', ''), []).append((f_path, p))
+    if len(series) == 0:
+        raise RuntimeError(f'No DICOM images with position and orientation found in {directory}')
+    slices = max(series.values(), key=len)
+    orientation = np.array(slices[0][1].ImageOrientationPatient, dtype=np.float64)
+    row_cosine, column_cosine = orientation[:3], orientation[3:]
+    normal = np.cross(row_cosine, column_cosine)
+    positions = np.array([p.ImagePositionPatient for _, p in slices], dtype=np.float64)
+    order = np.argsort(positions.dot(normal), kind='stable')
+    positions = positions[order]
+    file_paths = [slices[i][0] for i in order]
+    pixel_spacing = [float(x) for x in slices[0][1].PixelSpacing]
+    if len(file_paths) > 1:
+        slice_step = (positions[-1] - positions[0]) / (len(file_paths) - 1)
+    else:
+        slice_step = normal * float(slices[0][1].get('SliceThickness', 1.0) or 1.0)
+    affine = np.eye(4)
+    affine[:3, 0] = row_cosine * pixel_spacing[1]
+    affine[:3, 1] = column_cosine * pixel_spacing[0]
+    affine[:3, 2] = slice_step
+    affine[:3, 3] = positions[0]
+    affine = np.diag([-1, -1, 1, 1]).dot(affine)
+    volume = None
+    for k, f_path in enumerate(file_paths):
+        p = pydicom.dcmread(f_path)
+        pixels = p.pixel_array.astype(np.float32) * float(p.get('RescaleSlope', 1)) + float(p.get('RescaleIntercept', 0))
+        if volume is None:
+            volume = np.empty((pixels.shape[1], pixels.shape[0], len(file_paths)), dtype=np.int16)
+        # NIFTI index i runs along DICOM columns, j along rows
+        volume[:, :, k] = np.clip(np.rint(pixels), -32768, 32767).T
+    image = nibabel.Nifti1Image(volume, affine)
+    image.set_qform(affine, code=1)
+    image.set_sform(affine, code=1)
+    image.header.set_xyzt_units('mm')
+    return image
+
+
 class DicomToNifti:
 
     def __init__(self):
-        try:
-            subprocess.call(['dcm2niix'])
-        except FileNotFoundError:
-            print(
-                'dcm2niix is not installed! Please install it using the following command:\n'
-                'curl -fLO https://github.com/rordenlab/dcm2niix/releases/latest/download/dcm2niix_mac.zip'
-            )
+        self.executable = find_dcm2niix()
         self.input_directory = None
         self.output_file = None
         self.overwrite = True
+        self.skip_unchanged = False     # Skip conversion if input files did not change since last conversion
+        self.in_process = False         # Convert with load_dicom_series() instead of dcm2niix
+        self.output_image = None        # Nifti1Image (only set for in-process conversion)
         self.cmd = None
 
     @staticmethod
     def exists(f):
         return os.path.isfile(f)
 
+    def get_fingerprint_file(self):
+        return self.output_file + '.fingerprint'
+
+    def is_unchanged(self):
+        if not self.exists(self.output_file) or not self.exists(self.get_fingerprint_file()):
+            return False
+        with open(self.get_fingerprint_file(), 'r') as f:
+            fingerprint = json.load(f).get('fingerprint')
+        return fingerprint == get_fingerprint(self.input_directory)
+
+    def save_fingerprint(self):
+        with open(self.get_fingerprint_file(), 'w') as f:
+            json.dump({'input_directory': self.input_directory, 'fingerprint': get_fingerprint(self.input_directory)}, f)
+
     def execute(self, verbose=False):
         logger.info('Running DicomToNifti...')
         if self.input_directory is None:
             logger.error('Input directory not specified')
             return None
-        if self.output_file is None:
+        if self.output_file is None and not self.in_process:
             logger.error('Output file not specified')
             return None
+        if self.output_file is None:
+            # Hand image directly to the next stage without writing it to disk
+            self.output_image = load_dicom_series(self.input_directory)
+            return self.output_image
         if not self.overwrite and self.exists(self.output_file):
             logger.info('Overwrite = False and output file already exists')
             return self.output_file
-        if self.exists(self.output_file):
-            logger.warn('Output file already exists, deleting it')
-            file_base = os.path.splitext(self.output_file)[0]
-            os.system('rm {}*'.format(file_base))
+        if self.skip_unchanged and self.is_unchanged():
+            logger.info('Input files did not change since last conversion, skipping')
+            return self.output_file
         items = os.path.split(self.output_file)
         output_file_name = items[1]
         if output_file_name.endswith('.nii.gz'):
             output_file_name = output_file_name[:-7]
+            compress = 'y'
         elif output_file_name.endswith('.nii'):
             output_file_name = output_file_name[:-4]
+            compress = 'n'
         else:
             logger.error('Output file must have extension .nii.gz or .nii')
             return None
-        output_file_dir = items[0]
+        output_file_dir = items[0] if items[0] != '' else '.'
         os.makedirs(output_file_dir, exist_ok=True)
-        self.cmd = f'dcm2niix -m y -z y -f {output_file_name} -o {output_file_dir} {self.input_directory}'
-        if verbose:
-            logger.info(f'{self.cmd}')
-        os.system(self.cmd)
+        if self.in_process or self.executable is None:
+            return self.execute_in_process(output_file_dir)
+        # Convert into temporary directory next to the output file and move the results into place
+        # afterwards, so the output file is either the previous or the new version, never partial
+        tmp_dir = tempfile.mkdtemp(prefix='.dcm2niix-', dir=output_file_dir)
+        try:
+            cmd = [self.executable, '-m', 'y', '-z', compress, '-f', output_file_name, '-o', tmp_dir, self.input_directory]
+            self.cmd = ' '.join(cmd)
+            if verbose:
+                logger.info(f'{self.cmd}')
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if verbose:
+                logger.info(result.stdout.decode(errors='replace'))
+            tmp_output_file = os.path.join(tmp_dir, items[1])
+            if result.returncode != 0 or not self.exists(tmp_output_file):
+                logger.error(f'dcm2niix failed with exit code {result.returncode}: {result.stdout.decode(errors="replace")}')
+                return None
+            for f in os.listdir(tmp_dir):
+                if f != items[1]:
+                    os.replace(os.path.join(tmp_dir, f), os.path.join(output_file_dir, f))
+            os.replace(tmp_output_file, self.output_file)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.save_fingerprint()
         return self.output_file
 
+    def execute_in_process(self, output_file_dir):
+        import nibabel
+        logger.info('Converting DICOM to NIFTI in-process')
+        self.output_image = load_dicom_series(self.input_directory)
+        # Save under temporary name with the same extension and rename, as in execute()
+        ext = '.nii.gz' if self.output_file.endswith('.nii.gz') else '.nii'
+        fd, tmp_output_file = tempfile.mkstemp(prefix='.nifti-', suffix=ext, dir=output_file_dir)
+        os.close(fd)
+        try:
+            nibabel.save(self.output_image, tmp_output_file)
+            os.replace(tmp_output_file, self.output_file)
+        finally:
+            if self.exists(tmp_output_file):
+                os.remove(tmp_output_file)
+        self.save_fingerprint()
+        return self.output_file
+
+
+class DicomToNiftiFarm:
+    """ Converts many DICOM series to NIFTI concurrently, running at most nr_workers dcm2niix
+    processes at the same time
+    """
+    def __init__(self):
+        self.jobs = None                # List of (input directory, output file) tuples
+        self.nr_workers = 4
+        self.overwrite = True
+        self.skip_unchanged = True
+        self.output_files = None
+
+    def convert(self, job):
+        converter = DicomToNifti()
+        converter.input_directory = job[0]
+        converter.output_file = job[1]
+        converter.overwrite = self.overwrite
+        converter.skip_unchanged = self.skip_unchanged
+        return converter.execute()
+
+    def execute(self):
+        logger.info('Running DicomToNiftiFarm...')
+        if self.jobs is None:
+            logger.error('Jobs not specified')
+            return None
+        with ThreadPoolExecutor(max_workers=self.nr_workers) as executor:
+            self.output_files = list(executor.map(self.convert, self.jobs))
+        return self.output_files
+
 
 if __name__ == '__main__':
     def main():
@@ -0,0 +1,160 @@
+import os
+import html
+import logging
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from barbell2.converters.npy2png import encode_png, render, load_dicom_image
+
+logger = logging.getLogger(__name__)
+
+
+def resize_nearest(pixels, tile_size):
+    """ Downsamples (rows, cols[, 3]) image with nearest-neighbour sampling so that it fits in a
+    tile_size x tile_size square (keeping aspect ratio) and centers it in a black tile
+    """
+    rows, cols = pixels.shape[:2]
+    scale = tile_size / max(rows, cols)
+    new_rows, new_cols = max(1, int(round(rows * scale))), max(1, int(round(cols * scale)))
+    row_idx = np.minimum((np.arange(new_rows) / scale).astype(np.int64), rows - 1)
+    col_idx = np.minimum((np.arange(new_cols) / scale).astype(np.int64), cols - 1)
+    tile = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+    top, left = (tile_size - new_rows) // 2, (tile_size - new_cols) // 2
+    resized = pixels[row_idx][:, col_idx]
+    if resized.ndim == 2:
+        resized = resized[..., np.newaxis]
+    tile[top:top + new_rows, left:left + new_cols] = resized
+    return tile
+
+
+def render_tile(npy_file, image_file, tile_size, color_map, window, alpha):
+    """ Returns (tile, error message) for label file and/or DICOM image. Runs in worker processes
+    """
+    try:
+        labels = np.load(npy_file) if npy_file is not None else None
+        image = load_dicom_image(image_file) if image_file is not None else None
+        return resize_nearest(render(labels, image, color_map, window, alpha), tile_size), None
+    except Exception as e:
+        return np.zeros((tile_size, tile_size, 3), dtype=np.uint8), str(e)
+
+
+class MosaicRenderer:
+    """ Renders segmentations (optionally blended over their CT images) as thumbnails tiled
+    rows x cols per page, writes each page as one PNG and an HTML index in which every tile links
+    to its source file. Tiles are rendered across a process pool and pages are streamed, so only
+    the current page and the tiles of the next page are held in memory
+    """
+    def __init__(self):
+        self.npy_files = None           # Label files (e.g., *.seg.npy)
+        self.image_files = None         # Optional DICOM files (same order as npy_files)
+        self.output_dir = None
+        self.rows = 8                   # Nr. of tile rows per page
+        self.cols = 8                   # Nr. of tile columns per page
+        self.tile_size = 128            # Tile width and height in pixels
+        self.color_map = 'alberta'
+        self.window = (400, 50)
+        self.alpha = 0.5
+        self.workers = None             # Nr. of worker processes (default: number of CPUs)
+        self.index_file = None
+        self.page_files = None
+
+    def get_items(self):
+        if self.npy_files is not None:
+            image_files = self.image_files if self.image_files is not None else [None] * len(self.npy_files)
+            return list(zip(self.npy_files, image_files))
+        return [(None, image_file) for image_file in self.image_files]
+
+    def get_link(self, f_path):
+        try:
+            return os.path.relpath(f_path, self.output_dir)
+        except ValueError:
+            return os.path.abspath(f_path)
+
+    def get_tiles(self, items):
+        """ Yields (tile, error message) in order, keeping at most two pages of tiles in flight
+        """
+        max_in_flight = 2 * self.rows * self.cols
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = deque()
+            for npy_file, image_file in items:
+                futures.append(executor.submit(
+                    render_tile, npy_file, image_file, self.tile_size, self.color_map, self.window, self.alpha))
+                if len(futures) >= max_in_flight:
+                    yield futures.popleft().result()
+            while len(futures) > 0:
+                yield futures.popleft().result()
+
+    def write_page(self, page, page_nr, page_items):
+        page_file_name = f'page_{page_nr:04d}.png'
+        with open(os.path.join(self.output_dir, page_file_name), 'wb') as f:
+            f.write(encode_png(page))
+        self.page_files.append(os.path.join(self.output_dir, page_file_name))
+        lines = [
+            f'<h2>Page {page_nr}</h2>',
+            f'<img src="{page_file_name}" usemap="#page_{page_nr:04d}" width="{page.shape[1]}" height="{page.shape[0]}">',
+            f'<map name="page_{page_nr:04d}">',
+        ]
+        for i, (npy_file, image_file, error) in enumerate(page_items):
+            f_path = npy_file if npy_file is not None else image_file
+            top, left = (i // self.cols) * self.tile_size, (i % self.cols) * self.tile_size
+            title = os.path.split(f_path)[1] + (f' (error: {error})' if error is not None else '')
+            lines.append(
+                f'<area shape="rect" coords="{left},{top},{left + self.tile_size},{top + self.tile_size}" '
+                f'href="{html.escape(self.get_link(f_path))}" title="{html.escape(title)}">')
+        lines.append('</map>')
+        return lines
+
+    def execute(self):
+        logger.info('Running MosaicRenderer...')
+        if self.npy_files is None and self.image_files is None:
+            logger.error('Input files not specified')
+            return None
+        if self.output_dir is None:
+            logger.error('Output directory not specified')
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        items = self.get_items()
+        tiles_per_page = self.rows * self.cols
+        self.page_files = []
+        lines = ['<!DOCTYPE html>', '<html>', '<head><meta charset="utf-8"><title>Mosaic</title></head>', '<body>']
+        page, page_items, nr_errors = None, [], 0
+        for i, (tile, error) in enumerate(self.get_tiles(items)):
+            if i % tiles_per_page == 0:
+                nr_tiles = min(tiles_per_page, len(items) - i)
+                nr_rows = (nr_tiles + self.cols - 1) // self.cols
+                page = np.zeros((nr_rows * self.tile_size, self.cols * self.tile_size, 3), dtype=np.uint8)
+                page_items = []
+            if error is not None:
+                logger.warning(f'Could not render {items[i]}: {error}')
+                nr_errors += 1
+            j = i % tiles_per_page
+            top, left = (j // self.cols) * self.tile_size, (j % self.cols) * self.tile_size
+            page[top:top + self.tile_size, left:left + self.tile_size] = tile
+            page_items.append((*items[i], error))
+            if len(page_items) == nr_tiles:
+                lines.extend(self.write_page(page, len(self.page_files), page_items))
+                logger.info(f'Written page {len(self.page_files)} ({i + 1}/{len(items)} tiles)')
+        lines.extend(['</body>', '</html>'])
+        self.index_file = os.path.join(self.output_dir, 'index.html')
+        with open(self.index_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        if nr_errors > 0:
+            logger.warning(f'{nr_errors} tiles could not be rendered')
+        return self.index_file
+
+    @staticmethod
+    def render_directory(input_dir, output_dir, image_dir=None, **kwargs):
+        """ Renders all *.seg.npy files in input_dir as mosaic. If image_dir is given, each
+        <name>.seg.npy is blended over DICOM file <image_dir>/<name>. Other keyword arguments
+        set the corresponding attributes (rows, cols, tile_size, etc.)
+        """
+        renderer = MosaicRenderer()
+        renderer.npy_files = sorted([os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith('.seg.npy')])
+        if image_dir is not None:
+            renderer.image_files = [
+                os.path.join(image_dir, os.path.split(f)[1][:-len('.seg.npy')]) for f in renderer.npy_files]
+        renderer.output_dir = output_dir
+        for k, v in kwargs.items():
+            setattr(renderer, k, v)
+        return renderer.execute()
@@ -1,8 +1,12 @@
 import os
+import copy
 import pydicom
 import numpy as np
 
-from barbell2.utils import get_alberta_color_map, create_fake_dicom
+from pydicom.dataset import Dataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from concurrent.futures import ThreadPoolExecutor
+from barbell2.utils import get_color_map, create_fake_dicom, apply_color_map, is_tag_file, LabelMap
 
 
 class Numpy2Dicom:
@@ -10,13 +14,13 @@ class Numpy2Dicom:
     def __init__(self, npy_array_or_file_path, dcm_file_path_or_obj):
         self.npy_array_or_file_path = npy_array_or_file_path
         self.dcm_file_path_or_obj = dcm_file_path_or_obj
-        self.color_map = get_alberta_color_map()
+        self.color_map = get_color_map('alberta')
         self.npy_dcm_file_name = 'npy_array.dcm'
         self.npy_dcm_file_path = None
         self.output_dir = '..'
 
     def set_color_map(self, color_map):
-        self.color_map = color_map
+        self.color_map = get_color_map(color_map)
 
     def set_output_dir(self, output_dir):
         self.output_dir = output_dir
@@ -35,6 +39,181 @@ class Numpy2Dicom:
             p = self.dcm_file_path_or_obj
         if p.file_meta.TransferSyntaxUID.is_compressed:
             p.decompress()
-        p_new = create_fake_dicom(npy_array, p)
+        p_new = create_fake_dicom(npy_array, p, self.color_map)
         self.npy_dcm_file_path = os.path.join(self.output_dir, self.npy_dcm_file_name)
         p_new.save_as(self.npy_dcm_file_path)
+
+
+class DicomSeriesWriter:
+    """ Writes a stack of label images as a new DICOM series next to its source series, either
+    as RGB overlay images (one file per slice) or as a single DICOM SEG object (requires
+    highdicom). The header of the first source file is parsed once and used as template. Only
+    the per-slice attributes (SOPInstanceUID, ImagePositionPatient, InstanceNumber, etc.) are
+    read from the other source files and cloned into each output file
+    """
+    # Alberta labels written as DICOM SEG segments (label, segment label, SNOMED-CT code name)
+    SEG_SEGMENTS = [
+        (1, 'Muscle', 'SkeletalMuscle'),
+        (5, 'Visceral adipose tissue', 'AdiposeTissue'),
+        (7, 'Subcutaneous adipose tissue', 'AdiposeTissue'),
+    ]
+    SLICE_TAGS = ['SOPInstanceUID', 'ImagePositionPatient', 'InstanceNumber', 'SliceLocation']
+    PIXEL_TAGS = ['RescaleIntercept', 'RescaleSlope', 'RescaleType', 'WindowCenter', 'WindowWidth', 'PixelPaddingValue']
+
+    def __init__(self):
+        self.dcm_file_paths = None          # Source DICOM files, one per label image (same order)
+        self.output_dir = None
+        self.color_map = get_color_map('alberta')
+        self.series_description = 'Body composition'
+        self.series_number = None           # Default: source series number + 1000
+        self.workers = 8                    # Nr. of threads writing files
+        self.output_files = None
+
+    def set_color_map(self, color_map):
+        self.color_map = get_color_map(color_map)
+
+    @staticmethod
+    def save(p, f_path):
+        if int(pydicom.__version__.split('.')[0]) < 3:
+            p.is_little_endian = True
+            p.is_implicit_VR = False
+            p.save_as(f_path, write_like_original=False)
+        else:
+            p.save_as(f_path, enforce_file_format=True)
+
+    @staticmethod
+    def load_labels(labels, k, shape):
+        pixels = labels[k]
+        if isinstance(pixels, str) and is_tag_file(pixels):
+            from barbell2.converters.tag2npy import Tag2Numpy
+            pixels = Tag2Numpy(pixels, shape).execute()
+        elif isinstance(pixels, str):
+            pixels = np.load(pixels)
+        return pixels
+
+    def check_inputs(self, labels):
+        if self.dcm_file_paths is None:
+            print('Source DICOM files not specified')
+            return False
+        if self.output_dir is None:
+            print('Output directory not specified')
+            return False
+        if len(labels) != len(self.dcm_file_paths):
+            print(f'Nr. of label images ({len(labels)}) != nr. of source DICOM files ({len(self.dcm_file_paths)})')
+            return False
+        # Output files get the names of the source files, so writing into a source directory
+        # would silently replace the original series
+        output_dir = os.path.realpath(self.output_dir)
+        for f_path in self.dcm_file_paths:
+            if os.path.realpath(os.path.dirname(os.path.abspath(f_path))) == output_dir:
+                raise ValueError(f'Output directory {self.output_dir} contains source DICOM file {f_path}')
+        return True
+
+    def load_template(self):
+        """ Returns header of first source file converted to an 8-bit RGB image in a new series
+        """
+        p = pydicom.dcmread(self.dcm_file_paths[0], stop_before_pixels=True)
+        for tag in DicomSeriesWriter.PIXEL_TAGS:
+            if tag in p:
+                delattr(p, tag)
+        p.PhotometricInterpretation = 'RGB'
+        p.SamplesPerPixel = 3
+        p.BitsAllocated = 8
+        p.BitsStored = 8
+        p.HighBit = 7
+        p.PixelRepresentation = 0
+        p.PlanarConfiguration = 0
+        p.SeriesInstanceUID = generate_uid()
+        p.SeriesNumber = self.series_number if self.series_number is not None else int(p.get('SeriesNumber', 0) or 0) + 1000
+        p.SeriesDescription = self.series_description
+        p.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        return p
+
+    def load_slice_attributes(self, f_path):
+        p = pydicom.dcmread(f_path, stop_before_pixels=True, specific_tags=DicomSeriesWriter.SLICE_TAGS)
+        return {tag: p.get(tag) for tag in DicomSeriesWriter.SLICE_TAGS if tag in p}
+
+    def write_slice(self, template, labels, k):
+        attributes = self.load_slice_attributes(self.dcm_file_paths[k])
+        pixels = self.load_labels(labels, k, (template.Rows, template.Columns))
+        if pixels.shape != (template.Rows, template.Columns):
+            raise ValueError(f'Label image shape {pixels.shape} != ({template.Rows}, {template.Columns})')
+        p = copy.deepcopy(template)
+        for tag in ['ImagePositionPatient', 'InstanceNumber', 'SliceLocation']:
+            if tag in attributes:
+                setattr(p, tag, attributes[tag])
+        p.SOPInstanceUID = generate_uid()
+        p.file_meta.MediaStorageSOPInstanceUID = p.SOPInstanceUID
+        if 'SOPInstanceUID' in attributes:
+            source = Dataset()
+            source.ReferencedSOPClassUID = template.SOPClassUID
+            source.ReferencedSOPInstanceUID = attributes['SOPInstanceUID']
+            p.SourceImageSequence = [source]
+        p.add_new(0x7fe00010, 'OB', apply_color_map(pixels, self.color_map).tobytes())
+        f_path = os.path.join(self.output_dir, os.path.split(self.dcm_file_paths[k])[1])
+        self.save(p, f_path)
+        return f_path
+
+    def write_overlay_series(self, labels):
+        """ Writes RGB overlay series with one file per slice (same file names as the source files).
+        Raises ValueError if the output directory is a source directory
+        :param labels Label volume (N, rows, cols) or list of label images, .npy files or TAG files
+        """
+        if not self.check_inputs(labels):
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        template = self.load_template()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            self.output_files = list(executor.map(lambda k: self.write_slice(template, labels, k), range(len(labels))))
+        return self.output_files
+
+    def write_seg(self, labels, file_name='seg.dcm'):
+        """ Writes label volume as single DICOM SEG object with one segment per tissue present
+        :param labels Label volume (N, rows, cols) or list of label images or .npy files
+        :param file_name Output file name
+        """
+        import highdicom as hd
+        from pydicom.sr.codedict import codes
+        if not self.check_inputs(labels):
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        source_images = [pydicom.dcmread(f, stop_before_pixels=True) for f in self.dcm_file_paths]
+        shape = (source_images[0].Rows, source_images[0].Columns)
+        volume = np.stack([self.load_labels(labels, k, shape) for k in range(len(labels))])
+        present = np.flatnonzero(LabelMap.count(volume))
+        segments = [segment for segment in DicomSeriesWriter.SEG_SEGMENTS if segment[0] in present]
+        # Segment numbers are 1, 2, ... in the order of SEG_SEGMENTS, all other labels become background
+        mapping = {label: 0 for label in range(256)}
+        mapping.update({segment[0]: i + 1 for i, segment in enumerate(segments)})
+        volume = LabelMap(mapping).apply(volume)
+        algorithm = hd.AlgorithmIdentificationSequence(
+            name='barbell2', version='1.0', family=codes.cid7162.ArtificialIntelligence)
+        descriptions = [
+            hd.seg.SegmentDescription(
+                segment_number=i + 1,
+                segment_label=segment[1],
+                segmented_property_category=codes.SCT.Tissue,
+                segmented_property_type=getattr(codes.SCT, segment[2]),
+                algorithm_type=hd.seg.SegmentAlgorithmTypeValues.AUTOMATIC,
+                algorithm_identification=algorithm,
+            ) for i, segment in enumerate(segments)
+        ]
+        seg = hd.seg.Segmentation(
+            source_images=source_images,
+            pixel_array=volume,
+            segmentation_type=hd.seg.SegmentationTypeValues.BINARY,
+            segment_descriptions=descriptions,
+            series_instance_uid=generate_uid(),
+            series_number=self.series_number if self.series_number is not None else 1000,
+            sop_instance_uid=generate_uid(),
+            instance_number=1,
+            manufacturer='barbell2',
+            manufacturer_model_name='MuscleFatSegmentator',
+            software_versions='1.0',
+            device_serial_number='1',
+            series_description=self.series_description,
+        )
+        f_path = os.path.join(self.output_dir, file_name)
+        seg.save_as(f_path)
+        self.output_files = [f_path]
+        return self.output_files
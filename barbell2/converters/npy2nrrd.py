@@ -1,5 +1,4 @@
 import numpy as np
-import nrrd
 
 
 class Numpy2Nrrd:
@@ -10,6 +9,7 @@ class Numpy2Nrrd:
         self.index_order = 'C'
 
     def execute(self):
+        import nrrd
         if isinstance(self.npy_array_or_file_path, str):
             npy_array = np.load(self.npy_array_or_file_path)
         else:
@@ -1,8 +1,76 @@
 import os
+import zlib
+import struct
 import numpy as np
-import matplotlib.pyplot as plt
 
-from barbell2.utils import apply_color_map, get_alberta_color_map
+from concurrent.futures import ProcessPoolExecutor
+from barbell2.utils import apply_color_map, apply_window, get_color_map
+
+
+def encode_png(pixels, compression=6):
+    """ Encodes (rows, cols) grayscale or (rows, cols, 3) RGB uint8 image as PNG bytes using only zlib
+    """
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    if pixels.ndim == 2:
+        color_type, nr_channels = 0, 1
+    elif pixels.ndim == 3 and pixels.shape[2] == 3:
+        color_type, nr_channels = 2, 3
+    else:
+        raise ValueError(f'Cannot encode image of shape {pixels.shape} as PNG')
+    rows, cols = pixels.shape[:2]
+    # Each scanline starts with filter type 0 (none)
+    scanlines = np.zeros((rows, cols * nr_channels + 1), dtype=np.uint8)
+    scanlines[:, 1:] = pixels.reshape(rows, -1)
+
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', cols, rows, 8, color_type, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(scanlines.tobytes(), compression)),
+        chunk(b'IEND', b''),
+    ])
+
+
+def render(labels=None, image=None, color_map='alberta', window=(400, 50), alpha=0.5):
+    """ Returns uint8 image to be saved as PNG. The image (in HU) is windowed to grayscale and
+    the labels are mapped to RGB with the color map. If both are given, labels > 0 are blended
+    over the image with given alpha
+    """
+    if image is not None:
+        image = np.asarray(image, dtype=np.float32)
+        if window is not None:
+            gray = apply_window(image, window)
+        else:
+            gray = (image - np.min(image)) / max(float(np.max(image) - np.min(image)), 1e-6)
+        gray = (gray * 255 + 0.5).astype(np.uint8)
+        if labels is None:
+            return gray
+        rgb = np.repeat(gray[..., np.newaxis], 3, axis=-1)
+        overlay = apply_color_map(labels, color_map)
+        mask = labels > 0
+        rgb[mask] = (alpha * overlay[mask] + (1 - alpha) * rgb[mask] + 0.5).astype(np.uint8)
+        return rgb
+    if labels is None:
+        raise ValueError('Labels or image required')
+    return apply_color_map(labels, color_map)
+
+
+def load_dicom_image(f_path):
+    import pydicom
+    from barbell2.utils import get_pixels
+    return get_pixels(pydicom.dcmread(f_path), normalize=True)
+
+
+def render_file(npy_file, png_file, image_file=None, color_map='alberta', window=(400, 50), alpha=0.5):
+    """ Renders NumPy label file (optionally over DICOM image) as PNG. Runs in worker processes
+    """
+    labels = np.load(npy_file)
+    image = load_dicom_image(image_file) if image_file is not None else None
+    with open(png_file, 'wb') as f:
+        f.write(encode_png(render(labels, image, color_map, window, alpha)))
+    return png_file
 
 
 class Numpy2Png:
@@ -15,6 +83,9 @@ class Numpy2Png:
         self.color_map = None
         self.output_dir = '..'
         self.window = [400, 50]
+        self.image = None               # Optional image (array or DICOM file) to blend labels over
+        self.alpha = 0.5
+        self.use_matplotlib = False     # Render with matplotlib figure instead of encoding PNG directly
 
     def set_png_file_name(self, png_file_name):
         self.png_file_name = png_file_name
@@ -26,19 +97,39 @@ class Numpy2Png:
         self.output_dir = output_dir
 
     def set_color_map(self, color_map):
-        if isinstance(color_map, str) and color_map == 'alberta':
-            self.color_map = get_alberta_color_map()
-        else:
-            self.color_map = color_map
+        self.color_map = get_color_map(color_map) if color_map is not None else None
 
     def set_window(self, window):
         self.window = window
 
+    def set_image(self, image):
+        self.image = image
+
+    def set_alpha(self, alpha):
+        self.alpha = alpha
+
     def execute(self):
         if isinstance(self.npy_array_or_file_path, str):
             npy_array = np.load(self.npy_array_or_file_path)
         else:
             npy_array = self.npy_array_or_file_path
+        self.png_file_path = os.path.join(self.output_dir, self.png_file_name)
+        if self.use_matplotlib:
+            self.execute_matplotlib(npy_array)
+            return
+        if self.image is not None:
+            image = load_dicom_image(self.image) if isinstance(self.image, str) else self.image
+            color_map = self.color_map if self.color_map is not None else 'alberta'
+            pixels = render(npy_array, image, color_map, self.window, self.alpha)
+        elif self.color_map is not None:
+            pixels = render(npy_array, None, self.color_map)
+        else:
+            pixels = render(None, npy_array, window=self.window)
+        with open(self.png_file_path, 'wb') as f:
+            f.write(encode_png(pixels))
+
+    def execute_matplotlib(self, npy_array):
+        import matplotlib.pyplot as plt
         if self.color_map is not None:
             npy_array = apply_color_map(npy_array, self.color_map)
         fig = plt.figure(figsize=self.png_figure_size)
@@ -48,10 +139,47 @@ class Numpy2Png:
         else:
             plt.imshow(npy_array, cmap='gray')
         ax.axis('off')
-        self.png_file_path = os.path.join(self.output_dir, self.png_file_name)
         plt.savefig(self.png_file_path, bbox_inches='tight')
         plt.close('all')
 
+    @staticmethod
+    def render_many(npy_files, output_dir, image_files=None, color_map='alberta', window=(400, 50), alpha=0.5, workers=None):
+        """ Renders NumPy label files <name>.npy as <output_dir>/<name>.png across a process pool.
+        Returns list of PNG files (None for files that failed)
+        :param npy_files NumPy label files (e.g., *.seg.npy)
+        :param output_dir Output directory
+        :param image_files Optional DICOM files to blend labels over (same order as npy_files)
+        :param workers Number of worker processes (default: number of CPUs)
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        if image_files is None:
+            image_files = [None] * len(npy_files)
+        png_files = [os.path.join(output_dir, os.path.splitext(os.path.split(f)[1])[0] + '.png') for f in npy_files]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(render_file, npy_file, png_file, image_file, color_map, window, alpha)
+                for npy_file, png_file, image_file in zip(npy_files, png_files, image_files)
+            ]
+            results = []
+            for npy_file, future in zip(npy_files, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f'Could not render {npy_file}: {e}')
+                    results.append(None)
+        return results
+
+    @staticmethod
+    def render_directory(input_dir, output_dir, image_dir=None, **kwargs):
+        """ Renders all *.seg.npy files in input_dir. If image_dir is given, each <name>.seg.npy
+        is blended over DICOM file <image_dir>/<name>
+        """
+        npy_files = sorted([os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith('.seg.npy')])
+        image_files = None
+        if image_dir is not None:
+            image_files = [os.path.join(image_dir, os.path.split(f)[1][:-len('.seg.npy')]) for f in npy_files]
+        return Numpy2Png.render_many(npy_files, output_dir, image_files, **kwargs)
+
 
 if __name__ == '__main__':
     # pixels = np.load('/Users/Ralph/Desktop/output-segmentl3/1_pred.npy')
@@ -3,6 +3,7 @@ import pydicom
 
 from barbell2.utils import create_fake_dicom
 from barbell2.converters.tag2npy import Tag2Numpy
+from barbell2.converters.npy2dcm import DicomSeriesWriter
 
 
 class Tag2Dicom:
@@ -28,3 +29,19 @@ class Tag2Dicom:
         self.tag_dcm_file_name = os.path.split(self.tag_file_path)[1] + '.dcm'
         self.tag_dcm_file_path = os.path.join(self.output_dir, self.tag_dcm_file_name)
         p_new.save_as(self.tag_dcm_file_path)
+
+    @staticmethod
+    def convert_many(tag_file_paths, dcm_file_paths, output_dir, workers=8):
+        """ Converts TAG files of a single series to RGB overlay DICOM files in one call. The
+        header of the first DICOM file is parsed once and used as template for all slices
+        (see DicomSeriesWriter). Returns list of output files
+        :param tag_file_paths TAG files
+        :param dcm_file_paths Corresponding DICOM files (same order)
+        :param output_dir Output directory
+        :param workers Number of threads writing files
+        """
+        writer = DicomSeriesWriter()
+        writer.dcm_file_paths = dcm_file_paths
+        writer.output_dir = output_dir
+        writer.workers = workers
+        return writer.write_overlay_series(tag_file_paths)
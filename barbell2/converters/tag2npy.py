@@ -1,4 +1,23 @@
-from barbell2.utils import get_tag_pixels
+import os
+import argparse
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from barbell2.utils import get_tag_pixels, is_tag_file
+
+
+def convert_tag_file(tag_file_path, shape=None, overwrite=False):
+    """ Converts a single TAG file to a NumPy sidecar file next to it. The sidecar gets the
+    same base name as the TAG file so get_numpy_file_for_dicom() finds it for the corresponding
+    DICOM file (<name>.tag -> <name>.npy, <name>.dcm.tag -> <name>.dcm.npy). Existing NumPy
+    files are kept unless overwrite is True, so interrupted runs can be resumed
+    """
+    npy_file_path = os.path.splitext(tag_file_path)[0] + '.npy'
+    if not overwrite and os.path.isfile(npy_file_path):
+        return tag_file_path, npy_file_path
+    t2n = Tag2Numpy(tag_file_path, shape)
+    np.save(npy_file_path, t2n.execute())
+    return tag_file_path, npy_file_path
 
 
 class Tag2Numpy:
@@ -13,3 +32,53 @@ class Tag2Numpy:
         if self.shape is not None:
             self.npy_array = self.npy_array.reshape(self.shape)
         return self.npy_array
+
+    @staticmethod
+    def convert_many(tag_file_paths, shape=None, workers=None, overwrite=False):
+        """ Converts TAG files to NumPy sidecar files across a process pool. Yields tuples
+        (tag_file_path, npy_file_path, error) in the order in which conversions finish
+        :param tag_file_paths List of TAG file paths
+        :param shape Shape of the label arrays, e.g., (512, 512)
+        :param workers Number of worker processes (default: number of CPUs)
+        :param overwrite Overwrite existing NumPy files (default: keep them, same as the CLI without --overwrite)
+        """
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for tag_file_path in tag_file_paths:
+                future = executor.submit(convert_tag_file, tag_file_path, shape, overwrite)
+                futures[future] = tag_file_path
+            for future in as_completed(futures):
+                tag_file_path = futures[future]
+                try:
+                    _, npy_file_path = future.result()
+                    yield tag_file_path, npy_file_path, None
+                except Exception as e:
+                    yield tag_file_path, None, e
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', help='Input directory', default='.')
+    parser.add_argument('--rows', help='Nr. of rows in images', type=int, default=512)
+    parser.add_argument('--cols', help='Nr. of columns in images', type=int, default=512)
+    parser.add_argument('--workers', help='Nr. of worker processes', type=int, default=None)
+    parser.add_argument('--overwrite', help='Overwrite existing NumPy files', action='store_true')
+    args = parser.parse_args()
+    tag_file_paths = []
+    for root, dirs, files in os.walk(args.input_dir):
+        for f in files:
+            if is_tag_file(f):
+                tag_file_paths.append(os.path.join(root, f))
+    nr_errors = 0
+    for tag_file_path, npy_file_path, error in Tag2Numpy.convert_many(
+            tag_file_paths, (args.rows, args.cols), args.workers, args.overwrite):
+        if error is not None:
+            print(f'[ERROR] {tag_file_path}: {error}')
+            nr_errors += 1
+        else:
+            print(npy_file_path)
+    print(f'Converted {len(tag_file_paths) - nr_errors} TAG files ({nr_errors} errors)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
 import os
 import time
 import math
+import queue
 import datetime
 import struct
 import binascii
+import threading
 import numpy as np
 
 
@@ -61,6 +63,51 @@ def duration(seconds):
     return '{} hours, {} minutes, {} seconds'.format(h, m, s)
 
 
+def iter_prefetched(items, max_size):
+    """ Yields items of an iterable in order while a background thread produces them, at most
+    max_size items ahead of the consumer. Exceptions raised while producing are re-raised in the
+    consumer. If the consumer stops early, the producer stops too
+    :param items Iterable (e.g., generator) consumed on the background thread
+    :param max_size Max. nr. of items produced ahead of the consumer
+    """
+    buffer = queue.Queue(maxsize=max_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((None, e))
+            return
+        put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
 def is_dicom_file(file_path_or_obj):
     file_obj = file_path_or_obj
     if isinstance(file_obj, str):
@@ -114,6 +161,24 @@ def get_pixels(p, normalize=False):
 
 
 def get_tag_pixels(tag_file_path):
+    with open(tag_file_path, 'rb') as f:
+        data = f.read()
+    # Header ends at the first form feed (0x0c) byte
+    i = data.find(b'\x0c')
+    if i < 0:
+        return np.zeros(0, dtype=np.uint16)
+    # Mirror get_tag_pixels_bytewise() exactly: the byte following the form feed is
+    # skipped and the form feed itself (12) ends up as the first value
+    values = np.empty(max(1, len(data) - i - 1), dtype=np.uint16)
+    values[0] = 12
+    values[1:] = np.frombuffer(data, dtype=np.int8, offset=min(i + 2, len(data))).astype(np.uint16)
+    return values.reshape(-1, 1)
+
+
+def get_tag_pixels_bytewise(tag_file_path):
+    """ Reference implementation of get_tag_pixels() that reads the file byte by byte. Slow
+    but kept around to cross-check the vectorized decoder.
+    """
     f = open(tag_file_path, 'rb')
     f.seek(0)
     byte = f.read(1)
@@ -134,38 +199,171 @@ def get_tag_pixels(tag_file_path):
     return values
 
 
-def get_alberta_color_map():
-    color_map = []
-    for i in range(256):
-        if i == 1:  # muscle
-            color_map.append([255, 0, 0])
-        elif i == 2:  # inter-muscular adipose tissue
-            color_map.append([0, 255, 0])
-        elif i == 5:  # visceral adipose tissue
-            color_map.append([255, 255, 0])
-        elif i == 7:  # subcutaneous adipose tissue
-            color_map.append([0, 255, 255])
-        elif i == 12:  # unknown
-            color_map.append([0, 0, 255])
-        else:
-            color_map.append([0, 0, 0])
+def create_color_map(colors):
+    """ Returns read-only (256, 3) uint8 color map
+    :param colors Dictionary {label: [r, g, b]} (other labels are black) or list of 256 [r, g, b] values
+    """
+    color_map = np.zeros((256, 3), dtype=np.uint8)
+    if isinstance(colors, dict):
+        for label, color in colors.items():
+            color_map[int(label)] = color
+    else:
+        colors = np.asarray(colors, dtype=np.uint8)
+        if colors.shape != (256, 3):
+            raise ValueError(f'Color map must have shape (256, 3), not {colors.shape}')
+        color_map[:] = colors
+    color_map.flags.writeable = False
     return color_map
 
 
+COLOR_MAPS = {
+    'alberta': create_color_map({
+        1: [255, 0, 0],         # muscle
+        2: [0, 255, 0],         # inter-muscular adipose tissue
+        5: [255, 255, 0],       # visceral adipose tissue
+        7: [0, 255, 255],       # subcutaneous adipose tissue
+        12: [0, 0, 255],        # unknown
+    }),
+}
+
+
+def register_color_map(name, colors):
+    COLOR_MAPS[name] = create_color_map(colors)
+    return COLOR_MAPS[name]
+
+
+def load_color_map(json_file, name=None):
+    """ Loads color map from JSON file containing {"label": [r, g, b], ...} or a list of 256
+    [r, g, b] values and registers it under given name (default: file name without extension)
+    """
+    import json
+    with open(json_file, 'r') as f:
+        colors = json.load(f)
+    if name is None:
+        name = os.path.splitext(os.path.split(json_file)[1])[0]
+    return register_color_map(name, colors)
+
+
+def get_color_map(color_map):
+    """ Returns (256, 3) uint8 color map for given name, list or array
+    """
+    if isinstance(color_map, str):
+        if color_map not in COLOR_MAPS:
+            raise KeyError(f'Unknown color map {color_map} (available: {list(COLOR_MAPS.keys())})')
+        return COLOR_MAPS[color_map]
+    if isinstance(color_map, np.ndarray) and color_map.shape == (256, 3) and color_map.dtype == np.uint8:
+        return color_map
+    return create_color_map(color_map)
+
+
+def get_alberta_color_map():
+    return COLOR_MAPS['alberta']
+
+
+class LabelMap:
+    """ Maps label values through a precomputed lookup table, so any remap of a label image (or a
+    stack of label images) is a single np.take(). Label values must be in the range 0-255.
+    Optionally holds the set of valid labels and the labels that must be present, which are
+    checked with a single np.bincount()
+    """
+    def __init__(self, mapping=None, valid_labels=None, required_labels=None):
+        """ Creates lookup table
+        :param mapping Dictionary {label: new label}. Labels not in mapping are left as they are
+        :param valid_labels Labels that may occur in label images (None = all labels)
+        :param required_labels Labels that must occur in label images
+        """
+        self.mapping = mapping or {}
+        self.valid_labels = valid_labels
+        self.required_labels = required_labels or []
+        self.lut = np.arange(256, dtype=np.uint8)
+        for label, new_label in self.mapping.items():
+            self.lut[label] = new_label
+        self.lut.flags.writeable = False
+        self.luts = {self.lut.dtype: self.lut}
+
+    def get_lut(self, dtype):
+        # np.take() only writes into an output array of the same dtype as the lookup table
+        dtype = np.dtype(dtype)
+        if dtype not in self.luts:
+            self.luts[dtype] = self.lut.astype(dtype)
+        return self.luts[dtype]
+
+    @staticmethod
+    def check_range(pixels, max_label=255):
+        """ Raises ValueError naming the labels below 0 or above max_label (None = no maximum)
+        """
+        if pixels.dtype == np.uint8 or pixels.dtype == np.bool_ or pixels.size == 0:
+            return
+        too_large = max_label is not None and pixels.max() > max_label
+        if pixels.min() < 0 or too_large:
+            invalid = (pixels < 0) if max_label is None else (pixels < 0) | (pixels > max_label)
+            labels = np.unique(pixels[invalid]).tolist()
+            valid_range = '>= 0' if max_label is None else f'0-{max_label}'
+            raise ValueError(f'Labels {labels} outside valid range {valid_range}')
+
+    @staticmethod
+    def count(pixels):
+        """ Returns nr. of pixels for each label value (array of length >= 256)
+        """
+        pixels = np.asarray(pixels)
+        LabelMap.check_range(pixels, max_label=None)
+        return np.bincount(pixels.ravel(), minlength=256)
+
+    def validate(self, pixels, counts=None):
+        """ Returns tuple (dictionary {unexpected label: nr. of pixels}, list of missing required labels)
+        """
+        if counts is None:
+            counts = self.count(pixels)
+        present = np.flatnonzero(counts)
+        unexpected = {}
+        if self.valid_labels is not None:
+            for label in present[~np.isin(present, self.valid_labels)]:
+                unexpected[int(label)] = int(counts[label])
+        missing = [label for label in self.required_labels if label >= len(counts) or counts[label] == 0]
+        return unexpected, missing
+
+    def apply(self, pixels, out=None):
+        """ Returns remapped labels as uint8 array, or writes them into out (which can be pixels
+        itself, e.g., to remap a whole stack of slices in place)
+        """
+        pixels = np.asarray(pixels)
+        self.check_range(pixels, len(self.lut) - 1)
+        if out is None:
+            return np.take(self.lut, pixels)
+        return np.take(self.get_lut(out.dtype), pixels, out=out)
+
+
+# http://www.tomovision.com/Sarcopenia_Help/index.htm
+ALBERTA_LABELS = {
+    0: 'background',
+    1: 'muscle',
+    2: 'inter-muscular adipose tissue',
+    5: 'visceral adipose tissue',
+    7: 'subcutaneous adipose tissue',
+    12: 'unknown',
+    14: 'unknown',
+}
+ALBERTA_LABELS_TO_KEEP = [0, 1, 5, 7]
+ALBERTA_LABELS_TO_REMOVE = [2, 12, 14]
+ALBERTA_LABEL_MAP = LabelMap(
+    mapping={label: 0 for label in ALBERTA_LABELS_TO_REMOVE},
+    valid_labels=list(ALBERTA_LABELS.keys()),
+    required_labels=ALBERTA_LABELS_TO_KEEP,
+)
+
+
 def update_labels(pixels):
-    # http://www.tomovision.com/Sarcopenia_Help/index.htm
-    labels_to_keep = [0, 1, 5, 7]
-    labels_to_remove = [2, 12, 14]
-    for label in np.unique(pixels):
-        if label in labels_to_remove:
-            pixels[pixels == label] = 0
-    for label in np.unique(pixels):
-        if label not in labels_to_keep:
-            return None
-    if len(np.unique(pixels)) != 4:
-        print('Incorrect nr. of labels: {}'.format(len(np.unique(pixels))))
+    """ Removes labels 2, 12 and 14 (in place). Returns None if pixels contain labels outside the
+    Alberta protocol or not all of labels 0, 1, 5 and 7
+    """
+    unexpected, missing = ALBERTA_LABEL_MAP.validate(pixels)
+    if len(unexpected) > 0:
+        print('Unexpected labels (label: nr. of pixels): {}'.format(unexpected))
         return None
-    return pixels
+    if len(missing) > 0:
+        print('Missing labels: {}'.format(missing))
+        return None
+    return ALBERTA_LABEL_MAP.apply(pixels, out=pixels)
 
 
 def apply_window(pix, window):
@@ -175,14 +373,20 @@ def apply_window(pix, window):
     return result
 
 
-def apply_color_map(pixels, color_map):
-    pixels_new = np.zeros((*pixels.shape, 3), dtype=np.uint8)
-    np.take(color_map, pixels, axis=0, out=pixels_new)
-    return pixels_new
+def apply_color_map(pixels, color_map='alberta', out=None):
+    """ Returns RGB image(s) of shape (*pixels.shape, 3) for label image or stack of label images
+    :param pixels Label image(s) with values 0-255
+    :param color_map Color map name, list or (256, 3) array (see get_color_map())
+    :param out Optional uint8 output buffer of shape (*pixels.shape, 3)
+    """
+    if out is None:
+        out = np.empty((*pixels.shape, 3), dtype=np.uint8)
+    np.take(get_color_map(color_map), pixels, axis=0, out=out)
+    return out
 
 
-def create_fake_dicom(pixels, dcm_obj):
-    pixels_new = apply_color_map(pixels, get_alberta_color_map())
+def create_fake_dicom(pixels, dcm_obj, color_map='alberta'):
+    pixels_new = apply_color_map(pixels, color_map)
     dcm_obj.PhotometricInterpretation = 'RGB'
     dcm_obj.SamplesPerPixel = 3
     dcm_obj.BitsAllocated = 8
@@ -216,3 +420,58 @@ def calculate_mean_radiation_attenuation(image, labels, label):
         print('Sum of mask pixels is zero, return zero radiation attenuation')
         mean_ra = 0.0
     return mean_ra
+
+
+def calculate_label_statistics(image, labels, pixel_spacing, labels_to_measure=None):
+    """ Calculates area (cm2), mean and standard deviation of radiation attenuation and pixel
+    count for each label using np.bincount (one pass for counts and means, one for deviations).
+    Accepts a single slice (rows, cols) or a stack of slices (N, rows, cols). In the latter case
+    pixel spacing can be given per slice as an (N, 2) array and each statistic is returned as an
+    array of length N
+    :param image Image pixels (normalized to HU)
+    :param labels Label pixels (non-negative integers) with the same shape as image
+    :param pixel_spacing Pixel spacing (row, col) in mm, either (2,) or (N, 2)
+    :param labels_to_measure Labels to return statistics for (default: all labels present)
+    """
+    labels = np.asarray(labels)
+    image = np.asarray(image, dtype=np.float64)
+    if labels.shape != image.shape:
+        raise ValueError(f'Shape of labels {labels.shape} does not match shape of image {image.shape}')
+    single_slice = labels.ndim == 2
+    if single_slice:
+        labels = labels[np.newaxis]
+        image = image[np.newaxis]
+    nr_slices = labels.shape[0]
+    labels = labels.reshape(nr_slices, -1).astype(np.intp, copy=False)
+    image = image.reshape(nr_slices, -1)
+    nr_bins = int(labels.max()) + 1 if labels.size > 0 else 1
+    if labels_to_measure is not None and len(labels_to_measure) > 0:
+        nr_bins = max(nr_bins, int(max(labels_to_measure)) + 1)
+    # Give each slice its own range of bins so a single bincount covers the whole stack
+    bins = (labels + np.arange(nr_slices)[:, np.newaxis] * nr_bins).ravel()
+    size = nr_slices * nr_bins
+    counts = np.bincount(bins, minlength=size).reshape(nr_slices, nr_bins)
+    sums = np.bincount(bins, weights=image.ravel(), minlength=size).reshape(nr_slices, nr_bins)
+    means = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    # Second pass over deviations from the label means; E[x^2] - mean^2 cancels badly for large HU values
+    deviations = image.ravel() - means.ravel()[bins]
+    sums_sq = np.bincount(bins, weights=np.square(deviations), minlength=size).reshape(nr_slices, nr_bins)
+    stds = np.sqrt(np.divide(sums_sq, counts, out=np.zeros_like(sums_sq), where=counts > 0))
+    pixel_spacing = np.asarray(pixel_spacing, dtype=np.float64).reshape(-1, 2)
+    pixel_areas = pixel_spacing[:, 0] * pixel_spacing[:, 1] / 100.0
+    areas = counts * pixel_areas[:, np.newaxis]
+    if labels_to_measure is None:
+        labels_to_measure = np.nonzero(counts.sum(axis=0))[0]
+    statistics = {}
+    for label in labels_to_measure:
+        label = int(label)
+        statistics[label] = {
+            'area': areas[:, label],
+            'mean_ra': means[:, label],
+            'std_ra': stds[:, label],
+            'count': counts[:, label],
+        }
+        if single_slice:
+            for k in statistics[label].keys():
+                statistics[label][k] = statistics[label][k][0].item()
+    return statistics
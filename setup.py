@@ -35,15 +35,13 @@ test_requirements = []
 setup(
     author="Ralph Brecheisen",
     author_email='ralph.brecheisen@gmail.com',
-    python_requires='>=3.5',
+    python_requires='>=3.7',
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
     ],
@@ -62,6 +60,7 @@ setup(
             'bodycomp-decompdcm=barbell2.bodycomp.decompdcm:main',
             'bodycomp-flattendirs=barbell2.bodycomp.flattendirs:main',
             'bodycomp-copyfiles=barbell2.bodycomp.copyfiles:main',
+            'converters-tag2npy=barbell2.converters.tag2npy:main',
             'castor-buildimport=barbell2.castor.buildimport:main',
         ],
     },
@@ -0,0 +1,322 @@
+import os
+import json
+import math
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import requests
+import tracemalloc
+
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from barbell2.castor.api import CastorApiClient
+from barbell2.castor.cache import ResponseCache
+
+
+EXPORT_ROWS = [['Column {}'.format(i) for i in range(9)]] + [
+    ['Study', f'R{i:05d}', 'Study', '', '', f'F{i % 7}', f'value;{i}\n"é"', '', ''] for i in range(20000)]
+
+
+def get_export_data():
+    lines = []
+    for row in EXPORT_ROWS:
+        lines.append(';'.join(['"' + value.replace('"', '""') + '"' if ';' in value or '\n' in value else value for value in row]))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+RECORDS = [{'id': f'ARCHIVED-{i:03d}' if i % 10 == 3 else f'{i:03d}'} for i in range(95)]
+FIELDS = [{'id': f'FID{j}', 'field_variable_name': f'var{j}', 'field_type': 'string'} for j in range(5)]
+
+
+def get_data_points(record_id):
+    # Some fields have no value, the last field uses the older 'value' key
+    return [{'field_id': f'FID{j}', 'field_value' if j < 4 else 'value': f'{record_id}-{j}'}
+            for j in range(5) if (int(record_id[-3:]) + j) % 4 != 0]
+
+
+class CastorHandler(BaseHTTPRequestHandler):
+    """ Minimal stand-in for the Castor API. Only tokens in server.valid_tokens are accepted
+    """
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, data, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_page(self, url, embedded_key, items):
+        query = parse_qs(url.query)
+        page, page_size = int(query['page'][0]), int(query['page_size'][0])
+        with self.server.lock:
+            self.server.page_requests.append((url.path, page, page_size))
+            self.server.nr_active += 1
+            self.server.max_active = max(self.server.max_active, self.server.nr_active)
+        # Later pages are answered faster, so they complete before earlier ones
+        time.sleep(0.005 * max(0, 6 - page))
+        with self.server.lock:
+            self.server.nr_active -= 1
+        self.send_body(json.dumps({
+            'page_count': max(1, math.ceil(len(items) / page_size)),
+            '_embedded': {embedded_key: items[(page - 1) * page_size:page * page_size]},
+        }).encode())
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.nr_tokens += 1
+        token = f'token{self.server.nr_tokens}'
+        self.server.valid_tokens.add(token)
+        self.send_body(json.dumps({'access_token': token, 'token_type': 'Bearer', 'expires_in': 3600}).encode())
+
+    def do_GET(self):
+        if self.headers.get('Authorization', '')[len('Bearer '):] not in self.server.valid_tokens:
+            self.send_response(401)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        url = urlparse(self.path)
+        if url.path == '/api/study/S1/record':
+            self.send_page(url, 'records', RECORDS)
+        elif url.path == '/api/study/S1/field':
+            self.send_page(url, 'fields', FIELDS)
+        elif url.path.startswith('/api/study/S1/participant/') and url.path.endswith('/data-points/study'):
+            self.send_page(url, 'items', get_data_points(url.path.split('/')[5]))
+        elif self.path == '/api/study':
+            self.send_body(json.dumps({'_embedded': {'study': [{'name': 'Study', 'study_id': 'S1'}]}}).encode())
+        elif self.path == '/api/study/S1/export/data':
+            # Sent with Content-Length (not chunked), so urllib3 knows when the body is complete
+            self.send_body(get_export_data(), 'text/csv; charset=utf-8')
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+
+class TestCastorApiClient(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # OAuth2Session refuses plain HTTP token URLs unless this is set
+        cls.insecure_transport = os.environ.get('OAUTHLIB_INSECURE_TRANSPORT')
+        os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), CastorHandler)
+        cls.server.nr_tokens = 0
+        cls.server.valid_tokens = set()
+        cls.server.lock = threading.Lock()
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        base_url = f'http://127.0.0.1:{cls.server.server_port}'
+        cls.client_class = type('LocalCastorApiClient', (CastorApiClient,), {
+            'base_url': base_url,
+            'token_url': base_url + '/oauth/token',
+            'api_url': base_url + '/api',
+        })
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        if cls.insecure_transport is None:
+            del os.environ['OAUTHLIB_INSECURE_TRANSPORT']
+        else:
+            os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = cls.insecure_transport
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.server.nr_tokens = 0
+        self.server.valid_tokens.clear()
+        self.server.page_requests = []
+        self.server.nr_active = 0
+        self.server.max_active = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def save_token(self, access_token, expires_in=3600):
+        ResponseCache(self.cache_dir).save_token('client', {
+            'access_token': access_token,
+            'token_type': 'Bearer',
+            'expires_in': expires_in,
+            'expires_at': time.time() + expires_in,
+        })
+
+    def create_client(self, **kwargs):
+        self.server.valid_tokens.add('cached')
+        self.save_token('cached')
+        return self.client_class('client', 'secret', cache_dir=self.cache_dir, **kwargs)
+
+    def test_cached_token(self):
+        self.save_token('cached')
+        self.server.valid_tokens.add('cached')
+        client = self.client_class('client', 'secret', cache_dir=self.cache_dir)
+        self.assertEqual(client.studies[0]['study_id'], 'S1')
+        self.assertEqual(self.server.nr_tokens, 0)
+
+    def test_rejected_cached_token(self):
+        self.save_token('revoked')
+        client = self.client_class('client', 'secret', cache_dir=self.cache_dir)
+        self.assertEqual(client.studies[0]['study_id'], 'S1')
+        self.assertEqual(self.server.nr_tokens, 1)
+        self.assertEqual(ResponseCache(self.cache_dir).load_token('client')['access_token'], 'token1')
+        self.assertEqual(client.get_cached(client.api_url + '/study', refresh=True), client.get_cached(client.api_url + '/study'))
+        self.assertEqual(self.server.nr_tokens, 1)
+
+    def test_nearly_expired_cached_token(self):
+        # A cached token that expires within minutes is not reused for a (possibly long) run
+        self.save_token('cached', expires_in=120)
+        self.server.valid_tokens.add('cached')
+        client = self.client_class('client', 'secret', cache_dir=self.cache_dir)
+        self.assertEqual(client.studies[0]['study_id'], 'S1')
+        self.assertEqual(self.server.nr_tokens, 1)
+        self.assertEqual(ResponseCache(self.cache_dir).load_token('client')['access_token'], 'token1')
+
+    def test_token_expired_during_run(self):
+        for cache in [True, False]:
+            with self.subTest(cache=cache):
+                client = self.create_client(cache=cache)
+                client.max_page_size = 10
+                nr_tokens = self.server.nr_tokens
+                # Token expires while pages are fetched, oauthlib then refuses to send the request
+                client.session.token = dict(client.session.token, expires_in=-1, expires_at=time.time() - 1)
+                self.assertEqual(len(client.get_pages(client.api_url + '/study/S1/record', 'records')), len(RECORDS))
+                self.assertEqual(self.server.nr_tokens, nr_tokens + 1)
+                self.assertEqual(client.session.token['access_token'], f'token{nr_tokens + 1}')
+                if cache:
+                    self.assertEqual(ResponseCache(self.cache_dir).load_token('client')['access_token'], 'token1')
+
+    def test_rejected_new_token(self):
+        # A freshly fetched token that is rejected is not renewed again
+        self.save_token('revoked')
+        client = self.client_class('client', 'secret', cache_dir=self.cache_dir)
+        self.server.valid_tokens.clear()
+        with self.assertRaises(requests.HTTPError):
+            client.get_cached(client.api_url + '/study', refresh=True)
+        self.assertEqual(self.server.nr_tokens, 1)
+
+    def test_get_pages(self):
+        client = self.create_client(max_workers=4)
+        client.max_page_size = 10
+        records = client.get_records('S1')
+        self.assertEqual(records, [record for record in RECORDS if not record['id'].startswith('ARCHIVED')])
+        # Page 1 is requested once (first) and reused for the page count
+        self.assertEqual(self.server.page_requests[0][1], 1)
+        self.assertEqual(sorted(page for _, page, _ in self.server.page_requests), list(range(1, 11)))
+        self.assertEqual({page_size for _, _, page_size in self.server.page_requests}, {10})
+        self.assertGreater(self.server.max_active, 1)
+        self.assertLessEqual(self.server.max_active, 4)
+
+    def test_get_pages_sequential(self):
+        client = self.create_client()
+        client.max_page_size = 10
+        self.assertEqual(client.get_pages(client.api_url + '/study/S1/record', 'records', max_workers=1), RECORDS)
+        self.assertEqual([page for _, page, _ in self.server.page_requests], list(range(1, 11)))
+        self.assertEqual(self.server.max_active, 1)
+
+    def test_get_pages_single_page(self):
+        client = self.create_client()
+        self.assertEqual(client.get_pages(client.api_url + '/study/S1/record', 'records'), RECORDS)
+        self.assertEqual(self.server.page_requests, [('/api/study/S1/record', 1, CastorApiClient.max_page_size)])
+
+    def get_expected_values(self, record_id, field_names):
+        values = {item['field_id']: item.get('field_value', item.get('value')) for item in get_data_points(record_id)}
+        return [values.get('FID' + name[len('var'):], '') for name in field_names]
+
+    def test_get_records_field_data(self):
+        client = self.create_client(max_workers=4)
+        client.max_page_size = 2
+        df = client.get_records_field_data('S1')
+        record_ids = [record['id'] for record in RECORDS if not record['id'].startswith('ARCHIVED')]
+        field_names = [field['field_variable_name'] for field in FIELDS]
+        self.assertEqual(df.index.name, 'record_id')
+        self.assertEqual(list(df.index), record_ids)
+        self.assertEqual(list(df.columns), field_names)
+        for record_id in record_ids:
+            self.assertEqual(list(df.loc[record_id]), self.get_expected_values(record_id, field_names))
+        # One paginated request per record (page size 2, so 2 or 3 pages), records fetched concurrently
+        data_requests = [request for request in self.server.page_requests if request[0].endswith('/data-points/study')]
+        self.assertEqual(
+            sorted((path, page) for path, page, _ in data_requests),
+            sorted((f'/api/study/S1/participant/{record_id}/data-points/study', page)
+                   for record_id in record_ids for page in range(1, math.ceil(len(get_data_points(record_id)) / 2) + 1)))
+        self.assertGreater(self.server.max_active, 1)
+        self.assertLessEqual(self.server.max_active, 4)
+
+    def test_get_records_field_data_selection(self):
+        client = self.create_client()
+        df = client.get_records_field_data('S1', field_names=['var3', 'var0'], record_ids=['004', '001'])
+        self.assertEqual(list(df.index), ['004', '001'])
+        self.assertEqual(list(df.columns), ['var3', 'var0'])
+        self.assertEqual(df.values.tolist(), [self.get_expected_values('004', ['var3', 'var0']), self.get_expected_values('001', ['var3', 'var0'])])
+        self.assertFalse(any(request[0].endswith('/record') for request in self.server.page_requests))
+
+    def test_get_records_field_data_unknown_field(self):
+        client = self.create_client()
+        with self.assertRaises(ValueError):
+            client.get_records_field_data('S1', field_names=['var0', 'unknown'])
+        self.assertFalse(any(request[0].endswith('/data-points/study') for request in self.server.page_requests))
+
+    def test_iter_study_data(self):
+        self.server.valid_tokens.add('cached')
+        self.save_token('cached')
+        client = self.client_class('client', 'secret', cache_dir=self.cache_dir)
+        self.assertEqual(list(client.iter_study_data('S1')), EXPORT_ROWS[1:])
+
+
+class ExportClient(CastorApiClient):
+    """ Client that generates a synthetic export/data stream instead of downloading it
+    """
+    def __init__(self, nr_records, nr_fields, extra_rows=()):
+        self.nr_records = nr_records
+        self.nr_fields = nr_fields
+        self.extra_rows = extra_rows
+
+    def iter_study_data(self, study_id):
+        for i in range(self.nr_records):
+            yield ['Study', f'R{i:06d}', '', '', '', '', '', '', '']
+            for j in range(self.nr_fields):
+                if (i + j) % 5 != 0:
+                    yield ['Study', f'R{i:06d}', 'Study', 'Phase', 'Step', f'FIELD-{j:04d}', f'{i * j % 997}.5', '01-01-2020 10:00:00', 'user']
+        yield from self.extra_rows
+
+    def get_field_defs(self, study_id):
+        return {f'FIELD-{j:04d}': (f'var{j}', 'string', '') for j in range(self.nr_fields)}
+
+
+class TestStudyData(unittest.TestCase):
+
+    def test_get_study_data_frame(self):
+        client = ExportClient(4, 3, extra_rows=[
+            ['Study', 'R000001', 'Study', '', '', 'FIELD-0000', 'last', '', ''],
+            ['Study', 'UNKNOWN', 'Study', '', '', 'FIELD-0000', 'ignored', '', ''],
+        ])
+        df = client.get_study_data_frame('S1', typed=False)
+        self.assertEqual(df.index.name, 'record_id')
+        self.assertEqual(list(df.index), ['R000000', 'R000001', 'R000002', 'R000003'])
+        self.assertEqual(list(df.columns), ['var0', 'var1', 'var2'])
+        self.assertEqual(df.values.tolist(), [
+            ['', '0.5', '0.5'],
+            ['last', '1.5', '2.5'],
+            ['0.5', '2.5', '4.5'],
+            ['0.5', '3.5', ''],
+        ])
+
+    def test_get_study_data_frame_memory(self):
+        import pandas  # noqa: F401 (imported before measuring)
+        client = ExportClient(2000, 60)
+        export_size = sum(len(';'.join(items)) + 1 for items in client.iter_study_data('S1'))
+        tracemalloc.start()
+        try:
+            df = client.get_study_data_frame('S1', typed=False)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(df.shape, (2000, 60))
+        # Only the values are kept (as Python strings), not the rows or a long-format copy
+        self.assertLess(peak, 2 * export_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
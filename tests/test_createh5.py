@@ -0,0 +1,98 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pydicom
+
+from unittest import mock
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+from barbell2.bodycomp import createh5
+from barbell2.bodycomp.trainingdata import TrainingDataset
+
+
+class TestCreateH5(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmp_dir, 'input')
+        os.makedirs(self.input_dir)
+        self.output_file = os.path.join(self.tmp_dir, 'output.h5')
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_pair(self, name):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        p = Dataset()
+        p.file_meta = meta
+        p.SOPClassUID = CTImageStorage
+        p.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        p.Rows, p.Columns = 8, 8
+        p.SamplesPerPixel = 1
+        p.PhotometricInterpretation = 'MONOCHROME2'
+        p.BitsAllocated, p.BitsStored, p.HighBit, p.PixelRepresentation = 16, 16, 15, 1
+        p.RescaleSlope, p.RescaleIntercept = 1, -1024
+        p.PixelData = self.rng.integers(0, 2000, (8, 8)).astype(np.int16).tobytes()
+        f_path = os.path.join(self.input_dir, f'{name}.dcm')
+        pydicom.dcmwrite(f_path, p, enforce_file_format=True)
+        # TAG decoder yields the form feed as first value and skips the byte after it
+        labels = self.rng.choice([0, 1, 5, 7], 8 * 8 - 1).astype(np.int8)
+        labels[:3] = [1, 5, 7]
+        with open(os.path.join(self.input_dir, f'{name}.tag'), 'wb') as f:
+            f.write(b'header\x0c\x00' + labels.tobytes())
+        return f_path
+
+    def run_main(self, *args):
+        argv = ['createh5', '--input_dir', self.input_dir, '--output_file', self.output_file,
+                '--rows', '8', '--cols', '8', '--workers', '2'] + list(args)
+        with mock.patch.object(sys, 'argv', argv), mock.patch('builtins.print'):
+            createh5.main()
+
+    def get_dicom_files(self):
+        import h5py
+        with h5py.File(self.output_file, 'r') as h5f:
+            self.assertEqual(h5f.attrs['nr_written'], h5f['images'].shape[0])
+            return list(h5f['metadata/dicom_file'].asstr()[:])
+
+    def test_append_skips_existing_files(self):
+        f_paths = [self.write_pair(f'{i:03d}') for i in range(3)]
+        self.run_main()
+        self.assertEqual(self.get_dicom_files(), f_paths)
+        f_paths.append(self.write_pair('003'))
+        self.run_main('--append')
+        self.assertEqual(self.get_dicom_files(), f_paths)
+        self.run_main('--append')
+        self.assertEqual(self.get_dicom_files(), f_paths)
+
+    def test_append_after_kill(self):
+        import h5py
+        f_paths = [self.write_pair(f'{i:03d}') for i in range(5)]
+        self.run_main()
+        # Simulate a run that was killed after preallocating rows and writing (but not committing)
+        # two of them: datasets are longer than the committed row count
+        with h5py.File(self.output_file, 'a') as h5f:
+            createh5.resize_datasets(h5f, 12)
+            h5f.attrs['nr_written'] = 3
+        with TrainingDataset(self.output_file) as dataset:
+            self.assertEqual(len(dataset), 3)
+            self.assertEqual(dataset.get_metadata(2)[0], f_paths[2])
+        f_paths.append(self.write_pair('005'))
+        self.run_main('--append')
+        dicom_files = self.get_dicom_files()
+        self.assertEqual(dicom_files, f_paths)
+        with TrainingDataset(self.output_file) as dataset:
+            self.assertEqual(len(dataset), 6)
+            images, labels = dataset.get_batch(0, 6)
+            self.assertTrue(np.all(np.any(labels > 0, axis=(1, 2))))
+            self.assertTrue(np.all(np.any(images != 0, axis=(1, 2))))
+
+
+if __name__ == '__main__':
+    unittest.main()
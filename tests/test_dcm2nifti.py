@@ -0,0 +1,123 @@
+import os
+import stat
+import time
+import shutil
+import tempfile
+import unittest
+
+from barbell2.converters.dcm2nifti import DicomToNiftiFarm, find_dcm2niix
+
+# Fake dcm2niix: writes <name>.nii.gz and <name>.json into the -o directory. Input directories
+# named *fail* produce a partial output file and a non-zero exit code
+STUB_DCM2NIIX = """#!/bin/sh
+while [ $# -gt 1 ]; do
+    case "$1" in
+        -f) name="$2"; shift;;
+        -o) output="$2"; shift;;
+    esac
+    shift
+done
+input="$1"
+echo "$input" >> "{calls_file}"
+touch "{running_dir}/$$"
+echo "$(ls {running_dir} | wc -l)" >> "{running_file}"
+sleep 0.3
+rm "{running_dir}/$$"
+case "$input" in
+    *fail*) echo partial > "$output/$name.nii.gz"; echo "conversion failed"; exit 2;;
+esac
+echo "converted $input" > "$output/$name.nii.gz"
+echo "{{}}" > "$output/$name.json"
+"""
+
+
+@unittest.skipIf(os.name == 'nt', 'Requires POSIX shell')
+class TestDicomToNiftiFarm(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.tmp_dir, 'bin')
+        running_dir = os.path.join(self.tmp_dir, 'running')
+        os.makedirs(bin_dir)
+        os.makedirs(running_dir)
+        self.calls_file = os.path.join(self.tmp_dir, 'calls.txt')
+        self.running_file = os.path.join(self.tmp_dir, 'running.txt')
+        executable = os.path.join(bin_dir, 'dcm2niix')
+        with open(executable, 'w') as f:
+            f.write(STUB_DCM2NIIX.format(calls_file=self.calls_file, running_dir=running_dir, running_file=self.running_file))
+        os.chmod(executable, os.stat(executable).st_mode | stat.S_IEXEC)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + self.path
+        find_dcm2niix.cache_clear()
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        find_dcm2niix.cache_clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def create_jobs(self, *names):
+        jobs = []
+        for name in names:
+            input_directory = os.path.join(self.tmp_dir, 'input', name)
+            os.makedirs(input_directory, exist_ok=True)
+            with open(os.path.join(input_directory, '1.dcm'), 'w') as f:
+                f.write(name)
+            jobs.append((input_directory, os.path.join(self.output_dir, f'{name}.nii.gz')))
+        return jobs
+
+    def read_lines(self, f_path):
+        if not os.path.isfile(f_path):
+            return []
+        with open(f_path, 'r') as f:
+            return f.read().splitlines()
+
+    def run_farm(self, jobs, **kwargs):
+        farm = DicomToNiftiFarm()
+        farm.jobs = jobs
+        for k, v in kwargs.items():
+            setattr(farm, k, v)
+        return farm.execute()
+
+    def test_convert(self):
+        jobs = self.create_jobs('p1', 'p2', 'p3', 'p4', 'p5')
+        output_files = self.run_farm(jobs, nr_workers=2)
+        self.assertEqual(output_files, [job[1] for job in jobs])
+        for input_directory, output_file in jobs:
+            self.assertEqual(self.read_lines(output_file), [f'converted {input_directory}'])
+            self.assertTrue(os.path.isfile(output_file + '.fingerprint'))
+            self.assertTrue(os.path.isfile(output_file[:-len('.nii.gz')] + '.json'))
+        self.assertEqual(sorted(self.read_lines(self.calls_file)), sorted([job[0] for job in jobs]))
+        self.assertEqual(max([int(x) for x in self.read_lines(self.running_file)]), 2)
+        # Temporary conversion directories are removed
+        self.assertEqual([f for f in os.listdir(self.output_dir) if f.startswith('.dcm2niix-')], [])
+
+    def test_failed_conversion_keeps_previous_output(self):
+        jobs = self.create_jobs('p1', 'fail')
+        os.makedirs(self.output_dir)
+        with open(jobs[1][1], 'w') as f:
+            f.write('previous')
+        output_files = self.run_farm(jobs)
+        self.assertEqual(output_files, [jobs[0][1], None])
+        self.assertEqual(self.read_lines(jobs[1][1]), ['previous'])
+        self.assertFalse(os.path.isfile(jobs[1][1] + '.fingerprint'))
+        self.assertEqual([f for f in os.listdir(self.output_dir) if f.startswith('.dcm2niix-')], [])
+
+    def test_skip_unchanged(self):
+        jobs = self.create_jobs('p1', 'p2')
+        self.run_farm(jobs)
+        self.assertEqual(len(self.read_lines(self.calls_file)), 2)
+        self.assertEqual(self.run_farm(jobs), [job[1] for job in jobs])
+        self.assertEqual(len(self.read_lines(self.calls_file)), 2)
+        # Changing an input file triggers conversion of that series only
+        time.sleep(0.01)
+        with open(os.path.join(jobs[1][0], '2.dcm'), 'w') as f:
+            f.write('new slice')
+        self.run_farm(jobs)
+        self.assertEqual(self.read_lines(self.calls_file)[2:], [jobs[1][0]])
+        self.run_farm(jobs, skip_unchanged=False)
+        self.assertEqual(len(self.read_lines(self.calls_file)), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+import pydicom
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+from barbell2.bodycomp.dicomindex import DicomIndex
+
+
+class TestDicomIndexGetBetween(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_series(self, prefix, z_positions):
+        series_instance_uid = generate_uid()
+        for i, z in enumerate(z_positions):
+            meta = FileMetaDataset()
+            meta.MediaStorageSOPClassUID = CTImageStorage
+            meta.MediaStorageSOPInstanceUID = generate_uid()
+            meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            p = Dataset()
+            p.file_meta = meta
+            p.SOPClassUID = CTImageStorage
+            p.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+            p.SeriesInstanceUID = series_instance_uid
+            p.ImagePositionPatient = [0.0, 0.0, z]
+            p.InstanceNumber = i + 1
+            pydicom.dcmwrite(os.path.join(self.tmp_dir, f'{prefix}{i:03d}.dcm'), p, enforce_file_format=True)
+        return series_instance_uid
+
+    def test_one_file_per_z(self):
+        self.write_series('a', [0.0, 2.5, 5.0, 7.5])
+        self.write_series('b', [0.0, 2.5, 5.0, 7.5])
+        files = DicomIndex(self.tmp_dir).get_between(2.4, 7.0)
+        self.assertEqual([os.path.split(f)[1] for f in files], ['b001.dcm', 'b002.dcm', 'b003.dcm'])
+        files = DicomIndex(self.tmp_dir).get_between(5.1, 5.1)
+        self.assertEqual([os.path.split(f)[1] for f in files], ['b002.dcm'])
+
+    def test_series_instance_uid(self):
+        series_a = self.write_series('a', [0.0, 2.5, 5.0, 7.5])
+        series_b = self.write_series('b', [1.0, 3.0, 5.0])
+        index = DicomIndex(self.tmp_dir)
+        files = index.get_between(0.0, 4.0, series_a)
+        self.assertEqual([os.path.split(f)[1] for f in files], ['a000.dcm', 'a001.dcm', 'a002.dcm'])
+        files = index.get_between(0.0, 4.0, series_b)
+        self.assertEqual([os.path.split(f)[1] for f in files], ['b000.dcm', 'b001.dcm'])
+        self.assertEqual(index.get_between(0.0, 4.0, '1.2.3'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
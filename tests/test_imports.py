@@ -0,0 +1,64 @@
+import os
+import re
+import sys
+import json
+import unittest
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Packages that console scripts must not load at import time
+HEAVY_MODULES = ['matplotlib', 'nibabel', 'h5py', 'tensorflow', 'nrrd', 'pandas', 'pydicom']
+
+# Max. nr. of seconds it may take to import a console script module (excluding interpreter startup).
+# Scripts currently import in about 0.15 s (mostly NumPy), pandas alone takes about 0.4 s
+IMPORT_TIME_BUDGET = 0.3
+
+IMPORT_SCRIPT = '''
+import sys, json, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': sorted(sys.modules.keys())}}))
+'''
+
+
+def get_console_script_modules():
+    """ Returns {script name: module} for the console scripts declared in setup.py
+    """
+    with open(os.path.join(ROOT_DIR, 'setup.py'), 'r') as f:
+        content = f.read()
+    return dict(re.findall(r"'([\w-]+)=([\w.]+):\w+'", content))
+
+
+class TestConsoleScriptImports(unittest.TestCase):
+    """ Imports each console script module in a fresh interpreter and checks that no heavy
+    dependencies are loaded and that the import stays within the startup budget
+    """
+    def import_module(self, module):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = ROOT_DIR + os.pathsep + env.get('PYTHONPATH', '')
+        result = subprocess.run(
+            [sys.executable, '-c', IMPORT_SCRIPT.format(module=module)],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=ROOT_DIR)
+        if result.returncode != 0:
+            self.fail(f'Could not import {module}: {result.stderr.decode(errors="replace")}')
+        return json.loads(result.stdout.decode().strip().split('\n')[-1])
+
+    def test_console_scripts(self):
+        scripts = get_console_script_modules()
+        self.assertGreater(len(scripts), 0)
+        for script, module in scripts.items():
+            with self.subTest(script=script):
+                if not os.path.isfile(os.path.join(ROOT_DIR, *module.split('.')) + '.py'):
+                    self.skipTest(f'{script}: module {module} declared in setup.py does not exist')
+                output = self.import_module(module)
+                loaded = [name for name in HEAVY_MODULES if name in output['modules']]
+                self.assertEqual(loaded, [], f'{script} imports {loaded}')
+                self.assertLess(
+                    output['seconds'], IMPORT_TIME_BUDGET,
+                    f'{script} takes {output["seconds"]:.2f} s to import (budget {IMPORT_TIME_BUDGET} s)')
+
+
+if __name__ == '__main__':
+    unittest.main()
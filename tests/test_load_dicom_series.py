@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pydicom
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+from barbell2.converters.dcm2nifti import load_dicom_series
+
+
+class TestLoadDicomSeries(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_series(self, positions, orientation=(1, 0, 0, 0, 1, 0), pixel_spacing=(0.8, 0.6), rows=6, cols=5, prefix=''):
+        """ Writes one file per position (in shuffled file name order) and returns list of
+        (position, pixels in HU) in the given order
+        """
+        series_instance_uid = generate_uid()
+        slices = []
+        names = self.rng.permutation(len(positions))
+        for name, position in zip(names, positions):
+            pixels = self.rng.integers(-1000, 1000, (rows, cols)).astype(np.int16)
+            meta = FileMetaDataset()
+            meta.MediaStorageSOPClassUID = CTImageStorage
+            meta.MediaStorageSOPInstanceUID = generate_uid()
+            meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            p = Dataset()
+            p.file_meta = meta
+            p.SOPClassUID = CTImageStorage
+            p.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+            p.SeriesInstanceUID = series_instance_uid
+            p.ImagePositionPatient = [float(x) for x in position]
+            p.ImageOrientationPatient = [float(x) for x in orientation]
+            p.PixelSpacing = [float(x) for x in pixel_spacing]
+            p.SliceThickness = 2.0
+            p.Rows, p.Columns = rows, cols
+            p.SamplesPerPixel = 1
+            p.PhotometricInterpretation = 'MONOCHROME2'
+            p.BitsAllocated, p.BitsStored, p.HighBit, p.PixelRepresentation = 16, 16, 15, 1
+            p.RescaleSlope, p.RescaleIntercept = 1, -1024
+            p.PixelData = (pixels + 1024).astype(np.int16).tobytes()
+            pydicom.dcmwrite(os.path.join(self.tmp_dir, f'{prefix}{name:03d}.dcm'), p, enforce_file_format=True)
+            slices.append((np.array(position, dtype=np.float64), pixels))
+        return slices
+
+    @staticmethod
+    def get_lps(position, orientation, pixel_spacing, row, col):
+        orientation = np.array(orientation, dtype=np.float64)
+        return position + col * pixel_spacing[1] * orientation[:3] + row * pixel_spacing[0] * orientation[3:]
+
+    def assert_series(self, image, slices, orientation, pixel_spacing):
+        """ Checks that voxel (i, j, k) holds pixel (row j, column i) of the k-th slice along the
+        slice normal and that the affine maps it to the pixel's RAS position
+        """
+        normal = np.cross(np.array(orientation[:3], dtype=np.float64), np.array(orientation[3:], dtype=np.float64))
+        slices = sorted(slices, key=lambda item: item[0].dot(normal))
+        volume = np.asarray(image.dataobj)
+        rows, cols = slices[0][1].shape
+        self.assertEqual(volume.shape, (cols, rows, len(slices)))
+        self.assertEqual(volume.dtype, np.int16)
+        for k, (position, pixels) in enumerate(slices):
+            np.testing.assert_array_equal(volume[:, :, k], pixels.T)
+            for row, col in [(0, 0), (rows - 1, 0), (2, cols - 1)]:
+                ras = image.affine.dot([col, row, k, 1])[:3]
+                lps = self.get_lps(position, orientation, pixel_spacing, row, col)
+                np.testing.assert_allclose(ras, lps * [-1, -1, 1], atol=1e-4)
+
+    def test_axial(self):
+        import nibabel
+        positions = [(-50, -60, z) for z in [10, 12, 14, 16]]
+        slices = self.write_series(positions)
+        image = load_dicom_series(self.tmp_dir)
+        self.assert_series(image, slices, (1, 0, 0, 0, 1, 0), (0.8, 0.6))
+        self.assertEqual(nibabel.aff2axcodes(image.affine), ('L', 'P', 'S'))
+        self.assertEqual(image.header.get_xyzt_units()[0], 'mm')
+        np.testing.assert_allclose(image.header.get_zooms(), (0.6, 0.8, 2.0))
+
+    def test_descending_positions(self):
+        # Slices are sorted along the normal however they were acquired
+        positions = [(-50, -60, z) for z in [16, 14, 12, 10, 8]]
+        slices = self.write_series(positions)
+        self.assert_series(load_dicom_series(self.tmp_dir), slices, (1, 0, 0, 0, 1, 0), (0.8, 0.6))
+
+    def test_oblique(self):
+        angle = np.radians(20)
+        orientation = (1, 0, 0, 0, np.cos(angle), -np.sin(angle))
+        normal = np.cross(orientation[:3], orientation[3:])
+        positions = [np.array([-50.0, -60.0, 5.0]) + k * 2.5 * normal for k in range(4)]
+        slices = self.write_series(positions, orientation, (0.7, 0.7))
+        self.assert_series(load_dicom_series(self.tmp_dir), slices, orientation, (0.7, 0.7))
+
+    def test_sagittal(self):
+        import nibabel
+        orientation = (0, 1, 0, 0, 0, -1)
+        positions = [(x, -60, 40) for x in [-3, 0, 3]]
+        slices = self.write_series(positions, orientation)
+        image = load_dicom_series(self.tmp_dir)
+        self.assert_series(image, slices, orientation, (0.8, 0.6))
+        # Slice normal (row x column cosine) points to patient right
+        self.assertEqual(nibabel.aff2axcodes(image.affine), ('P', 'I', 'R'))
+
+    def test_largest_series(self):
+        self.write_series([(0, 0, z) for z in [0, 1]], prefix='a')
+        slices = self.write_series([(0, 0, z) for z in [0, 1, 2]], prefix='b')
+        with open(os.path.join(self.tmp_dir, 'notes.txt'), 'w') as f:
+            f.write('not a DICOM file')
+        self.assert_series(load_dicom_series(self.tmp_dir), slices, (1, 0, 0, 0, 1, 0), (0.8, 0.6))
+
+    def test_single_slice(self):
+        slices = self.write_series([(-50, -60, 10)])
+        image = load_dicom_series(self.tmp_dir)
+        self.assert_series(image, slices, (1, 0, 0, 0, 1, 0), (0.8, 0.6))
+        np.testing.assert_allclose(image.affine[:3, 2], [0, 0, 2.0])
+
+    def test_no_series(self):
+        with self.assertRaises(RuntimeError):
+            load_dicom_series(self.tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import re
+import html
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from barbell2.utils import create_color_map
+from barbell2.converters.mosaic import MosaicRenderer, resize_nearest
+from tests.test_npy2png import decode_png
+
+# Label i + 1 of file i gets its own color, so tiles can be traced back to their files
+COLOR_MAP = create_color_map({i: [i * 10, 255 - i * 10, 7] for i in range(1, 20)})
+
+
+class TestResizeNearest(unittest.TestCase):
+
+    def test_aspect_ratio(self):
+        pixels = np.arange(4 * 8, dtype=np.uint8).reshape(4, 8)
+        tile = resize_nearest(pixels, 4)
+        self.assertEqual(tile.shape, (4, 4, 3))
+        # 4 x 8 image becomes 2 x 4 and is centered vertically
+        np.testing.assert_array_equal(tile[0], 0)
+        np.testing.assert_array_equal(tile[3], 0)
+        np.testing.assert_array_equal(tile[1:3, :, 0], pixels[::2, ::2])
+
+
+class TestMosaicRenderer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmp_dir, 'input')
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        os.makedirs(self.input_dir)
+        self.npy_files = []
+        for i in range(11):
+            f_path = os.path.join(self.input_dir, f'{i:02d}.dcm.seg.npy')
+            np.save(f_path, np.full((10, 10), i + 1, dtype=np.uint8))
+            self.npy_files.append(f_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def create_renderer(self, npy_files):
+        renderer = MosaicRenderer()
+        renderer.npy_files = npy_files
+        renderer.output_dir = self.output_dir
+        renderer.rows, renderer.cols, renderer.tile_size = 2, 3, 8
+        renderer.color_map = COLOR_MAP
+        renderer.workers = 2
+        return renderer
+
+    def read_page(self, page_file):
+        with open(page_file, 'rb') as f:
+            return decode_png(f.read())
+
+    def read_areas(self):
+        with open(os.path.join(self.output_dir, 'index.html'), 'r') as f:
+            content = f.read()
+        areas = re.findall(r'<area shape="rect" coords="(\d+),(\d+),(\d+),(\d+)" href="([^"]*)" title="([^"]*)">', content)
+        return content, [([int(x) for x in area[:4]], html.unescape(area[4]), html.unescape(area[5])) for area in areas]
+
+    def test_pages(self):
+        renderer = self.create_renderer(self.npy_files)
+        self.assertEqual(renderer.execute(), os.path.join(self.output_dir, 'index.html'))
+        self.assertEqual([os.path.split(f)[1] for f in renderer.page_files], ['page_0000.png', 'page_0001.png'])
+        pages = [self.read_page(f) for f in renderer.page_files]
+        # Full page of 2 x 3 tiles and a last page of 5 tiles that still has 2 rows
+        self.assertEqual(pages[0].shape, (16, 24, 3))
+        self.assertEqual(pages[1].shape, (16, 24, 3))
+        for i in range(len(self.npy_files)):
+            page, j = pages[i // 6], i % 6
+            top, left = (j // 3) * 8, (j % 3) * 8
+            np.testing.assert_array_equal(page[top:top + 8, left:left + 8], np.broadcast_to(COLOR_MAP[i + 1], (8, 8, 3)))
+        # Unused tile on the last page stays black
+        np.testing.assert_array_equal(pages[1][8:16, 16:24], 0)
+
+    def test_image_map(self):
+        npy_files = self.npy_files[:4] + [os.path.join(self.input_dir, 'missing.seg.npy')]
+        renderer = self.create_renderer(npy_files)
+        renderer.execute()
+        content, areas = self.read_areas()
+        self.assertEqual(len(renderer.page_files), 1)
+        self.assertIn('<img src="page_0000.png" usemap="#page_0000" width="24" height="16">', content)
+        self.assertEqual(len(areas), 5)
+        for i, (coords, href, title) in enumerate(areas):
+            top, left = (i // 3) * 8, (i % 3) * 8
+            self.assertEqual(coords, [left, top, left + 8, top + 8])
+            self.assertEqual(os.path.normpath(os.path.join(self.output_dir, href)), npy_files[i])
+            self.assertTrue(title.startswith(os.path.split(npy_files[i])[1]))
+        self.assertNotIn('error', areas[0][2])
+        self.assertIn('(error:', areas[4][2])
+        np.testing.assert_array_equal(self.read_page(renderer.page_files[0])[8:16, 8:16], 0)
+
+    def test_render_directory(self):
+        index_file = MosaicRenderer.render_directory(
+            self.input_dir, self.output_dir, rows=4, cols=4, tile_size=8, color_map=COLOR_MAP, workers=1)
+        self.assertTrue(os.path.isfile(index_file))
+        page_files = sorted(f for f in os.listdir(self.output_dir) if f.endswith('.png'))
+        self.assertEqual(page_files, ['page_0000.png'])
+        self.assertEqual(self.read_page(os.path.join(self.output_dir, page_files[0])).shape, (24, 32, 3))
+        _, areas = self.read_areas()
+        self.assertEqual([title for _, _, title in areas], [os.path.split(f)[1] for f in self.npy_files])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pydicom
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+from barbell2.utils import get_color_map
+from barbell2.converters.npy2dcm import DicomSeriesWriter
+
+
+class TestDicomSeriesWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, 'source')
+        os.makedirs(self.source_dir)
+        self.series_instance_uid = generate_uid()
+        self.dcm_file_paths = [self.write_source(k) for k in range(3)]
+        rng = np.random.default_rng(0)
+        self.labels = rng.choice([0, 1, 5, 7], (3, 6, 4)).astype(np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_source(self, k):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        p = Dataset()
+        p.file_meta = meta
+        p.SOPClassUID = CTImageStorage
+        p.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        p.SeriesInstanceUID = self.series_instance_uid
+        p.SeriesNumber = 3
+        p.InstanceNumber = k + 1
+        p.ImagePositionPatient = [0.0, 0.0, 2.5 * k]
+        p.Rows, p.Columns = 6, 4
+        p.SamplesPerPixel = 1
+        p.PhotometricInterpretation = 'MONOCHROME2'
+        p.BitsAllocated, p.BitsStored, p.HighBit, p.PixelRepresentation = 16, 16, 15, 1
+        p.RescaleSlope, p.RescaleIntercept = 1, -1024
+        p.PixelData = np.full((6, 4), k, dtype=np.int16).tobytes()
+        f_path = os.path.join(self.source_dir, f'{k:03d}.dcm')
+        pydicom.dcmwrite(f_path, p, enforce_file_format=True)
+        return f_path
+
+    def create_writer(self, output_dir):
+        writer = DicomSeriesWriter()
+        writer.dcm_file_paths = self.dcm_file_paths
+        writer.output_dir = output_dir
+        writer.workers = 2
+        return writer
+
+    def test_write_overlay_series(self):
+        output_dir = os.path.join(self.tmp_dir, 'overlay')
+        output_files = self.create_writer(output_dir).write_overlay_series(self.labels)
+        self.assertEqual([os.path.split(f)[1] for f in output_files], [os.path.split(f)[1] for f in self.dcm_file_paths])
+        sop_instance_uids = set()
+        for k, f_path in enumerate(output_files):
+            p = pydicom.dcmread(f_path)
+            source = pydicom.dcmread(self.dcm_file_paths[k])
+            self.assertEqual(p.PhotometricInterpretation, 'RGB')
+            self.assertEqual(p.SeriesNumber, 1003)
+            self.assertNotEqual(p.SeriesInstanceUID, self.series_instance_uid)
+            self.assertEqual(p.InstanceNumber, k + 1)
+            self.assertEqual([float(x) for x in p.ImagePositionPatient], [0.0, 0.0, 2.5 * k])
+            self.assertEqual(p.SourceImageSequence[0].ReferencedSOPInstanceUID, source.SOPInstanceUID)
+            self.assertNotIn('RescaleIntercept', p)
+            np.testing.assert_array_equal(p.pixel_array, get_color_map('alberta')[self.labels[k]])
+            sop_instance_uids.add(p.SOPInstanceUID)
+        self.assertEqual(len(sop_instance_uids), 3)
+
+    def test_output_dir_is_source_dir(self):
+        originals = []
+        for f_path in self.dcm_file_paths:
+            with open(f_path, 'rb') as f:
+                originals.append(f.read())
+        link_dir = os.path.join(self.tmp_dir, 'link')
+        os.symlink(self.source_dir, link_dir)
+        for output_dir in [self.source_dir, self.source_dir + os.sep, link_dir]:
+            with self.assertRaises(ValueError):
+                self.create_writer(output_dir).write_overlay_series(self.labels)
+        for f_path, original in zip(self.dcm_file_paths, originals):
+            with open(f_path, 'rb') as f:
+                self.assertEqual(f.read(), original)
+
+    def test_label_count_mismatch(self):
+        writer = self.create_writer(os.path.join(self.tmp_dir, 'overlay'))
+        self.assertIsNone(writer.write_overlay_series(self.labels[:2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import zlib
+import struct
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from barbell2.utils import apply_window, get_color_map
+from barbell2.converters.npy2png import encode_png, render, Numpy2Png
+
+
+def decode_png(data):
+    """ Decodes 8-bit grayscale or RGB PNG without filters (as written by encode_png)
+    """
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    pos, chunks = 8, {}
+    while pos < len(data):
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        chunk_data = data[pos + 8:pos + 8 + length]
+        crc = struct.unpack('>I', data[pos + 8 + length:pos + 12 + length])[0]
+        assert crc == zlib.crc32(chunk_type + chunk_data)
+        chunks.setdefault(chunk_type, b'')
+        chunks[chunk_type] += chunk_data
+        pos += 12 + length
+    cols, rows, bit_depth, color_type = struct.unpack('>IIBB', chunks[b'IHDR'][:10])
+    assert bit_depth == 8
+    nr_channels = {0: 1, 2: 3}[color_type]
+    scanlines = np.frombuffer(zlib.decompress(chunks[b'IDAT']), dtype=np.uint8).reshape(rows, -1)
+    assert np.all(scanlines[:, 0] == 0)
+    pixels = scanlines[:, 1:].reshape(rows, cols, nr_channels)
+    return pixels[..., 0] if nr_channels == 1 else pixels
+
+
+class TestEncodePng(unittest.TestCase):
+
+    def test_grayscale(self):
+        pixels = np.arange(7 * 5, dtype=np.uint8).reshape(7, 5)
+        np.testing.assert_array_equal(decode_png(encode_png(pixels)), pixels)
+
+    def test_rgb(self):
+        pixels = np.random.default_rng(0).integers(0, 256, (4, 9, 3)).astype(np.uint8)
+        np.testing.assert_array_equal(decode_png(encode_png(pixels)), pixels)
+
+    def test_invalid_shape(self):
+        with self.assertRaises(ValueError):
+            encode_png(np.zeros((4, 4, 2), dtype=np.uint8))
+
+
+class TestRender(unittest.TestCase):
+
+    def setUp(self):
+        self.labels = np.array([[0, 1], [5, 7]], dtype=np.uint8)
+        self.image = np.array([[-1000, -150], [50, 250]], dtype=np.float32)
+
+    def test_labels(self):
+        rgb = render(self.labels)
+        np.testing.assert_array_equal(rgb, get_color_map('alberta')[self.labels])
+
+    def test_image(self):
+        gray = render(None, self.image, window=(400, 50))
+        self.assertEqual(gray.dtype, np.uint8)
+        np.testing.assert_array_equal(gray, (apply_window(self.image, (400, 50)) * 255 + 0.5).astype(np.uint8))
+        np.testing.assert_array_equal(gray, [[0, 0], [128, 255]])
+
+    def test_image_without_window(self):
+        np.testing.assert_array_equal(render(None, self.image, window=None), [[0, 173], [214, 255]])
+
+    def test_blend(self):
+        rgb = render(self.labels, self.image, window=(400, 50), alpha=0.5)
+        gray = render(None, self.image, window=(400, 50))
+        colors = get_color_map('alberta')[self.labels]
+        # Background keeps the gray value, labels are blended over it
+        np.testing.assert_array_equal(rgb[0, 0], [gray[0, 0]] * 3)
+        for row, col in [(0, 1), (1, 0), (1, 1)]:
+            expected = (0.5 * colors[row, col] + 0.5 * gray[row, col] + 0.5).astype(np.uint8)
+            np.testing.assert_array_equal(rgb[row, col], expected)
+
+    def test_nothing_to_render(self):
+        with self.assertRaises(ValueError):
+            render()
+
+
+class TestNumpy2Png(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.npy_files = []
+        for i in range(5):
+            f_path = os.path.join(self.tmp_dir, f'{i}.dcm.seg.npy')
+            np.save(f_path, rng.choice([0, 1, 5, 7], (6, 8)).astype(np.uint8))
+            self.npy_files.append(f_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_render_many(self):
+        output_dir = os.path.join(self.tmp_dir, 'png')
+        npy_files = self.npy_files + [os.path.join(self.tmp_dir, 'missing.seg.npy')]
+        png_files = Numpy2Png.render_many(npy_files, output_dir, workers=2)
+        self.assertEqual(png_files[-1], None)
+        for npy_file, png_file in zip(self.npy_files, png_files):
+            self.assertEqual(png_file, os.path.join(output_dir, os.path.split(npy_file)[1][:-len('.npy')] + '.png'))
+            with open(png_file, 'rb') as f:
+                np.testing.assert_array_equal(decode_png(f.read()), get_color_map('alberta')[np.load(npy_file)])
+
+    def test_execute(self):
+        n2p = Numpy2Png(self.npy_files[0])
+        n2p.set_output_dir(self.tmp_dir)
+        n2p.set_color_map('alberta')
+        n2p.execute()
+        with open(n2p.png_file_path, 'rb') as f:
+            np.testing.assert_array_equal(decode_png(f.read()), get_color_map('alberta')[np.load(self.npy_files[0])])
+
+
+if __name__ == '__main__':
+    unittest.main()
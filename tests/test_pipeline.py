@@ -0,0 +1,175 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from barbell2.bodycomp.pipeline import Pipeline, PipelineStage
+
+
+class StubStages:
+    """ Stage functions that write one file each and record which stages ran
+    """
+    def __init__(self):
+        self.calls = []             # List of (patient, stage, overwrite) tuples
+        self.fail = set()           # Names of stages that raise an exception
+        self.nr_active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def run(self, name, context, overwrite, inputs):
+        with self.lock:
+            self.calls.append((context['patient'], name, overwrite))
+            self.nr_active += 1
+            self.max_active = max(self.max_active, self.nr_active)
+        time.sleep(0.01)
+        with self.lock:
+            self.nr_active -= 1
+        if name in self.fail:
+            raise RuntimeError(f'{name} failed')
+        output_file = os.path.join(context['output_directory'], name + '.txt')
+        with open(output_file, 'w') as f:
+            f.write(','.join([str(context[x]) for x in inputs]))
+        return {name + '_file': output_file}
+
+    def create_stage(self, name, inputs, max_workers=1, params=None):
+        return PipelineStage(
+            name, inputs, [name + '_file'], lambda context, overwrite: self.run(name, context, overwrite, inputs),
+            max_workers, params)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_directories = []
+        for patient in ['P1', 'P2']:
+            d = os.path.join(self.tmp_dir, 'dicom', patient)
+            os.makedirs(d)
+            with open(os.path.join(d, 'image.dcm'), 'w') as f:
+                f.write(patient)
+            self.input_directories.append(d)
+        self.output_directory = os.path.join(self.tmp_dir, 'output')
+        self.stages = StubStages()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def create_pipeline(self, params=None):
+        # Stages are added out of order, the pipeline sorts them
+        pipeline = Pipeline()
+        pipeline.input_directories = self.input_directories
+        pipeline.output_directory = self.output_directory
+        pipeline.add_stage(self.stages.create_stage('c', ['a_file', 'b_file']))
+        pipeline.add_stage(self.stages.create_stage('b', ['a_file', 'patient'], params=params))
+        pipeline.add_stage(self.stages.create_stage('a', ['dicom_directory'], max_workers=2))
+        return pipeline
+
+    def run_pipeline(self, pipeline=None):
+        self.stages.calls = []
+        output = (pipeline or self.create_pipeline()).execute()
+        return output, sorted(self.stages.calls)
+
+    @staticmethod
+    def touch(file_path):
+        # Move modification time forward explicitly, file systems can have a coarse resolution
+        mtime_ns = os.stat(file_path).st_mtime_ns + 10 ** 9
+        os.utime(file_path, ns=(mtime_ns, mtime_ns))
+
+    def test_get_sorted_stages(self):
+        pipeline = self.create_pipeline()
+        self.assertEqual([stage.name for stage in pipeline.get_sorted_stages()], ['a', 'b', 'c'])
+
+    def test_get_sorted_stages_missing_input(self):
+        pipeline = self.create_pipeline()
+        pipeline.add_stage(self.stages.create_stage('d', ['e_file']))
+        pipeline.add_stage(self.stages.create_stage('e', ['d_file']))
+        with self.assertRaises(RuntimeError) as cm:
+            pipeline.get_sorted_stages()
+        self.assertIn("['d', 'e']", str(cm.exception))
+
+    def test_run(self):
+        output, calls = self.run_pipeline()
+        self.assertEqual(calls, [(p, s, False) for p in ['P1', 'P2'] for s in ['a', 'b', 'c']])
+        for patient in ['P1', 'P2']:
+            patient_directory = os.path.join(self.output_directory, patient)
+            self.assertEqual(output[patient]['c_file'], os.path.join(patient_directory, 'c.txt'))
+            self.assertTrue(os.path.isfile(os.path.join(patient_directory, Pipeline.STATE_FILE_NAME)))
+            with open(output[patient]['b_file'], 'r') as f:
+                self.assertEqual(f.read(), f'{patient_directory}/a.txt,{patient}')
+
+    def test_skip_unchanged(self):
+        first_output, _ = self.run_pipeline()
+        pipeline = self.create_pipeline()
+        output, calls = self.run_pipeline(pipeline)
+        self.assertEqual(calls, [])
+        self.assertEqual(output, first_output)
+        self.assertTrue(all([skipped for _, _, _, skipped in pipeline.timings]))
+        self.assertEqual(len(pipeline.timings), 6)
+
+    def test_rerun_after_input_changed(self):
+        first_output, _ = self.run_pipeline()
+        # Stage a is unchanged, stages b and c use its output and run again (overwriting their outputs)
+        self.touch(first_output['P1']['a_file'])
+        _, calls = self.run_pipeline()
+        self.assertEqual(calls, [('P1', 'b', True), ('P1', 'c', True)])
+        # A changed DICOM file re-runs all stages of that patient only
+        self.touch(os.path.join(self.input_directories[1], 'image.dcm'))
+        _, calls = self.run_pipeline()
+        self.assertEqual(calls, [('P2', 'a', True), ('P2', 'b', True), ('P2', 'c', True)])
+        _, calls = self.run_pipeline()
+        self.assertEqual(calls, [])
+
+    def test_rerun_after_params_changed(self):
+        self.run_pipeline()
+        _, calls = self.run_pipeline(self.create_pipeline(params={'mode': 'median'}))
+        # Stage c re-runs too because stage b rewrote its output
+        self.assertEqual(calls, [(p, s, True) for p in ['P1', 'P2'] for s in ['b', 'c']])
+
+    def test_rerun_missing_output(self):
+        first_output, _ = self.run_pipeline()
+        os.remove(first_output['P2']['c_file'])
+        _, calls = self.run_pipeline()
+        self.assertEqual(calls, [('P2', 'c', True)])
+
+    def test_overwrite(self):
+        self.run_pipeline()
+        pipeline = self.create_pipeline()
+        pipeline.overwrite = True
+        _, calls = self.run_pipeline(pipeline)
+        self.assertEqual(calls, [(p, s, True) for p in ['P1', 'P2'] for s in ['a', 'b', 'c']])
+
+    def test_failed_stage(self):
+        self.stages.fail.add('b')
+        output, calls = self.run_pipeline()
+        self.assertIsNone(output['P1'])
+        self.assertEqual(calls, [(p, s, False) for p in ['P1', 'P2'] for s in ['a', 'b']])
+        # Failed stage runs again next time, stage a is skipped
+        self.stages.fail.clear()
+        output, calls = self.run_pipeline()
+        self.assertIsNotNone(output['P1'])
+        self.assertEqual(calls, [(p, s, False) for p in ['P1', 'P2'] for s in ['b', 'c']])
+
+    def test_stage_max_workers(self):
+        self.input_directories = [os.path.join(self.tmp_dir, 'dicom', f'P{i}') for i in range(6)]
+        for d in self.input_directories:
+            os.makedirs(d, exist_ok=True)
+        pipeline = Pipeline()
+        pipeline.input_directories = self.input_directories
+        pipeline.output_directory = self.output_directory
+        pipeline.max_workers = 4
+        pipeline.add_stage(self.stages.create_stage('a', ['dicom_directory'], max_workers=2))
+        output, _ = self.run_pipeline(pipeline)
+        self.assertEqual(len(output), 6)
+        self.assertEqual(self.stages.max_active, 2)
+
+    def test_missing_directories(self):
+        pipeline = Pipeline()
+        self.assertIsNone(pipeline.execute())
+        pipeline.input_directories = self.input_directories
+        self.assertIsNone(pipeline.execute())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pydicom
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+from barbell2.bodycomp.seg import MuscleFatSegmentator
+
+
+class TestMuscleFatSegmentatorLoading(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.params = {'min_bound': -200, 'max_bound': 200, 'min_bound_contour': -1000, 'max_bound_contour': 1000}
+        self.input_files = []
+        for i in range(11):
+            self.input_files.append(self.write_dicom(os.path.join(self.tmp_dir, f'{i:03d}.dcm'), i))
+        not_dicom = os.path.join(self.tmp_dir, 'notes.txt')
+        with open(not_dicom, 'w') as f:
+            f.write('not a DICOM file')
+        self.input_files.insert(5, not_dicom)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def write_dicom(f_path, value):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        p = Dataset()
+        p.file_meta = meta
+        p.SOPClassUID = CTImageStorage
+        p.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        p.Rows, p.Columns = 8, 8
+        p.SamplesPerPixel = 1
+        p.PhotometricInterpretation = 'MONOCHROME2'
+        p.BitsAllocated, p.BitsStored, p.HighBit, p.PixelRepresentation = 16, 16, 15, 1
+        p.RescaleSlope, p.RescaleIntercept = 1, -1024
+        pixels = np.arange(64, dtype=np.int16).reshape(8, 8) * 10 + 1000 + value
+        p.PixelData = pixels.tobytes()
+        pydicom.dcmwrite(f_path, p, enforce_file_format=True)
+        return f_path
+
+    def test_load_batches(self):
+        segmentator = MuscleFatSegmentator()
+        segmentator.input_files = self.input_files
+        segmentator.batch_size = 4
+        segmentator.queue_size = 2
+        batches = list(segmentator.load_batches(self.params, True))
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 3])
+        files = [item[0] for batch in batches for item in batch]
+        self.assertEqual(files, [f for f in self.input_files if f.endswith('.dcm')])
+        for f, img, img_contour in batches[0]:
+            self.assertEqual(img.shape, (8, 8))
+            self.assertEqual(img_contour.shape, (8, 8))
+            self.assertGreaterEqual(img.min(), 0)
+            self.assertLessEqual(img.max(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from barbell2.utils import get_tag_pixels
+from barbell2.converters.tag2npy import Tag2Numpy
+
+
+class TestTag2Numpy(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.tag_files = []
+        for i in range(3):
+            f_path = os.path.join(self.tmp_dir, f'image{i}.dcm.tag')
+            # Decoder yields the form feed as first value and skips the byte after it
+            labels = rng.choice([0, 1, 5, 7], 8 * 8 - 1).astype(np.int8)
+            with open(f_path, 'wb') as f:
+                f.write(b'header\x0c\x00' + labels.tobytes())
+            self.tag_files.append(f_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, tag_files, **kwargs):
+        return sorted(Tag2Numpy.convert_many(tag_files, shape=(8, 8), workers=2, **kwargs))
+
+    def test_convert_many(self):
+        results = self.convert(self.tag_files)
+        self.assertEqual([r[0] for r in results], self.tag_files)
+        for tag_file, npy_file, error in results:
+            self.assertIsNone(error)
+            self.assertEqual(npy_file, tag_file[:-len('.tag')] + '.npy')
+            np.testing.assert_array_equal(np.load(npy_file), get_tag_pixels(tag_file).reshape(8, 8))
+
+    def test_overwrite(self):
+        npy_file = self.convert(self.tag_files[:1])[0][1]
+        np.save(npy_file, np.zeros((8, 8), dtype=np.uint16))
+        # Existing files are kept by default, same as the CLI without --overwrite
+        self.convert(self.tag_files[:1])
+        np.testing.assert_array_equal(np.load(npy_file), np.zeros((8, 8)))
+        self.convert(self.tag_files[:1], overwrite=True)
+        np.testing.assert_array_equal(np.load(npy_file), get_tag_pixels(self.tag_files[0]).reshape(8, 8))
+
+    def test_wrong_shape(self):
+        results = sorted(Tag2Numpy.convert_many(self.tag_files[:1], shape=(4, 4), workers=1))
+        self.assertEqual(results[0][1], None)
+        self.assertIsInstance(results[0][2], ValueError)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import os
+import stat
+import time
+import shutil
+import tempfile
+import unittest
+
+from barbell2.bodycomp.totalseg import TotalSegmentator, TotalSegmentatorRunner
+
+
+class TestTotalSegmentatorTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_executable(self):
+        # Fake TotalSegmentator that starts a child process and writes its PID
+        pid_file = os.path.join(self.tmp_dir, 'child.pid')
+        executable = os.path.join(self.tmp_dir, 'TotalSegmentator')
+        with open(executable, 'w') as f:
+            f.write(f'#!/bin/sh\nsleep 60 &\necho $! > {pid_file}\nwait\n')
+        os.chmod(executable, os.stat(executable).st_mode | stat.S_IEXEC)
+        return executable, pid_file
+
+    @staticmethod
+    def is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    @unittest.skipUnless(hasattr(os, 'killpg'), 'Requires process groups')
+    def test_timeout_kills_children(self):
+        executable, pid_file = self.write_executable()
+        segmentator = TotalSegmentator()
+        segmentator.input_file = os.path.join(self.tmp_dir, 'ct.nii.gz')
+        segmentator.output_directory = os.path.join(self.tmp_dir, 'output')
+        segmentator.executable = executable
+        segmentator.timeout = 1
+        start = time.time()
+        self.assertIsNone(segmentator.execute())
+        self.assertLess(time.time() - start, 30)
+        with open(pid_file, 'r') as f:
+            child_pid = int(f.read())
+        # Killed child is reparented to init, which may take a moment to reap it
+        for _ in range(50):
+            if not self.is_running(child_pid):
+                break
+            time.sleep(0.1)
+        self.assertFalse(self.is_running(child_pid))
+
+
+# Fake TotalSegmentator: logs its settings, keeps track of how many instances run at the same
+# time and fails, hangs or writes a segmentation depending on the input file name
+STUB_EXECUTABLE = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -i) input="$2"; shift;;
+        -o) output="$2"; shift;;
+    esac
+    shift
+done
+echo "input $input"
+echo "threads $OMP_NUM_THREADS"
+echo "memory $(ulimit -v)"
+touch "{running_dir}/$$"
+echo "running $(ls {running_dir} | wc -l)"
+case "$input" in
+    *fail*) rm "{running_dir}/$$"; echo "error"; exit 3;;
+    *hang*) rm "{running_dir}/$$"; sleep 60 & echo $! > "$output/child.pid"; wait;;
+esac
+sleep 0.5
+echo "running $(ls {running_dir} | wc -l)"
+rm "{running_dir}/$$"
+echo done > "$output/segmentation.nii.gz"
+"""
+
+
+@unittest.skipUnless(hasattr(os, 'killpg') and hasattr(os, 'wait4'), 'Requires process groups and wait4')
+class TestTotalSegmentatorRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        running_dir = os.path.join(self.tmp_dir, 'running')
+        os.makedirs(running_dir)
+        self.executable = os.path.join(self.tmp_dir, 'TotalSegmentator')
+        with open(self.executable, 'w') as f:
+            f.write(STUB_EXECUTABLE.format(running_dir=running_dir))
+        os.chmod(self.executable, os.stat(self.executable).st_mode | stat.S_IEXEC)
+        self.runner = TotalSegmentatorRunner()
+        self.runner.output_directory = os.path.join(self.tmp_dir, 'output')
+        self.runner.log_directory = os.path.join(self.tmp_dir, 'logs')
+        self.runner.executable = self.executable
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_input_files(self, *names):
+        return [os.path.join(self.tmp_dir, f'{name}.nii.gz') for name in names]
+
+    @staticmethod
+    def read_log(result):
+        with open(result['log_file'], 'r') as f:
+            return f.read().splitlines()
+
+    def test_parallel_runs(self):
+        self.runner.input_files = self.get_input_files('ct1', 'ct2', 'ct3', 'ct4', 'ct5')
+        self.runner.nr_parallel = 2
+        self.runner.nr_threads = 3
+        results = self.runner.execute()
+        self.assertEqual([r['input_file'] for r in results], self.runner.input_files)
+        max_running = 0
+        for i, result in enumerate(results):
+            self.assertEqual(result['exit_code'], 0)
+            self.assertFalse(result['timed_out'])
+            self.assertFalse(result['skipped'])
+            self.assertGreater(result['wall_time'], 0.4)
+            self.assertGreater(result['peak_rss'], 0)
+            self.assertEqual(result['output_directory'], os.path.join(self.runner.output_directory, f'ct{i + 1}'))
+            self.assertTrue(os.path.isfile(os.path.join(result['output_directory'], 'segmentation.nii.gz')))
+            # One log file per volume, starting with the command
+            self.assertEqual(result['log_file'], os.path.join(self.runner.log_directory, f'ct{i + 1}.log'))
+            lines = self.read_log(result)
+            self.assertTrue(lines[0].startswith(self.executable))
+            self.assertIn('--nr_thr_resamp 3', lines[0])
+            self.assertIn(f'input {self.runner.input_files[i]}', lines)
+            self.assertIn('threads 3', lines)
+            max_running = max([max_running] + [int(line.split()[1]) for line in lines if line.startswith('running')])
+        self.assertEqual(max_running, 2)
+
+    def test_exit_code(self):
+        self.runner.input_files = self.get_input_files('ct1', 'fail')
+        results = self.runner.execute()
+        self.assertEqual(results[0]['exit_code'], 0)
+        self.assertEqual(results[1]['exit_code'], 3)
+        self.assertFalse(results[1]['timed_out'])
+        self.assertIn('error', self.read_log(results[1]))
+
+    def test_timeout(self):
+        self.runner.input_files = self.get_input_files('hang', 'ct1')
+        self.runner.timeout = 1
+        start = time.time()
+        results = self.runner.execute()
+        self.assertLess(time.time() - start, 30)
+        self.assertTrue(results[0]['timed_out'])
+        self.assertEqual(results[0]['exit_code'], -9)
+        self.assertFalse(results[1]['timed_out'])
+        self.assertEqual(results[1]['exit_code'], 0)
+        with open(os.path.join(results[0]['output_directory'], 'child.pid'), 'r') as f:
+            child_pid = int(f.read())
+        for _ in range(50):
+            if not TestTotalSegmentatorTimeout.is_running(child_pid):
+                break
+            time.sleep(0.1)
+        self.assertFalse(TestTotalSegmentatorTimeout.is_running(child_pid))
+
+    def test_skipped(self):
+        self.runner.input_files = self.get_input_files('ct1', 'ct2')
+        os.makedirs(os.path.join(self.runner.output_directory, 'ct1'))
+        with open(os.path.join(self.runner.output_directory, 'ct1', 'existing.nii.gz'), 'w') as f:
+            f.write('existing')
+        self.runner.overwrite = False
+        results = self.runner.execute()
+        self.assertTrue(results[0]['skipped'])
+        self.assertIsNone(results[0]['exit_code'])
+        self.assertFalse(os.path.isfile(results[0]['log_file']))
+        self.assertFalse(results[1]['skipped'])
+        self.assertEqual(results[1]['exit_code'], 0)
+
+    def test_max_memory(self):
+        self.runner.input_files = self.get_input_files('ct1')
+        self.runner.max_memory = 4 * 1024 * 1024 * 1024
+        results = self.runner.execute()
+        self.assertEqual(results[0]['exit_code'], 0)
+        # ulimit -v reports kilobytes; the limit is set before the executable starts
+        self.assertIn(f'memory {4 * 1024 * 1024}', self.read_log(results[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+
+from barbell2.bodycomp.createh5 import create_datasets, resize_datasets
+from barbell2.bodycomp.trainingdata import TrainingDataset
+
+
+class RecordingArray:
+    """ Wraps dataset and records the row indices of each read
+    """
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+        self.reads = []
+
+    def __getitem__(self, idx):
+        self.reads.append(np.arange(self.shape[0])[idx])
+        return self.array[idx]
+
+
+def get_runs(indices):
+    """ Returns nr. of runs of consecutive values in sorted indices
+    """
+    indices = np.sort(np.atleast_1d(indices))
+    return 1 + int(np.count_nonzero(np.diff(indices) != 1)) if len(indices) > 0 else 0
+
+
+class TestTrainingDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, 'training.h5')
+        self.nr_rows = 50
+        with h5py.File(self.file_path, 'w') as h5f:
+            # Same layout as createh5: one slice per chunk
+            create_datasets(h5f, (4, 4), 1)
+            resize_datasets(h5f, self.nr_rows)
+            h5f['images'][:] = np.arange(self.nr_rows, dtype=np.float32)[:, np.newaxis, np.newaxis]
+            h5f['labels'][:] = (np.arange(self.nr_rows) % 8).astype(np.uint8)[:, np.newaxis, np.newaxis]
+            h5f.attrs['nr_written'] = self.nr_rows
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_blocks(self, indices, block_size):
+        self.assertEqual(sorted(indices.tolist()), list(range(self.nr_rows)))
+        blocks = indices // block_size
+        # Each block appears as one run of positions holding all of its rows
+        starts = np.flatnonzero(np.diff(np.concatenate([[-1], blocks])) != 0)
+        self.assertEqual(len(starts), len(np.unique(blocks)))
+        for block in np.split(indices, starts[1:]):
+            self.assertEqual(get_runs(block), 1)
+            self.assertEqual(block.min() % block_size, 0)
+
+    def test_default_block_size(self):
+        with TrainingDataset(self.file_path) as dataset:
+            self.assertEqual(dataset.chunk_size, 1)
+            self.assertEqual(dataset.block_size, TrainingDataset.MIN_BLOCK_SIZE)
+            indices = dataset.get_shuffled_indices(seed=1)
+            self.assert_blocks(indices, dataset.block_size)
+            self.assertFalse(np.array_equal(indices, np.arange(self.nr_rows)))
+
+    def test_block_size(self):
+        with TrainingDataset(self.file_path, block_size=5) as dataset:
+            self.assert_blocks(dataset.get_shuffled_indices(seed=2), 5)
+
+    def test_shuffled_reads_are_contiguous(self):
+        # Batches aligned with blocks read exactly one block each
+        with TrainingDataset(self.file_path, block_size=10) as dataset:
+            dataset.images = RecordingArray(dataset.images)
+            batch_size = dataset.block_size
+            seen = []
+            for images, labels in dataset.get_batches(batch_size, shuffle=True, seed=3):
+                rows = images[:, 0, 0].astype(np.int64)
+                np.testing.assert_array_equal(labels[:, 0, 0], rows % 8)
+                seen.extend(rows.tolist())
+            self.assertEqual(sorted(seen), list(range(self.nr_rows)))
+            self.assertEqual(len(dataset.images.reads), self.nr_rows // batch_size)
+            for read in dataset.images.reads:
+                self.assertEqual(len(read), batch_size)
+                self.assertEqual(get_runs(read), 1)
+
+    def test_iter_batches(self):
+        with TrainingDataset(self.file_path, window=(400, 50)) as dataset:
+            expected = list(dataset.get_batches(8, shuffle=True, seed=4))
+            for prefetch in [0, 2]:
+                batches = list(dataset.iter_batches(8, shuffle=True, seed=4, prefetch=prefetch))
+                self.assertEqual(len(batches), len(expected))
+                for (images, labels), (expected_images, expected_labels) in zip(batches, expected):
+                    np.testing.assert_array_equal(images, expected_images)
+                    np.testing.assert_array_equal(labels, expected_labels)
+            # Stopping early stops the prefetching thread
+            batches = dataset.iter_batches(8, prefetch=2)
+            next(batches)
+            batches.close()
+
+    def test_getitem(self):
+        with TrainingDataset(self.file_path) as dataset:
+            self.assertEqual(len(dataset), self.nr_rows)
+            image, labels = dataset[-1]
+            self.assertEqual(image[0, 0], self.nr_rows - 1)
+            with self.assertRaises(IndexError):
+                dataset[self.nr_rows]
+
+
+if __name__ == '__main__':
+    unittest.main()
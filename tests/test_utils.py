@@ -0,0 +1,180 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from barbell2.utils import (
+    get_tag_pixels,
+    get_tag_pixels_bytewise,
+    calculate_area,
+    calculate_mean_radiation_attenuation,
+    calculate_label_statistics,
+    iter_prefetched,
+    LabelMap,
+    ALBERTA_LABEL_MAP,
+)
+
+
+class TestGetTagPixels(unittest.TestCase):
+    """ Cross-checks the vectorized TAG decoder against the byte-by-byte reference decoder
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_tag_file(self, data):
+        f_path = os.path.join(self.tmp_dir, 'test.tag')
+        with open(f_path, 'wb') as f:
+            f.write(data)
+        return f_path
+
+    def assert_same_pixels(self, data):
+        f_path = self.write_tag_file(data)
+        expected = get_tag_pixels_bytewise(f_path)
+        actual = get_tag_pixels(f_path)
+        self.assertEqual(actual.dtype, expected.dtype)
+        self.assertEqual(actual.shape, expected.shape)
+        np.testing.assert_array_equal(actual, expected)
+
+    def test_labels(self):
+        rng = np.random.default_rng(0)
+        labels = rng.choice([0, 1, 2, 5, 7, 12, 14], 64 * 64).astype(np.int8)
+        self.assert_same_pixels(b'header\x00text\x0c\x00' + labels.tobytes())
+
+    def test_negative_bytes(self):
+        self.assert_same_pixels(b'h\x0c\x00' + bytes(range(256)))
+
+    def test_form_feed_in_pixels(self):
+        self.assert_same_pixels(b'h\x0c\x00\x01\x0c\x05\x0c')
+
+    def test_no_form_feed(self):
+        self.assert_same_pixels(b'header without terminator')
+
+    def test_form_feed_at_end(self):
+        self.assert_same_pixels(b'header\x0c')
+
+    def test_form_feed_and_one_byte(self):
+        self.assert_same_pixels(b'header\x0c\x00')
+
+    def test_empty_file(self):
+        self.assert_same_pixels(b'')
+
+
+class TestCalculateLabelStatistics(unittest.TestCase):
+    """ Compares the bincount kernel with the per-label helpers and np.std
+    """
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.labels = rng.choice([0, 1, 5, 7], (64, 64)).astype(np.uint8)
+        self.image = rng.normal(-20, 80, (64, 64))
+        self.pixel_spacing = (0.8, 0.7)
+
+    def assert_statistics(self, image, labels, pixel_spacing):
+        statistics = calculate_label_statistics(image, labels, pixel_spacing)
+        # Mask-based helpers do not support label 0 (background)
+        for label in [1, 5, 7]:
+            self.assertAlmostEqual(statistics[label]['area'], calculate_area(labels, label, pixel_spacing))
+            self.assertAlmostEqual(
+                statistics[label]['mean_ra'], calculate_mean_radiation_attenuation(image, labels, label), places=6)
+            self.assertAlmostEqual(statistics[label]['std_ra'], np.std(image[labels == label]), places=6)
+            self.assertEqual(statistics[label]['count'], np.count_nonzero(labels == label))
+
+    def test_single_slice(self):
+        self.assert_statistics(self.image, self.labels, self.pixel_spacing)
+
+    def test_large_values(self):
+        # E[x^2] - mean^2 loses all precision here (and can go negative)
+        image = 1e8 + self.image * 1e-3
+        statistics = calculate_label_statistics(image, self.labels, self.pixel_spacing)
+        for label in [0, 1, 5, 7]:
+            self.assertFalse(np.isnan(statistics[label]['std_ra']))
+            self.assertAlmostEqual(statistics[label]['std_ra'], np.std(image[self.labels == label]), places=6)
+
+    def test_constant_label(self):
+        image = np.full((64, 64), 3071.0)
+        statistics = calculate_label_statistics(image, self.labels, self.pixel_spacing)
+        for label in [0, 1, 5, 7]:
+            self.assertEqual(statistics[label]['std_ra'], 0.0)
+
+    def test_stack(self):
+        images = np.stack([self.image, self.image[::-1]])
+        labels = np.stack([self.labels, self.labels[:, ::-1]])
+        pixel_spacing = np.array([[0.8, 0.7], [1.0, 1.0]])
+        statistics = calculate_label_statistics(images, labels, pixel_spacing, labels_to_measure=[1, 9])
+        for i in range(2):
+            single = calculate_label_statistics(images[i], labels[i], pixel_spacing[i])
+            for k in ['area', 'mean_ra', 'std_ra', 'count']:
+                self.assertAlmostEqual(statistics[1][k][i], single[1][k])
+            self.assertEqual(statistics[9]['count'][i], 0)
+
+
+class TestIterPrefetched(unittest.TestCase):
+
+    def test_order(self):
+        self.assertEqual(list(iter_prefetched(iter(range(100)), 4)), list(range(100)))
+        self.assertEqual(list(iter_prefetched([], 4)), [])
+
+    def test_bounded(self):
+        produced = []
+
+        def items():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        prefetched = iter_prefetched(items(), 4)
+        self.assertEqual(next(prefetched), 0)
+        time.sleep(0.2)
+        # 4 items in the buffer plus one waiting to be put
+        self.assertLessEqual(len(produced), 6)
+        prefetched.close()
+        nr_produced = len(produced)
+        time.sleep(0.2)
+        self.assertEqual(len(produced), nr_produced)
+
+    def test_exception(self):
+        def items():
+            yield 1
+            raise ValueError('producer failed')
+
+        prefetched = iter_prefetched(items(), 4)
+        self.assertEqual(next(prefetched), 1)
+        with self.assertRaisesRegex(ValueError, 'producer failed'):
+            next(prefetched)
+
+
+class TestLabelMap(unittest.TestCase):
+
+    def test_apply(self):
+        pixels = np.array([[0, 1, 2], [5, 7, 12], [14, 7, 0]], dtype=np.uint16)
+        expected = np.array([[0, 1, 0], [5, 7, 0], [0, 7, 0]], dtype=np.uint8)
+        labels = ALBERTA_LABEL_MAP.apply(pixels)
+        self.assertEqual(labels.dtype, np.uint8)
+        np.testing.assert_array_equal(labels, expected)
+        stack = np.stack([pixels, pixels])
+        ALBERTA_LABEL_MAP.apply(stack, out=stack)
+        np.testing.assert_array_equal(stack, np.stack([expected, expected]))
+
+    def test_validate(self):
+        pixels = np.array([0, 1, 1, 5, 300, 300, 3], dtype=np.int64)
+        unexpected, missing = ALBERTA_LABEL_MAP.validate(pixels)
+        self.assertEqual(unexpected, {3: 1, 300: 2})
+        self.assertEqual(missing, [7])
+
+    def test_out_of_range(self):
+        label_map = LabelMap({1: 2})
+        with self.assertRaisesRegex(ValueError, r'\[-3, 256, 1000\]'):
+            label_map.apply(np.array([0, 1, -3, 256, 1000, 256], dtype=np.int32))
+        with self.assertRaisesRegex(ValueError, r'\[-1\]'):
+            label_map.count(np.array([[0, -1], [2, 3]], dtype=np.int16))
+        with self.assertRaisesRegex(ValueError, r'\[-1\]'):
+            ALBERTA_LABEL_MAP.validate(np.array([0, -1], dtype=np.int8))
+        np.testing.assert_array_equal(label_map.apply(np.array([0, 1, 255], dtype=np.int64)), [0, 2, 255])
+
+
+if __name__ == '__main__':
+    unittest.main()